@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, jsonify, json
+from flask import Flask, render_template, request, jsonify, json, abort
+from flask.json.provider import DefaultJSONProvider
 from json import JSONDecodeError
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timedelta
@@ -6,6 +7,30 @@ from dotenv import load_dotenv
 import requests
 import os
 import logging
+import threading
+try:
+    import orjson                   # opcional, si esta instalado se usa para parsear/serializar JSON
+except ImportError:
+    orjson = None
+import time
+import socket
+import uuid
+import contextvars
+import functools
+import cProfile
+import pstats
+import marshal
+import io
+import sys
+import random
+import hmac
+import hashlib
+import signal
+import atexit
+from collections import deque
+from contextlib import contextmanager
+from estado import EstadoMemoria, crear_backend_estado
+from cache_http import CacheHTTP
 #________________________________________________________________________________________
 """
 App middleware Zoho
@@ -35,6 +60,40 @@ api un valor vacio que la Api persivia como un error, se agrega para hacer una e
 - Se crea funcion from_zoho(): que realiza la captura del webhook y se envia a la App A
 - Se buscar Visitante si no existe crea visisitante y con el fin de poder visitor_id, y 
 con este ultimo buscar una nueva conversación, si no existe crearla.
+- Modo diferido (ZOHO_LAZY_CONVERSATIONS): mientras el usuario solo habla con el bot no se abre nada en
+Zoho; al escalar (btn_0 exacto) se crea la conversación con la transcripción, cada boton traducido una sola vez;
+si el agente la cierra los mensajes vuelven al buffer hasta la siguiente escalación
+- Pruebas en tests/ (python -m pytest -q), contra los Zoho y App A falsos de fakes.py
+- Estado compartido en estado.py (STATE_BACKEND_URL = memoria, sqlite:///ruta o redis://host): token,
+buffers del modo diferido, dedupe de los webhooks de Zoho y candados, para correr varios workers o instancias
+- Trazabilidad por request: el trace_id (X-Trace-Id, X-Request-ID, traceparent o uno nuevo) va en cada log y
+en las llamadas a Zoho/App A; TRACE_EXPORT_PATH guarda los spans y TRACE_SLOW_MS avisa de los lentos
+- Perfilado sin reiniciar: cProfile de un request con el header X-Profile (o una muestra con PROFILE_SAMPLE_RATE)
+y muestreo de pilas de todos los hilos; ambos se consultan en /admin/profile
+- Mapa local telefono -> conversación: un reconciliador (RECONCILE_INTERVAL) trae lo modificado desde el
+cursor y cada RECONCILE_FULL_SCAN_EVERY ciclos revisa todo; conversaciones sin estado no se tocan
+- Telefonos en E.164: "3001234567", "+57 300 123 4567" y "00573001234567" son la misma clave
+(PHONE_DEFAULT_COUNTRY_CODE=57 para numeros nacionales), memoizada porque el mismo numero se repite mucho
+- Cupos por endpoint (ADMISSION_LIMIT_WABA/ZOHO/HEALTH): lo que no alcanza cupo espera ADMISSION_QUEUE_WAIT_MS
+y sale con 503, con la cola llena sale de inmediato con 429; ambos con Retry-After
+- Apagado con SIGTERM (instalado por iniciar_app(), no al importar): se cierran los webhooks con 503, se drena
+y, si hay SHUTDOWN_CHECKPOINT_PATH, se guarda lo que aun no escribio en Zoho/App A para reenviarlo al iniciar
+- JSON con orjson si esta instalado (proveedor de Flask) y esquemas precompilados para los webhooks: un
+campo faltante es 400 y un cuerpo sobre WEBHOOK_MAX_BYTES es 413, los dos como {"error", "details"}
+- Plazo total por webhook (WABA_DEADLINE_SECONDS, ZOHO_DEADLINE_SECONDS): el timeout de cada llamada se recorta
+a lo que queda; sin tiempo no se llama mas y se responde 504 con el uso de cada paso
+- Carriles (PRIORITY_WEIGHTS, escalacion y agente antes que usuario y bot) para los UPSTREAM_CONCURRENCY
+cupos hacia Zoho/App A; el cupo se toma despues del candado del telefono y /admin/lanes muestra las esperas
+- soak.py: horas de trafico mixto contra los falsos de fakes.py (latencia, 429, 5xx, 200 vacios, resets);
+falla si crece la memoria asignada desde los modulos de la app (tracemalloc) o cae el throughput, el RSS es informativo
+- Multi-portal (ZOHO_PORTALS): /t/<portal>/api/... o el header X-Portal eligen el portal, con token, pool HTTP,
+cupos y claves de estado separados; traza y perfilado siguen al endpoint, asi que tambien cubren esas rutas
+- /stats (con token admin): mensajes por origen, conversaciones nuevas vs reutilizadas, botones, ecos y errores
+upstream del ultimo minuto/hora/dia; memoria fija, a lo sumo STATS_MAX_COUNTERS nombres (el resto va a "otros")
+- cache_http.py: los GET a visitors/conversations se guardan por ZOHO_CACHE_TTL (LRU con limite de bytes), se
+revalidan con ETag (304) y los iguales en vuelo se unen; un POST invalida la coleccion, incluso lo que estaba en vuelo
+- Captura para replay.py: con CAPTURE_PATH y CAPTURE_SALT (sin sal no se captura) cada webhook queda en JSONL
+sin telefonos ni textos, hasta CAPTURE_MAX_BYTES; replay.py la reenvia de 1x a 50x contra los falsos
 
 """
 #________________________________________________________________________________________
@@ -44,7 +103,7 @@ load_dotenv()
 app = Flask(__name__)
 
 # Configura el logger (Log de eventos para ajustado para utilizarlo en render)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s')
 #________________________________________________________________________________________
 #variables entorno y configuración
 
@@ -54,15 +113,542 @@ ZOHO_REFRESH_TOKEN = os.getenv("ZOHO_REFRESH_TOKEN")
 ZOHO_ACCESS_TOKEN = os.getenv("ZOHO_ACCESS_TOKEN")
 ZOHO_PORTAL_NAME = os.getenv("ZOHO_PORTAL_NAME")            # ej: "ticallmedia"
 ZOHO_SALESIQ_BASE = os.getenv("ZOHO_SALESIQ_BASE", "https://salesiq.zoho.com/api/v2")
+ZOHO_VISITOR_BASE = os.getenv("ZOHO_VISITOR_BASE", "https://salesiq.zoho.com/visitor/v2")
+ZOHO_ACCOUNTS_URL = os.getenv("ZOHO_ACCOUNTS_URL", "https://accounts.zoho.com")   # OAuth (soak/fakes lo apuntan a local)
 
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")                    # para /webhook GET verification
 APP_A_URL = os.getenv("APP_A_URL")                          # URL de App A para reenviar respuestas
 SALESIQ_APP_ID = os.getenv("SALESIQ_APP_ID")                # opcional (para crear conversación)
 SALESIQ_DEPARTMENT_ID = os.getenv("SALESIQ_DEPARTMENT_ID")  # opcional
 
-#variables para gestionar el estado del token
-CACHED_ACCESS_TOKEN = None
-TOKEN_EXPIRATION_TIME = None 
+# Varios portales en un proceso: JSON (o ruta a un .json) {"<portal>": {"portal_name": ..., "client_id": ..., ...}}
+# Las variables de arriba definen el portal "default", los valores "$VARIABLE" se leen del entorno
+ZOHO_PORTALS = os.getenv("ZOHO_PORTALS", "")
+PORTAL_DEFAULT = os.getenv("PORTAL_DEFAULT", "default")
+PORTAL_HEADER = os.getenv("PORTAL_HEADER", "X-Portal")                        # alternativa a la ruta /t/<portal>/...
+PORTAL_ADMISSION_SHARE = float(os.getenv("PORTAL_ADMISSION_SHARE", "0.5"))    # fracción maxima del cupo de admisión por portal
+
+# Estadisticas de trafico en memoria (/stats)
+STATS_MAX_COUNTERS = int(os.getenv("STATS_MAX_COUNTERS", "128"))             # contadores distintos (btn_*, errores, ...)
+
+# Cache de lecturas (GET) a Zoho con ETag/Last-Modified
+ZOHO_CACHE_TTL = float(os.getenv("ZOHO_CACHE_TTL", "5"))                      # segundos, 0 desactiva la cache
+ZOHO_CACHE_TTLS = os.getenv("ZOHO_CACHE_TTLS", "visitors:15,conversations:5,tags:300")   # por coleccion (ultimo segmento de la URL)
+ZOHO_CACHE_MAX_ENTRIES = int(os.getenv("ZOHO_CACHE_MAX_ENTRIES", "256"))
+ZOHO_CACHE_MAX_BYTES = int(os.getenv("ZOHO_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Captura de trafico para replay.py (vacio = desactivada)
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+CAPTURE_SAMPLE_RATE = float(os.getenv("CAPTURE_SAMPLE_RATE", "1"))
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(200 * 1024 * 1024)))
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")                              # sal del hash de telefonos e ids, obligatoria con CAPTURE_PATH
+
+# Modo diferido: las conversaciones solo bot se guardan localmente y solo se crean en Zoho al escalar
+ZOHO_LAZY_CONVERSATIONS = os.getenv("ZOHO_LAZY_CONVERSATIONS", "false").lower() in ("1", "true", "si", "yes")
+ZOHO_LAZY_TRIGGERS = [t.strip() for t in os.getenv("ZOHO_LAZY_TRIGGERS", "btn_0").split(",") if t.strip()]
+ZOHO_LAZY_MAX_BUFFER = int(os.getenv("ZOHO_LAZY_MAX_BUFFER", "50"))          # mensajes maximos por telefono
+ZOHO_LAZY_TTL = int(os.getenv("ZOHO_LAZY_TTL", "86400"))                     # segundos sin actividad antes de descartar
+
+# Estado compartido entre workers/instancias: "memoria", "sqlite:///ruta/estado.db" o "redis://:clave@host:6379/0"
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "memoria")
+DEDUPE_TTL = int(os.getenv("DEDUPE_TTL", "600"))                             # segundos que se recuerda un webhook procesado
+
+# Trazabilidad: archivo JSON lines con los spans de cada request y umbral para marcar requests lentos
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")                          # vacio = no exportar
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+
+# Presupuesto de tiempo por request: los timeouts de cada llamada se recortan a lo que queda
+WABA_DEADLINE_SECONDS = float(os.getenv("WABA_DEADLINE_SECONDS", "25"))
+ZOHO_DEADLINE_SECONDS = float(os.getenv("ZOHO_DEADLINE_SECONDS", "25"))
+
+# Perfilado bajo demanda (endpoints /admin/profile), protegido con ADMIN_SECRET o VERIFY_TOKEN
+ADMIN_SECRET = os.getenv("ADMIN_SECRET") or VERIFY_TOKEN
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))         # 0.01 = 1% de los requests
+PROFILE_MAX_RESULTS = int(os.getenv("PROFILE_MAX_RESULTS", "20"))
+PROFILE_MAX_SAMPLE_SECONDS = int(os.getenv("PROFILE_MAX_SAMPLE_SECONDS", "60"))
+
+# Reconciliador de conversaciones abiertas (0 = desactivado)
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "0"))                  # segundos entre ciclos
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "100"))
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", "5"))                 # paginas por ciclo incremental
+RECONCILE_FULL_SCAN_EVERY = int(os.getenv("RECONCILE_FULL_SCAN_EVERY", "120"))   # cada cuantos ciclos se hace un escaneo completo
+RECONCILE_FULL_SCAN_MAX_PAGES = int(os.getenv("RECONCILE_FULL_SCAN_MAX_PAGES", "50"))
+CONVERSATION_MAP_TTL = int(os.getenv("CONVERSATION_MAP_TTL", "86400"))          # vigencia del mapa telefono -> conversación
+
+# Normalización de telefonos a E.164 (por defecto Colombia +57)
+PHONE_DEFAULT_COUNTRY_CODE = os.getenv("PHONE_DEFAULT_COUNTRY_CODE", "57")
+PHONE_NATIONAL_LENGTH = int(os.getenv("PHONE_NATIONAL_LENGTH", "10"))            # digitos de un numero nacional
+PHONE_CACHE_SIZE = int(os.getenv("PHONE_CACHE_SIZE", "4096"))
+
+# Control de admisión: trabajo simultaneo por endpoint y espera maxima antes de responder 429/503
+ADMISSION_LIMIT_WABA = int(os.getenv("ADMISSION_LIMIT_WABA", "8"))
+ADMISSION_LIMIT_ZOHO = int(os.getenv("ADMISSION_LIMIT_ZOHO", "8"))
+ADMISSION_LIMIT_HEALTH = int(os.getenv("ADMISSION_LIMIT_HEALTH", "4"))
+ADMISSION_QUEUE_WAIT_MS = int(os.getenv("ADMISSION_QUEUE_WAIT_MS", "500"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))              # requests esperando turno por endpoint
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))           # segundos sugeridos en Retry-After
+
+# Apagado ordenado (SIGTERM en cada deploy de Render)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+SHUTDOWN_CHECKPOINT_PATH = os.getenv("SHUTDOWN_CHECKPOINT_PATH", "")   # vacio = no guardar ni reanudar
+
+# Tamaño maximo de un webhook, los mas grandes se rechazan con 413 sin leerlos
+WEBHOOK_MAX_BYTES = int(os.getenv("WEBHOOK_MAX_BYTES", "262144"))
+
+# Carriles de prioridad para el trabajo hacia Zoho/App A (clase:peso)
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "6"))             # llamadas simultaneas a Zoho/App A
+PRIORITY_WEIGHTS = os.getenv("PRIORITY_WEIGHTS", "escalacion:8,agente:8,usuario:4,bot:1")
+PRIORITY_MAX_WAIT_MS = int(os.getenv("PRIORITY_MAX_WAIT_MS", "2000"))           # anti-inanición: pasa primero quien espere mas
+PRIORITY_QUEUE_TIMEOUT = float(os.getenv("PRIORITY_QUEUE_TIMEOUT", "10"))       # espera maxima sin presupuesto de request
+
+#________________________________________________________________________________________
+#Estado compartido (token, modo diferido, dedupe y candados)
+#________________________________________________________________________________________
+"""
+Todo el estado que deben compartir varios workers o instancias pasa por ESTADO, los backends
+(memoria, sqlite, redis) estan en estado.py.
+"""
+ESTADO = crear_backend_estado(STATE_BACKEND_URL)
+# identifica a este proceso como dueño de los leases
+ID_PROCESO = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+@contextmanager
+def candado_estado(clave, ttl=30, espera=10):
+    """
+    Candado compartido sobre ESTADO. Si no se obtiene en 'espera' segundos se continua
+    sin candado (se prefiere un duplicado a dejar el mensaje sin atender). Retorna si se obtuvo.
+    """
+    dueno = f"{ID_PROCESO}-{threading.get_ident()}"
+    restante = presupuesto_restante()
+    if restante is not None:
+        espera = min(espera, restante)
+    limite = time.monotonic() + espera
+    obtenido = False
+    try:
+        while True:
+            try:
+                obtenido = ESTADO.adquirir_lease(clave, dueno, ttl)
+            except Exception as e:
+                logging.error(f"candado_estado: Error del backend de estado tomando {clave}: {e}")
+                break
+            if obtenido or time.monotonic() >= limite:
+                break
+            time.sleep(0.05)
+        if not obtenido:
+            logging.warning(f"candado_estado: No se obtuvo el candado {clave}, se continua sin candado")
+        yield obtenido
+    finally:
+        if obtenido:
+            try:
+                ESTADO.liberar_lease(clave, dueno)
+            except Exception as e:
+                logging.error(f"candado_estado: Error liberando {clave}: {e}")
+#________________________________________________________________________________________
+#Trazabilidad (trace_id por request y spans por llamada)
+#________________________________________________________________________________________
+"""
+Cada request a la API recibe un trace_id (se toma de X-Trace-Id / X-Request-ID / X-Correlation-ID /
+traceparent o se genera), que va en cada linea de log y en los headers de las llamadas a Zoho y App A.
+Cada funcion auxiliar registra un span con su duración; al terminar el request los spans se exportan
+en JSON lines (TRACE_EXPORT_PATH) y si supera TRACE_SLOW_MS se loguea el detalle.
+"""
+_TRAZA = contextvars.ContextVar("traza", default=None)
+_EXPORT_LOCK = threading.Lock()
+HEADERS_TRAZA = ("X-Trace-Id", "X-Request-ID", "X-Correlation-ID")
+# por endpoint y no por ruta: /api/from-waba y /t/<portal>/api/from-waba son el mismo webhook
+ENDPOINTS_WEBHOOK = ("from_waba", "from_zoho")
+
+_fabrica_registros = logging.getLogRecordFactory()
+
+def _registro_con_traza(*args, **kwargs):
+    registro = _fabrica_registros(*args, **kwargs)
+    traza = _TRAZA.get()
+    registro.trace_id = traza["trace_id"] if traza else "-"
+    return registro
+
+logging.setLogRecordFactory(_registro_con_traza)
+
+def trace_id_de_headers(headers):
+    """
+    Toma el trace_id que envia quien llama, o genera uno nuevo
+    """
+    for nombre in HEADERS_TRAZA:
+        valor = headers.get(nombre)
+        if valor:
+            return valor.strip()[:64]
+    traceparent = headers.get("traceparent")    # W3C: version-traceid-spanid-flags
+    if traceparent and traceparent.count("-") == 3:
+        return traceparent.split("-")[1]
+    return uuid.uuid4().hex
+
+def iniciar_traza(trace_id, nombre):
+    return _TRAZA.set({"trace_id": trace_id, "nombre": nombre, "inicio": time.perf_counter(), "spans": []})
+
+def traza_actual():
+    return _TRAZA.get()
+
+@contextmanager
+def span(nombre):
+    """
+    Mide la duración de un bloque y lo agrega a la traza del request actual
+    """
+    traza = _TRAZA.get()
+    inicio = time.perf_counter()
+    registro = {"span": nombre, "error": None}
+    try:
+        yield registro
+    except Exception as e:
+        registro["error"] = type(e).__name__
+        raise
+    finally:
+        duracion_ms = round((time.perf_counter() - inicio) * 1000, 2)
+        if traza is not None:
+            registro["inicio_ms"] = round((inicio - traza["inicio"]) * 1000, 2)
+            registro["duracion_ms"] = duracion_ms
+            traza["spans"].append(registro)
+        plazo = _PLAZO.get()
+        if plazo is not None:
+            restante = presupuesto_restante()
+            plazo["pasos"].append({"paso": nombre, "ms": duracion_ms, "restante_ms": round(restante * 1000)})
+            logging.info(f"presupuesto: paso {nombre} uso {duracion_ms}ms, restan {round(restante * 1000)}ms de {plazo['total']}s")
+
+def medir_span(nombre):
+    """
+    Decorador: registra un span con la duración de la función auxiliar
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            with span(nombre) as registro:
+                registro["funcion"] = funcion.__name__
+                return funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+def finalizar_traza(token_contexto, status):
+    """
+    Cierra la traza del request: exporta los spans y avisa si fue lento
+    """
+    traza = _TRAZA.get()
+    try:
+        if traza is None:
+            return
+        total_ms = round((time.perf_counter() - traza["inicio"]) * 1000, 2)
+        resumen = {
+            "ts": datetime.now().isoformat(),
+            "trace_id": traza["trace_id"],
+            "endpoint": traza["nombre"],
+            "status": status,
+            "duracion_ms": total_ms,
+            "lento": total_ms > TRACE_SLOW_MS,
+            "spans": traza["spans"]
+        }
+        if resumen["lento"]:
+            detalle = ", ".join(f"{s['span']}={s['duracion_ms']}ms" for s in traza["spans"])
+            logging.warning(f"traza: Request lento {traza['nombre']} {total_ms}ms (umbral {TRACE_SLOW_MS}ms) -> {detalle}")
+        if TRACE_EXPORT_PATH:
+            linea = json.dumps(resumen, ensure_ascii=False)
+            with _EXPORT_LOCK, open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as archivo:
+                archivo.write(linea + "\n")
+    except Exception as e:
+        logging.error(f"traza: No se pudo exportar la traza -> {e}")
+    finally:
+        _TRAZA.reset(token_contexto)
+
+#________________________________________________________________________________________
+#Presupuesto de tiempo por request (deadline)
+#________________________________________________________________________________________
+"""
+from_waba puede encadenar token + busqueda + creación + envio. Con con_plazo() el request tiene un
+presupuesto total; cada llamada HTTP usa como timeout lo que quede (nunca mas que su propio timeout)
+y si ya no queda tiempo la llamada no se hace (PresupuestoAgotado). El uso por paso se loguea.
+"""
+_PLAZO = contextvars.ContextVar("plazo", default=None)
+
+class PresupuestoAgotado(requests.exceptions.Timeout):
+    """Se agoto el presupuesto de tiempo del request, la llamada no se realiza"""
+
+def presupuesto_restante():
+    """
+    Segundos que le quedan al request actual, None si no tiene presupuesto
+    """
+    plazo = _PLAZO.get()
+    if plazo is None:
+        return None
+    return max(plazo["limite"] - time.monotonic(), 0)
+
+def presupuesto_agotado():
+    restante = presupuesto_restante()
+    return restante is not None and restante <= 0.05
+
+def resumen_presupuesto():
+    plazo = _PLAZO.get()
+    return {"budget_s": plazo["total"], "steps": plazo["pasos"]} if plazo else {}
+
+def respuesta_plazo_agotado(telefono):
+    """
+    504 con el detalle del presupuesto, la misma respuesta en todos los puntos donde se agota
+    """
+    return jsonify({"error": "Deadline exceeded", "phone": telefono, **resumen_presupuesto()}), 504
+
+def recortar_timeout(timeout):
+    """
+    Recorta el timeout de una llamada a lo que queda del presupuesto
+    """
+    restante = presupuesto_restante()
+    if restante is None:
+        return timeout
+    if restante <= 0.05:
+        raise PresupuestoAgotado(f"presupuesto de {_PLAZO.get()['total']}s agotado, no se realiza la llamada")
+    if timeout is None:
+        return restante
+    if isinstance(timeout, tuple):
+        return tuple(min(t, restante) if t is not None else restante for t in timeout)
+    return min(timeout, restante)
+
+def con_plazo(segundos):
+    """
+    Decorador: el endpoint corre con un presupuesto total de 'segundos'
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            token_contexto = _PLAZO.set({"limite": time.monotonic() + segundos, "total": segundos, "pasos": []})
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                usado = round(segundos - presupuesto_restante(), 3)
+                logging.info(f"presupuesto: {request.path} uso {usado}s de {segundos}s en {len(_PLAZO.get()['pasos'])} pasos")
+                _PLAZO.reset(token_contexto)
+        return envoltura
+    return decorador
+
+class SesionTrazada(requests.Session):
+    """
+    Sesión HTTP usada para todas las llamadas salientes (reutiliza conexiones), que propaga
+    el trace_id del request actual y recorta el timeout al presupuesto que queda.
+    Con 'cache' los GET a Zoho pasan por CacheHTTP y las escrituras exitosas la invalidan.
+    """
+    def __init__(self, cache=None):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs["timeout"] = recortar_timeout(kwargs.get("timeout"))
+        if self.cache is None:
+            return self._enviar(method, url, *args, **kwargs)
+        if method.upper() == "GET" and self.cache.aplica(url, kwargs):
+            return self.cache.obtener(url, kwargs, lambda opciones: self._enviar(method, url, *args, **opciones))
+        respuesta = self._enviar(method, url, *args, **kwargs)
+        if method.upper() != "GET" and respuesta.status_code < 400:
+            self.cache.invalidar(url)
+        return respuesta
+
+    def _enviar(self, method, url, *args, **kwargs):
+        # refrescar el token no escribe nada en Zoho: el request todavia se puede reenviar
+        if method.upper() != "GET" and not url.split("?")[0].endswith("/oauth/v2/token"):
+            marcar_trabajo_upstream()
+        traza = _TRAZA.get()
+        if traza is not None:
+            headers = dict(kwargs.get("headers") or {})
+            headers.setdefault("X-Trace-Id", traza["trace_id"])
+            kwargs["headers"] = headers
+        try:
+            respuesta = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            ESTADISTICAS.contar("errores_upstream", f"errores_upstream:{type(e).__name__}")
+            raise
+        if respuesta.status_code >= 500 or respuesta.status_code == 429:
+            ESTADISTICAS.contar("errores_upstream", f"errores_upstream:{respuesta.status_code}")
+        return respuesta
+
+class _SesionDelPortal:
+    """
+    HTTP resuelve a la sesión (pool de conexiones) del portal del request actual
+    """
+    def __getattr__(self, nombre):
+        return getattr(portal_actual().http, nombre)
+
+HTTP = _SesionDelPortal()
+
+@app.before_request
+def _abrir_traza():
+    if request.endpoint in ENDPOINTS_WEBHOOK:
+        request.environ["traza.token"] = iniciar_traza(trace_id_de_headers(request.headers), request.path)
+
+@app.after_request
+def _header_traza(response):
+    traza = _TRAZA.get()
+    if traza is not None:
+        response.headers["X-Trace-Id"] = traza["trace_id"]
+        request.environ["traza.status"] = response.status_code
+    return response
+
+@app.teardown_request
+def _cerrar_traza(error=None):
+    token_contexto = request.environ.pop("traza.token", None)
+    if token_contexto is not None:
+        finalizar_traza(token_contexto, request.environ.get("traza.status", 500))
+
+#________________________________________________________________________________________
+#Perfilado bajo demanda
+#________________________________________________________________________________________
+"""
+Dos modos, sin reiniciar la app:
+- cProfile por request: header X-Profile: <ADMIN_SECRET> o muestreo con PROFILE_SAMPLE_RATE en
+los webhooks (ENDPOINTS_WEBHOOK, tambien bajo /t/<portal>/). Los resultados quedan en memoria (PROFILE_MAX_RESULTS).
+- Muestreo de pilas: /admin/profile/sample?seconds=N toma las pilas de todos los hilos cada
+pocos ms y devuelve el formato collapsed-stack (flamegraph.pl, speedscope).
+Los requests que no se perfilan solo pagan la lectura de un header.
+"""
+PERFILES = deque(maxlen=PROFILE_MAX_RESULTS)
+_MUESTREO_LOCK = threading.Lock()
+
+class _PerfilGuardado:
+    """
+    pstats.Stats vacia el perfil que recibe, se guarda el dict de stats y se entrega una copia cada vez
+    """
+    def __init__(self, stats):
+        self.stats = dict(stats)
+
+    def create_stats(self):
+        pass
+
+def es_admin(valor):
+    """
+    Compara el secreto recibido contra ADMIN_SECRET en tiempo constante
+    """
+    return bool(ADMIN_SECRET and valor) and hmac.compare_digest(str(valor), ADMIN_SECRET)
+
+def admin_autorizado():
+    return es_admin(request.headers.get("X-Admin-Token") or request.args.get("token"))
+
+@app.before_request
+def _iniciar_perfil():
+    if request.endpoint not in ENDPOINTS_WEBHOOK:
+        return
+    solicitado = request.headers.get("X-Profile")
+    if not ((solicitado and es_admin(solicitado)) or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE)):
+        return
+
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:
+        # ya hay otro profiler activo en el proceso
+        logging.warning("perfil: Ya hay un profiler activo, no se perfila este request")
+        return
+    request.environ["perfil"] = (perfil, time.perf_counter())
+
+@app.teardown_request
+def _terminar_perfil(error=None):
+    datos = request.environ.pop("perfil", None)
+    if not datos:
+        return
+    perfil, inicio = datos
+    perfil.disable()
+    perfil.create_stats()
+    traza = traza_actual()
+    PERFILES.append({
+        "id": uuid.uuid4().hex[:12],
+        "ts": datetime.now().isoformat(),
+        "ruta": request.path,
+        "trace_id": traza["trace_id"] if traza else None,
+        "duracion_ms": round((time.perf_counter() - inicio) * 1000, 2),
+        "stats": perfil.stats
+    })
+
+def muestrear_pilas(segundos, intervalo):
+    """
+    Toma las pilas de todos los hilos (menos el actual) cada 'intervalo' segundos y
+    retorna un dict pila_colapsada -> muestras
+    """
+    propio = threading.get_ident()
+    conteo = {}
+    limite = time.monotonic() + segundos
+    while time.monotonic() < limite:
+        for hilo, frame in sys._current_frames().items():
+            if hilo == propio:
+                continue
+            pila = []
+            while frame is not None:
+                codigo = frame.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+                frame = frame.f_back
+            clave = ";".join(reversed(pila))
+            conteo[clave] = conteo.get(clave, 0) + 1
+        time.sleep(intervalo)
+    return conteo
+
+@app.route("/admin/profile", methods=["GET"])
+def admin_perfiles():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify([{k: v for k, v in p.items() if k != "stats"} for p in PERFILES]), 200
+
+@app.route("/admin/profile/<perfil_id>", methods=["GET"])
+def admin_perfil(perfil_id):
+    """
+    format=text (default) imprime pstats ordenado por 'sort' (ej: cumulative o tottime,calls) con
+    'limit' funciones; format=pstats descarga el binario compatible con pstats.Stats / snakeviz
+    """
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    encontrado = next((p for p in PERFILES if p["id"] == perfil_id), None)
+    if not encontrado:
+        return jsonify({"error": "perfil no encontrado"}), 404
+
+    if request.args.get("format") == "pstats":
+        return app.response_class(
+            marshal.dumps(encontrado["stats"]),
+            mimetype="application/octet-stream",
+            headers={"Content-Disposition": f"attachment; filename=perfil_{perfil_id}.pstats"}
+        )
+
+    orden = [clave.strip() for clave in request.args.get("sort", "cumulative").split(",") if clave.strip()]
+    invalidas = [clave for clave in orden if clave not in pstats.Stats.sort_arg_dict_default]
+    if not orden or invalidas:
+        return jsonify({
+            "error": "sort invalido",
+            "details": invalidas,
+            "validos": sorted(pstats.Stats.sort_arg_dict_default)
+        }), 400
+    try:
+        limite = int(request.args.get("limit", 40))
+    except ValueError:
+        limite = 0
+    if limite < 1:
+        return jsonify({"error": "limit debe ser un entero mayor que 0"}), 400
+
+    salida = io.StringIO()
+    stats = pstats.Stats(_PerfilGuardado(encontrado["stats"]), stream=salida)
+    stats.sort_stats(*orden).print_stats(limite)
+    return app.response_class(salida.getvalue(), mimetype="text/plain")
+
+@app.route("/admin/profile/sample", methods=["GET", "POST"])
+def admin_muestreo():
+    """
+    Muestrea las pilas de todos los hilos por N segundos y responde en formato collapsed-stack
+    """
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    try:
+        segundos = min(float(request.args.get("seconds", 10)), PROFILE_MAX_SAMPLE_SECONDS)
+        intervalo = max(float(request.args.get("interval_ms", 10)), 1) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds e interval_ms deben ser numericos"}), 400
+
+    if not _MUESTREO_LOCK.acquire(blocking=False):
+        return jsonify({"error": "ya hay un muestreo en curso"}), 409
+    try:
+        logging.info(f"perfil: Muestreando pilas por {segundos}s cada {intervalo * 1000}ms")
+        conteo = muestrear_pilas(segundos, intervalo)
+    finally:
+        _MUESTREO_LOCK.release()
+
+    lineas = [f"{pila} {n}" for pila, n in sorted(conteo.items(), key=lambda item: -item[1])]
+    return app.response_class("\n".join(lineas) + "\n", mimetype="text/plain")
+
 #________________________________________________________________________________________
 """
 Función para redirigir al usuario a la URL de autorización de Zoho, 
@@ -75,22 +661,23 @@ def oauth_callback():
     if not code:
         return "No se recibió 'code' en la URL.", 400
 
-    if not (ZOHO_CLIENT_ID and ZOHO_CLIENT_SECRET):
+    portal = portal_actual()
+    if not (portal.client_id and portal.client_secret):
         return "Faltan ZOHO_CLIENT_ID o ZOHO_CLIENT_SECRET en variables de entorno.", 500
 
     REDIRECT_URI = "https://api-middleware-zoho-gleamcarecol.onrender.com/oauth2callback"
 
     # Intercambia el authorization code por tokens
-    token_url = "https://accounts.zoho.com/oauth/v2/token"
+    token_url = f"{portal.accounts_url}/oauth/v2/token"
     params = {
         "code": code,
-        "client_id": ZOHO_CLIENT_ID,
-        "client_secret": ZOHO_CLIENT_SECRET,
+        "client_id": portal.client_id,
+        "client_secret": portal.client_secret,
         "redirect_uri": REDIRECT_URI, #request.base_url,  # debe ser exactamente lo registrado
         "grant_type": "authorization_code"
     }
     try:
-        r = requests.post(token_url, params=params, timeout=10)
+        r = HTTP.post(token_url, params=params, timeout=10)
         data = r.json()
         logging.info(f"oauth2callback: token exchange -> {data}")
 
@@ -104,58 +691,98 @@ def oauth_callback():
 
 #Generación de Token provisional    
 
+def _leer_token_compartido():
+    """
+    Lee el access_token que otro worker/instancia dejo en ESTADO y lo copia a la cache local del portal
+    """
+    portal = portal_actual()
+    try:
+        valor = ESTADO.get(portal.clave("zoho:token"))
+    except Exception as e:
+        logging.error(f"get_access_token: Error leyendo el token del estado compartido -> {e}")
+        return None
+    if not valor:
+        return None
+
+    data = json.loads(valor)
+    portal.token = data["access_token"]
+    portal.token_expira = datetime.fromtimestamp(data["expira"])
+    return portal.token
+
+@medir_span("token")
 def get_access_token():
     """
     Obtiene un nuevo access_token de Zoho utilizando el refresh_token.
     cada vez que se establece una comunicación, es necesario refrescarlo.
+    El token se comparte en ESTADO y el refresco se hace con candado, asi solo un
+    worker/instancia le pide token a Zoho. Cada portal tiene su propio token.
     """
-    global CACHED_ACCESS_TOKEN, TOKEN_EXPIRATION_TIME
+    portal = portal_actual()
 
-    if CACHED_ACCESS_TOKEN and TOKEN_EXPIRATION_TIME and datetime.now() < TOKEN_EXPIRATION_TIME - timedelta(seconds=30):
+    if portal.token and portal.token_expira and datetime.now() < portal.token_expira - timedelta(seconds=30):
         logging.info(f"get_access_token: access_token, sigue siendo valido...")
-        return CACHED_ACCESS_TOKEN
+        return portal.token
+
+    if _leer_token_compartido():
+        logging.info(f"get_access_token: access_token tomado del estado compartido...")
+        return portal.token
     
     logging.info(f"get_access_token: El access_token no es valido o a expirado. Solicitando uno nuevo a zoho...")
 
-    if not (ZOHO_REFRESH_TOKEN and ZOHO_CLIENT_ID and ZOHO_CLIENT_SECRET):
-        logging.error("get_access_token: Faltan credenciales críticas (REFRESH_TOKEN, CLIENT_ID, o CLIENT_SECRET).")
+    if not (portal.refresh_token and portal.client_id and portal.client_secret):
+        logging.error(f"get_access_token: Faltan credenciales críticas (REFRESH_TOKEN, CLIENT_ID, o CLIENT_SECRET) del portal {portal.id}.")
         return None
     
-    url = "https://accounts.zoho.com/oauth/v2/token"
+    url = f"{portal.accounts_url}/oauth/v2/token"
     params = {
-        "refresh_token": ZOHO_REFRESH_TOKEN,
-        "client_id": ZOHO_CLIENT_ID,
-        "client_secret": ZOHO_CLIENT_SECRET,
+        "refresh_token": portal.refresh_token,
+        "client_id": portal.client_id,
+        "client_secret": portal.client_secret,
         "grant_type": "refresh_token"
     }
 
-    try:
-        logging.info(f"get_access_token: Solicitando un nuevo access_token a Zoho...")
-        response = requests.post(url, params=params, timeout=10)
-        response.raise_for_status()  # Verificar si hubo errores HTTP
-        
-        data = response.json()
-        new_access_token = data.get("access_token")
-
-        if new_access_token:
-            #calculando la expiracion del token
-            expiracion_en_segundos = data.get("expires_in",3600)
+    with candado_estado(portal.clave("zoho:token:refresh"), ttl=20, espera=12):
+        # otro worker pudo refrescarlo mientras se esperaba el candado
+        if _leer_token_compartido():
+            logging.info(f"get_access_token: access_token refrescado por otro worker...")
+            return portal.token
 
-            CACHED_ACCESS_TOKEN = new_access_token
-            TOKEN_EXPIRATION_TIME = datetime.now() + timedelta(seconds=expiracion_en_segundos)
+        try:
+            logging.info(f"get_access_token: Solicitando un nuevo access_token a Zoho...")
+            response = HTTP.post(url, params=params, timeout=10)
+            response.raise_for_status()  # Verificar si hubo errores HTTP
             
-            logging.info(f"get_access_token: Nuevo access_token obtenido exitosamente.")
-            return CACHED_ACCESS_TOKEN
-        else:
-            logging.error(f"get_access_token: La respuesta de Zoho no incluyó un access_token. Respuesta: {data}")
+            data = response.json()
+            new_access_token = data.get("access_token")
+
+            if new_access_token:
+                #calculando la expiracion del token
+                expiracion_en_segundos = data.get("expires_in",3600)
+
+                portal.token = new_access_token
+                portal.token_expira = datetime.now() + timedelta(seconds=expiracion_en_segundos)
+
+                try:
+                    ESTADO.set(
+                        portal.clave("zoho:token"),
+                        json.dumps({"access_token": new_access_token, "expira": portal.token_expira.timestamp()}),
+                        ttl=max(expiracion_en_segundos - 30, 1)
+                    )
+                except Exception as e:
+                    logging.error(f"get_access_token: No se pudo guardar el token en el estado compartido -> {e}")
+                
+                logging.info(f"get_access_token: Nuevo access_token obtenido exitosamente.")
+                return portal.token
+            else:
+                logging.error(f"get_access_token: La respuesta de Zoho no incluyó un access_token. Respuesta: {data}")
+                return None
+                
+        except requests.exceptions.HTTPError as http_err:
+            logging.error(f"get_access_token: Error HTTP al refrescar token. Status: {http_err.response.status_code}, Body: {http_err.response.text}")
+            return None
+        except Exception as e:
+            logging.error(f"get_access_token: Ocurrió una excepción inesperada -> {e}")
             return None
-            
-    except requests.exceptions.HTTPError as http_err:
-        logging.error(f"get_access_token: Error HTTP al refrescar token. Status: {http_err.response.status_code}, Body: {http_err.response.text}")
-        return None
-    except Exception as e:
-        logging.error(f"get_access_token: Ocurrió una excepción inesperada -> {e}")
-        return None
     
 #________________________________________________________________________________________
 #________________________________________________________________________________________
@@ -163,6 +790,7 @@ def get_access_token():
 #________________________________________________________________________________________
 #________________________________________________________________________________________
 
+@medir_span("create")
 def create_or_update_visitor(visitor_id, nombre_completo, telefono, nombre=None, apellido=None, email=None, custom_fields=None):
     """
     Crea o actualiza visitante en Zoho SalesIQ v2
@@ -197,16 +825,16 @@ def create_or_update_visitor(visitor_id, nombre_completo, telefono, nombre=None,
         payload["custom_fields"] = custom_fields
 
 
-    create_url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/visitors"
+    create_url = f"{portal_actual().api_base}/visitors"
     
     # Ahora SÍ incluir 'id' en el payload
     payload["id"] = str(visitor_id)
     
     logging.info(f"create_or_update_visitor: Creando nuevo visitante POST {create_url}")
-    logging.info(f"Payload: {json.dumps(payload, indent=2)}")
+    logging.info(f"Payload: {resumen_log(payload)}")
     
     try:
-        r_create = requests.post(create_url, headers=headers, json=payload, timeout=10)
+        r_create = HTTP.post(create_url, headers=headers, json=payload, timeout=10)
         logging.info(f"POST respuesta: status={r_create.status_code}, body={r_create.text[:300]}")
         
         if r_create.status_code in [200, 201]:
@@ -221,6 +849,7 @@ def create_or_update_visitor(visitor_id, nombre_completo, telefono, nombre=None,
         return {"error": str(e)}, 500
 
 
+@medir_span("search")
 def busca_conversacion(phone):
     """
     Busca una conversación abierta en Zoho SalesIQ para un número de teléfono.
@@ -230,15 +859,16 @@ def busca_conversacion(phone):
         logging.error("busca_conversacion: No se pudo obtener un access_token válido. Abortando búsqueda.")
         return None
 
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations"
+    url = f"{portal_actual().api_base}/conversations"
     headers = {
         "Authorization": f"Zoho-oauthtoken {access_token}",
         "Content-Type": "application/json"
     }
+    clave_telefono = limpiar_telefono(phone)
     
     try:
         logging.info(f"busca_conversacion:Buscando conversación abierta para el teléfono: {phone}")
-        response = requests.get(url, headers=headers, timeout=10)
+        response = HTTP.get(url, headers=headers, timeout=10)
         
         response.raise_for_status()  # Verificar si hubo errores HTTP
         response_data = response.json()
@@ -278,7 +908,7 @@ def busca_conversacion(phone):
                     logging.info(f"busca_conversacion: state................{state}")
                     logging.info(f"busca_conversacion: is_bot_conversation................{is_bot_conversation}")
 
-                    if (visitor_phone == phone and
+                    if (limpiar_telefono(visitor_phone) == clave_telefono and
                         status_key == "open" and
                         state in (1,2) and
                         is_bot_conversation):
@@ -304,6 +934,7 @@ def busca_conversacion(phone):
         logging.error(f"busca_conversacion: Ocurrió un error inesperado -> {e}")    
         return None
     
+@medir_span("send")
 def envio_mesaje_a_conversacion(conversation_id,mensaje):
     """
     Envía el mensaj a una conversacion de zoho sales IQ existente
@@ -339,7 +970,7 @@ def envio_mesaje_a_conversacion(conversation_id,mensaje):
 
     access_token = get_access_token()
 
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations/{conversation_id}/messages"
+    url = f"{portal_actual().api_base}/conversations/{conversation_id}/messages"
     headers = {"Authorization": f"Zoho-oauthtoken {access_token}", 
                "Content-Type": "application/json"}
 
@@ -348,7 +979,7 @@ def envio_mesaje_a_conversacion(conversation_id,mensaje):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = HTTP.post(url, headers=headers, json=payload, timeout=10)
         #revision si hay un error de HTTP
         response.raise_for_status()  # Verificar si hubo errores HTTP
         logging.info(f"envio_mesaje_a_conversacion: Enviando mensaje a la conversación: {conversation_id}")
@@ -373,21 +1004,36 @@ def envio_mesaje_a_conversacion(conversation_id,mensaje):
 #________________________________________________________________________________________
 #________________________________________________________________________________________
 
-def limpiar_telefono(telefono):
-    # Implementación arriba
+@functools.lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _normalizar_telefono(telefono):
+    """
+    Convierte el telefono a E.164 (+<pais><numero>). Memoizado: el mismo numero llega en
+    cada mensaje y en cada fila de visitantes/conversaciones de Zoho
+    """
+    telefono = telefono.strip()
+    internacional = telefono.startswith("+") or telefono.startswith("00")
+    digitos = "".join(c for c in telefono if c.isdigit())
+    if telefono.startswith("00"):
+        digitos = digitos[2:]
+    if not internacional:
+        # se quita el 0 de troncal si lo trae
+        digitos = digitos.lstrip("0")
+    if not digitos:
+        return ""
 
+    if internacional or len(digitos) > PHONE_NATIONAL_LENGTH:
+        # ya trae indicativo de pais (WhatsApp envia 573001234567)
+        return "+" + digitos
+    return "+" + PHONE_DEFAULT_COUNTRY_CODE + digitos
+
+def limpiar_telefono(telefono):
     """
-    Limpia y estandariza el formato del teléfono
+    Limpia y estandariza el formato del teléfono (E.164), es la clave canonica para comparar
+    telefonos y para el estado local. A Zoho y a App A se les sigue enviando el telefono original.
     """
     if not telefono:
         return ""
-    
-    telefono_limpio = str(telefono).strip().replace(' ','').replace('-','').replace('(','').replace(')','')
-
-    if telefono_limpio.startswith('+'):
-        telefono_limpio = '+' + telefono_limpio
-    
-    return telefono_limpio
+    return _normalizar_telefono(str(telefono))
 
 # FUNCIONES DE VISITANTES
 def obtener_o_crear_visitante(telefono):
@@ -411,6 +1057,7 @@ def obtener_o_crear_visitante(telefono):
 
     return visitor_id
 
+@medir_span("search")
 def buscar_visitante_por_telefono(telefono):
     # Implementación arriba
     """
@@ -427,7 +1074,7 @@ def buscar_visitante_por_telefono(telefono):
     telefono_limpio = limpiar_telefono(telefono)
 
     # URL para listar visitante
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/visitors"
+    url = f"{portal_actual().api_base}/visitors"
 
     headers = {
         "Authorization": f"Zoho-oauthtoken {access_token}",
@@ -435,7 +1082,7 @@ def buscar_visitante_por_telefono(telefono):
     }
     
     try:
-        response = requests.get(url, headers=headers)
+        response = HTTP.get(url, headers=headers, timeout=10)
         logging.info(f"buscar_visitante_por_telefono: URL: {url}")
         logging.info(f"buscar_visitante_por_telefono: response... {response.status_code}")
         logging.info(f"buscar_visitante_por_telefono: response text... {response.text}")
@@ -457,7 +1104,7 @@ def buscar_visitante_por_telefono(telefono):
                 logging.info(f"buscar_visitante_por_telefono: CONTROL...phone_limpio...:{phone_limpio}")
 
                 if phone_limpio == telefono_limpio:
-                    visitor_id = visitante.id('id')
+                    visitor_id = visitante.get('id')
                     logging.info(f"buscar_visitante_por_telefono: Visitante encontrado_ ID= {visitor_id}, telefono= {phone_visitante}")
                     return visitor_id
             return None        
@@ -475,6 +1122,7 @@ def buscar_visitante_por_telefono(telefono):
         logging.error(f"buscar_visitante_por_telefono: Error de conexión (Timeout, DNS, etc): {req_err}")
         return None
 
+@medir_span("create")
 def crear_visitante(telefono):
     # Implementación arriba
     """
@@ -490,7 +1138,7 @@ def crear_visitante(telefono):
     telefono_limpio = limpiar_telefono(telefono)
 
     # URL para listar visitante
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/visitors"
+    url = f"{portal_actual().api_base}/visitors"
 
     payload = {
         "name": f"Visitante {telefono_limpio}",
@@ -508,7 +1156,7 @@ def crear_visitante(telefono):
     }
     
     try:
-        response = requests.get(url, headers=headers, json=payload)
+        response = HTTP.get(url, headers=headers, json=payload, timeout=10)
         
         if response.status_code in [200, 201]:
             data = response.json()
@@ -525,23 +1173,30 @@ def crear_visitante(telefono):
 
 # FUNCIONES DE CONVERSACIONES
 #def buscar_conversacion_abierta_por_visitor(visitor_id):
-def buscar_conversacion_abierta_por_visitor(telefono):
+@medir_span("search")
+def buscar_conversacion_abierta_por_visitor(telefono, clave_telefono=None, refrescar=False):
     # Implementación arriba
     """
     Busca conversaciones abiertas para un visitor_id especifico
     Retona la conversación si existe, None si no
+    clave_telefono: telefono ya normalizado (limpiar_telefono) si quien llama ya lo calculo
+    refrescar: no usar la respuesta guardada en la cache de lecturas
     """
+    clave_telefono = clave_telefono or limpiar_telefono(telefono)
     access_token = get_access_token()
 
     logging.info(f"buscar_conversacion_abierta_por_visitor: Buscando conversación abierta para visitor_id: {telefono}")
 
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations"
+    url = f"{portal_actual().api_base}/conversations"
 
     headers = {
         "Authorization": f"Zoho-oauthtoken {access_token}",
         "Content-Type": "application/json"
     }
 
+    if refrescar:
+        headers["Cache-Control"] = "no-cache"
+
     params = {
         "phone": telefono,
         "status": "open"
@@ -549,7 +1204,7 @@ def buscar_conversacion_abierta_por_visitor(telefono):
 
     try:
         #response = requests.get(url, headers=headers)
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = HTTP.get(url, headers=headers, params=params, timeout=10)
 
         if response.status_code == 200:
             response.raise_for_status()  # Verificar si hubo errores HTTP
@@ -567,13 +1222,13 @@ def buscar_conversacion_abierta_por_visitor(telefono):
                 #verificar que sea del mismo visitante y esté abierta
                 #if conv_visitor_id == visitor_id and status_key =='open':
                 logging.info(f"buscar_conversacion_abierta_por_visitor: Numero de telefono del visitante: {conv_phone}")
-                if conv_phone == telefono:
+                if limpiar_telefono(conv_phone) == clave_telefono:
                     #chat_id = conv.get('chat_id')
                     logging.info(f"buscar_conversacion_abierta_por_visitor: Conversación abierta encontrada: {conv_id}, para el visitor: {conv_visitor_id}")
                     return conv_id
             
             #logging.info(f"buscar_conversacion_abierta_por_visitor: No hay conversaciones abierta para el visitor_id {visitor_id}")
-            logging.info(f"buscar_conversacion_abierta_por_visitor: No hay conversaciones abierta para el visitor_id {conv_visitor_id}")
+            logging.info(f"buscar_conversacion_abierta_por_visitor: No hay conversaciones abierta para el telefono {telefono}")
             return None
         
         else:
@@ -590,6 +1245,7 @@ def buscar_conversacion_abierta_por_visitor(telefono):
         logging.error(f"buscar_conversacion_abierta_por_visitor: Excepción al buscar convarsación: {str(e)}")    
         return None
 
+@medir_span("create")
 def crear_conversacion_con_visitante(visitor_id, telefono, mensaje_inicial):
     # Implementación arriba
     """
@@ -598,12 +1254,12 @@ def crear_conversacion_con_visitante(visitor_id, telefono, mensaje_inicial):
     access_token = get_access_token()
     logging.info(f"crear_conversacion_con_visitante: Creando conversación para el visitor_id: {visitor_id}")
 
-    url = f"https://salesiq.zoho.com/visitor/v2/{ZOHO_PORTAL_NAME}/conversations"
+    url = f"{portal_actual().visitor_api_base}/conversations"
 
     payload = {
         "visitor": {"user_id": visitor_id, "phone": telefono},
-        "app_id": SALESIQ_APP_ID,
-        "department_id": SALESIQ_DEPARTMENT_ID,
+        "app_id": portal_actual().app_id,
+        "department_id": portal_actual().department_id,
         "question": mensaje_inicial #,"auto_assign": True
         }
 
@@ -613,7 +1269,7 @@ def crear_conversacion_con_visitante(visitor_id, telefono, mensaje_inicial):
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = HTTP.post(url, headers=headers, json=payload, timeout=10)
 
         logging.info(f"crear_conversacion_con_visitante: Respuesta crear conversación: {response.status_code}")
 
@@ -648,44 +1304,50 @@ def crear_conversacion_con_visitante(visitor_id, telefono, mensaje_inicial):
         logging.error(f"crear_conversacion_con_visitante: Excepción al buscar convarsación: {str(e)}")    
         return {"error": str(e)}
 
+def creacion_exitosa(resultado):
+    """
+    crear_conversacion_con_visitante retorna None o {"error": ...} cuando falla
+    """
+    return isinstance(resultado, dict) and "error" not in resultado
+
+# id del boton de WhatsApp -> texto que ve el agente en Zoho
+BOTONES = {
+    "btn_si1": "Si",
+    "btn_no1": "No",
+    "btn_1": "🌟Micropigmen. Ceja",
+    "btn_2": "✨Retoque Cejas",
+    "btn_3": "💋Micropigmen. Labios",
+    "btn_4": "✨Retoque Labios",
+    "btn_5": "⭐Laminado Cejas",
+    "btn_6": "💕Lifting Pestañas",
+    "btn_7": "💞Extensión Pestañas",
+    "btn_8": "💫Diseño Cejas con henna",
+    "btn_9": "🌸Depilación Corporal",
+    "btn_10": "🪷Depilación Facial",
+    "btn_0": "📞Hablar con una experta"
+}
+
+def formatear_boton(mensaje):
+    """
+    Traduce el id de un boton de WhatsApp (btn_*) al texto que ve el agente en Zoho.
+    Solo cuando el mensaje del usuario es exactamente el id (btn_1 no toma a btn_10 y
+    no se tocan las lineas del bot que mencionen un boton). Aplicarlo dos veces no cambia nada.
+    """
+    texto = mensaje.strip()
+    if texto.startswith("[👤 Usuario]:"):
+        texto = texto[len("[👤 Usuario]:"):].strip()
+    etiqueta = BOTONES.get(texto)
+    return f"[👤 Usuario]: {etiqueta}" if etiqueta else mensaje
+
 #def enviar_mensaje_a_conversacion(chat_id, mensaje):
+@medir_span("send")
 def enviar_mensaje_a_conversacion(conversacion_abierta, mensaje):
 
     # Implementación arriba
     """
-    Envía un mensaje a una conversación existente
+    Envía un mensaje a una conversación existente, el mensaje ya llega formateado (formatear_boton)
     """
 
-    if "btn_si1" in mensaje:
-        mensaje = "[👤 Usuario]: Si"
-    elif "btn_no1" in mensaje:
-        mensaje = "[👤 Usuario]: No"
-    elif "btn_1" in mensaje:
-        mensaje = "[👤 Usuario]: 🌟Micropigmen. Ceja"
-    elif "btn_2" in mensaje:
-        mensaje = "[👤 Usuario]: ✨Retoque Cejas"
-    elif "btn_3" in mensaje:
-        mensaje = "[👤 Usuario]: 💋Micropigmen. Labios"
-    elif "btn_4" in mensaje:
-        mensaje = "[👤 Usuario]: ✨Retoque Labios"
-    elif "btn_5" in mensaje:
-        mensaje = "[👤 Usuario]: ⭐Laminado Cejas"
-    elif "btn_6" in mensaje:
-        mensaje = "[👤 Usuario]: 💕Lifting Pestañas"
-    elif "btn_7" in mensaje:
-        mensaje = "[👤 Usuario]: 💞Extensión Pestañas"
-    elif "btn_8" in mensaje:
-        mensaje = "[👤 Usuario]: 💫Diseño Cejas con henna"
-    elif "btn_9" in mensaje:
-        mensaje = "[👤 Usuario]: 🌸Depilación Corporal"
-    elif "btn_10" in mensaje:
-        mensaje = "[👤 Usuario]: 🪷Depilación Facial"
-    elif "btn_0" in mensaje:
-        mensaje = "[👤 Usuario]: 📞Hablar con una experta"
-    else:
-        mensaje
-            
-
     access_token = get_access_token()
     """
     if not access_token:
@@ -696,8 +1358,8 @@ def enviar_mensaje_a_conversacion(conversacion_abierta, mensaje):
     #logging.info(f"enviar_mensaje_a_conversacion: Enviando mensaje a conversación: {chat_id}")
     logging.info(f"enviar_mensaje_a_conversacion: Enviando mensaje a conversación: {conversacion_abierta}")
 
-    #url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations/{chat_id}/message"
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations/{conversacion_abierta}/messages"
+    #url = f"{portal_actual().api_base}/conversations/{chat_id}/message"
+    url = f"{portal_actual().api_base}/conversations/{conversacion_abierta}/messages"
         
     headers = {
         'Authorization': f'Zoho-oauthtoken {access_token}',
@@ -709,7 +1371,7 @@ def enviar_mensaje_a_conversacion(conversacion_abierta, mensaje):
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = HTTP.post(url, headers=headers, json=payload, timeout=10)
         response.raise_for_status()  # Verificar si hubo errores HTTP
         
         """
@@ -738,6 +1400,7 @@ def enviar_mensaje_a_conversacion(conversacion_abierta, mensaje):
 #________________________________________________________________________________________
 #Funciones Principales 
 #________________________________________________________________________________________
+@medir_span("send")
 def asignar_tag_a_conversacion(conversation_id, tag_id):
     """
     Asigna un tag a una conversación existente en Zoho
@@ -751,24 +1414,1360 @@ def asignar_tag_a_conversacion(conversation_id, tag_id):
         "Content-Type": "application/json"
     }
     
-    url = f"{ZOHO_SALESIQ_BASE}/{ZOHO_PORTAL_NAME}/conversations/{conversation_id}/tags"
+    url = f"{portal_actual().api_base}/conversations/{conversation_id}/tags"
     
     payload = {
         "tag_ids": [tag_id] if isinstance(tag_id, str) else tag_id
     }
     
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=10)
+        r = HTTP.post(url, headers=headers, json=payload, timeout=10)
         logging.info(f"Tag asignado: {r.status_code} - {r.text}")
         return r.json() if r.text else {"success": True}, r.status_code
     except Exception as e:
         logging.error(f"Error asignando tag: {e}")
         return {"error": str(e)}, 500
 #________________________________________________________________________________________
+#Modo diferido de conversaciones (ZOHO_LAZY_CONVERSATIONS)
+#________________________________________________________________________________________
+"""
+Mientras el usuario solo habla con el bot no se crea nada en Zoho: los mensajes se guardan
+por telefono y cuando el usuario escala (ej: btn_0 "Hablar con una experta") se crea la
+conversación y se envia toda la transcripción en un solo mensaje.
+"""
+
+def es_escalacion(mensaje, tag_name):
+    """
+    Indica si el mensaje del usuario debe abrir la conversación en Zoho
+    """
+    if tag_name == "respuesta_bot":
+        return False
+    # igual que formatear_boton: solo cuando el mensaje es exactamente el trigger (btn_0 no toma a btn_01)
+    texto = mensaje.strip()
+    if texto.startswith("[👤 Usuario]:"):
+        texto = texto[len("[👤 Usuario]:"):].strip()
+    return texto in ZOHO_LAZY_TRIGGERS
+
+def _actualizar_buffer(telefono, cambio):
+    """
+    Aplica 'cambio' (lista -> lista) al buffer del telefono en ESTADO con compare-and-set,
+    reintentando si otro worker lo modifico al mismo tiempo. Retorna la lista resultante.
+    """
+    clave = portal_actual().clave(f"lazy:buf:{telefono}")
+    while True:
+        actual = ESTADO.get(clave)
+        mensajes = cambio(json.loads(actual) if actual else [])
+        if not mensajes:
+            if actual is None or ESTADO.cas_borrar(clave, actual):
+                return mensajes
+        elif ESTADO.cas(clave, actual, json.dumps(mensajes), ttl=ZOHO_LAZY_TTL):
+            return mensajes
+
+def guardar_en_buffer(telefono, mensaje_formateado):
+    """
+    Guarda el mensaje en el buffer del telefono, retorna la cantidad de mensajes guardados
+    """
+    # se conservan solo los ultimos mensajes para no crecer sin limite
+    mensajes = _actualizar_buffer(telefono, lambda m: (m + [mensaje_formateado])[-ZOHO_LAZY_MAX_BUFFER:])
+    return len(mensajes)
+
+def leer_transcripcion(telefono):
+    """
+    Retorna los mensajes guardados para el telefono (sin borrarlos)
+    """
+    valor = ESTADO.get(portal_actual().clave(f"lazy:buf:{telefono}"))
+    return json.loads(valor) if valor else []
+
+def descartar_transcripcion(telefono, cantidad):
+    """
+    Borra los primeros 'cantidad' mensajes del buffer, una vez enviados a Zoho
+    """
+    if cantidad:
+        _actualizar_buffer(telefono, lambda m: m[cantidad:])
+
+def marcar_materializada(telefono):
+    """
+    Registra que el telefono ya tiene conversación en Zoho, los siguientes mensajes se envian directo
+    """
+    ESTADO.set(portal_actual().clave(f"lazy:conv:{telefono}"), "1", ttl=ZOHO_LAZY_TTL)
+
+def esta_materializada(telefono):
+    return ESTADO.get(portal_actual().clave(f"lazy:conv:{telefono}")) is not None
+
+def olvidar_materializada(telefono):
+    """
+    La conversación del telefono se cerro en Zoho: los mensajes vuelven al buffer hasta la proxima escalación
+    """
+    ESTADO.delete(portal_actual().clave(f"lazy:conv:{telefono}"))
+
+def diferir_mensaje(telefono, clave_telefono, mensaje_formateado):
+    """
+    Guarda el mensaje en el buffer del telefono y arma la respuesta de from-waba
+    """
+    total = guardar_en_buffer(clave_telefono, mensaje_formateado)
+    ESTADISTICAS.contar("mensajes_diferidos")
+    logging.info(f"from-waba: Modo diferido, mensaje guardado localmente ({total} en buffer) para: {telefono}")
+    return jsonify({
+        "success": True,
+        "phone": telefono,
+        "action": "buffered",
+        "buffered_messages": total
+    }), 200
+
+#________________________________________________________________________________________
+#Mapa local telefono -> conversación y reconciliador
+#________________________________________________________________________________________
+"""
+El mapa telefono (E.164) -> conversación abierta vive en ESTADO (conv:<telefono>). from_waba lo consulta
+antes de listar conversaciones en Zoho. Un hilo de fondo (RECONCILE_INTERVAL) trae solo las
+conversaciones modificadas desde el ultimo cursor, paginando, y actualiza el mapa. Cada
+RECONCILE_FULL_SCAN_EVERY ciclos se hace un escaneo completo. Con varios portales cada uno
+tiene su cursor y sus metricas (Portal.metricas_reconciliador).
+"""
+METRICAS_RECONCILIADOR_INICIALES = {
+    "ciclos": 0,
+    "ultima_ejecucion": None,
+    "duracion_ms": None,
+    "paginas": 0,
+    "conversaciones": 0,
+    "abiertas": 0,
+    "cerradas": 0,
+    "sin_estado": 0,
+    "escaneo_completo": False,
+    "truncado": False,
+    "lag_segundos": None,
+    "errores": 0,
+    "ultimo_error": None
+}
+_RECONCILIADOR_INICIADO = False
+_RECONCILIADOR_LOCK = threading.Lock()
+
+def conversacion_local(telefono):
+    try:
+        return ESTADO.get(portal_actual().clave(f"conv:{telefono}"))
+    except Exception as e:
+        logging.error(f"conversacion_local: Error leyendo el estado compartido -> {e}")
+        return None
+
+def guardar_conversacion_local(telefono, conversation_id):
+    if not (telefono and conversation_id):
+        return
+    try:
+        ESTADO.set(portal_actual().clave(f"conv:{telefono}"), str(conversation_id), ttl=CONVERSATION_MAP_TTL)
+    except Exception as e:
+        logging.error(f"guardar_conversacion_local: Error escribiendo el estado compartido -> {e}")
+
+def olvidar_conversacion_local(telefono, conversation_id=None):
+    clave = portal_actual().clave(f"conv:{telefono}")
+    try:
+        if conversation_id is None:
+            ESTADO.delete(clave)
+            cerrada = True
+        else:
+            # si el mapa ya apunta a otra conversación (abierta despues) el telefono sigue materializado
+            cerrada = ESTADO.cas_borrar(clave, str(conversation_id)) or ESTADO.get(clave) is None
+        if cerrada and ZOHO_LAZY_CONVERSATIONS:
+            olvidar_materializada(telefono)
+    except Exception as e:
+        logging.error(f"olvidar_conversacion_local: Error escribiendo el estado compartido -> {e}")
+
+def _tiempo_modificacion(conv):
+    """
+    Tiempo de ultima modificación de la conversación en ms (Zoho lo entrega como str o int)
+    """
+    for campo in ("last_modified_time", "modified_time", "last_message_time", "start_time"):
+        valor = conv.get(campo)
+        if valor:
+            try:
+                return int(valor)
+            except (TypeError, ValueError):
+                continue
+    return 0
+
+def _aplicar_conversacion(conv):
+    """
+    Aplica una conversación de Zoho al mapa local, retorna True si quedo abierta, False si se
+    cerro y None si no se puede saber (sin id, telefono o estado): en ese caso no se toca el mapa
+    """
+    conversation_id = conv.get("id")
+    telefono = limpiar_telefono((conv.get("visitor") or {}).get("phone"))
+    chat_status = conv.get("chat_status") or {}
+    status_key = chat_status.get("status_key")
+    state = chat_status.get("state")
+    if not (conversation_id and telefono) or (status_key is None and state is None):
+        return None
+
+    abierta = status_key in (None, "open") and state in (None, 1, 2)
+    if abierta:
+        guardar_conversacion_local(telefono, conversation_id)
+    else:
+        olvidar_conversacion_local(telefono, conversation_id)
+    return abierta
+
+def reconciliar_conversaciones(completo=False):
+    """
+    Trae de Zoho las conversaciones modificadas desde el cursor y actualiza el mapa local
+    """
+    inicio = time.perf_counter()
+    access_token = get_access_token()
+    if not access_token:
+        raise RuntimeError("no se obtuvo access_token valido")
+
+    cursor = 0 if completo else int(ESTADO.get(portal_actual().clave("reconciler:cursor")) or 0)
+    nuevo_cursor = cursor
+    max_paginas = RECONCILE_FULL_SCAN_MAX_PAGES if completo else RECONCILE_MAX_PAGES
+    url = f"{portal_actual().api_base}/conversations"
+    headers = {
+        "Authorization": f"Zoho-oauthtoken {access_token}",
+        "Content-Type": "application/json"
+    }
+    paginas = total = abiertas = cerradas = sin_estado = 0
+    truncado = True
+
+    for pagina in range(max_paginas):
+        params = {
+            "limit": RECONCILE_PAGE_SIZE,
+            "from_index": pagina * RECONCILE_PAGE_SIZE,
+            "sort_by": "last_modified_time",
+            "sort_order": "asc"
+        }
+        if cursor:
+            params["modified_after"] = cursor
+
+        with span("reconcile_page"):
+            response = HTTP.get(url, headers=headers, params=params, timeout=10)
+        response.raise_for_status()
+        lista = response.json().get("data", []) or []
+        paginas += 1
+
+        for conv in lista:
+            modificada = _tiempo_modificacion(conv)
+            # por si la API ignora modified_after, se filtra tambien aqui
+            if cursor and modificada and modificada <= cursor:
+                continue
+            total += 1
+            abierta = _aplicar_conversacion(conv)
+            if abierta is None:
+                sin_estado += 1
+            elif abierta:
+                abiertas += 1
+            else:
+                cerradas += 1
+            nuevo_cursor = max(nuevo_cursor, modificada)
+
+        if len(lista) < RECONCILE_PAGE_SIZE:
+            truncado = False
+            break
+
+    if nuevo_cursor:
+        ESTADO.set(portal_actual().clave("reconciler:cursor"), str(nuevo_cursor))
+
+    portal_actual().metricas_reconciliador.update({
+        "ultima_ejecucion": datetime.now().isoformat(),
+        "duracion_ms": round((time.perf_counter() - inicio) * 1000, 2),
+        "paginas": paginas,
+        "conversaciones": total,
+        "abiertas": abiertas,
+        "cerradas": cerradas,
+        "sin_estado": sin_estado,
+        "escaneo_completo": completo,
+        "truncado": truncado,
+        "lag_segundos": round(time.time() - nuevo_cursor / 1000, 1) if nuevo_cursor else None
+    })
+    logging.info(
+        f"reconciliar_conversaciones: completo={completo}, paginas={paginas}, conversaciones={total}, "
+        f"abiertas={abiertas}, cerradas={cerradas}, sin_estado={sin_estado}, truncado={truncado}, lag={portal_actual().metricas_reconciliador['lag_segundos']}s"
+    )
+
+def es_ciclo_completo(ciclo):
+    """
+    El primer ciclo y luego uno de cada RECONCILE_FULL_SCAN_EVERY hacen escaneo completo (1 = todos)
+    """
+    return RECONCILE_FULL_SCAN_EVERY > 0 and (ciclo - 1) % RECONCILE_FULL_SCAN_EVERY == 0
+
+def _ciclo_reconciliador():
+    dueno = f"{ID_PROCESO}-reconciliador"
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        for portal in list(PORTALES.values()):
+            token_contexto = iniciar_traza(f"reconciler-{uuid.uuid4().hex[:8]}", "reconciler")
+            token_portal = _PORTAL.set(portal)
+            metricas = portal.metricas_reconciliador
+            try:
+                # con varias instancias solo una reconcilia por ciclo
+                if not ESTADO.adquirir_lease(portal.clave("reconciler:lease"), dueno, RECONCILE_INTERVAL):
+                    continue
+                metricas["ciclos"] += 1
+                reconciliar_conversaciones(completo=es_ciclo_completo(metricas["ciclos"]))
+            except Exception as e:
+                metricas["errores"] += 1
+                metricas["ultimo_error"] = str(e)
+                logging.error(f"reconciliador: Error en el ciclo del portal {portal.id} -> {e}")
+            finally:
+                _PORTAL.reset(token_portal)
+                finalizar_traza(token_contexto, None)
+
+@app.before_request
+def _iniciar_reconciliador():
+    """
+    El hilo se inicia con el primer request para que exista en cada worker (gunicorn hace fork)
+    """
+    global _RECONCILIADOR_INICIADO
+    if _RECONCILIADOR_INICIADO or RECONCILE_INTERVAL <= 0:
+        return
+    with _RECONCILIADOR_LOCK:
+        if not _RECONCILIADOR_INICIADO:
+            threading.Thread(target=_ciclo_reconciliador, name="reconciliador", daemon=True).start()
+            _RECONCILIADOR_INICIADO = True
+            logging.info(f"reconciliador: Iniciado cada {RECONCILE_INTERVAL}s")
+
+@app.route("/admin/reconciler", methods=["GET"])
+def admin_reconciliador():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    portal = portal_actual()
+    return jsonify({
+        "activo": _RECONCILIADOR_INICIADO,
+        "intervalo": RECONCILE_INTERVAL,
+        "portal": portal.id,
+        "cursor": ESTADO.get(portal.clave("reconciler:cursor")),
+        **portal.metricas_reconciliador
+    }), 200
+
+#________________________________________________________________________________________
+#Control de admisión
+#________________________________________________________________________________________
+"""
+Cuando Zoho se degrada los hilos se quedan esperando timeouts de 10-20 s. Cada endpoint tiene un
+cupo de trabajo simultaneo; si no hay cupo se espera como maximo ADMISSION_QUEUE_WAIT_MS y luego se
+responde 503 (o 429 si ya hay demasiados esperando) con Retry-After. Los endpoints de salud tienen
+su propio cupo, asi /verify sigue respondiendo aunque los webhooks esten saturados.
+"""
+
+class ControlAdmision:
+    """
+    Cupo de trabajo simultaneo para un endpoint
+    """
+    def __init__(self, nombre, limite, max_cola):
+        self.nombre = nombre
+        self.limite = limite
+        self.max_cola = max_cola
+        self._cupos = threading.BoundedSemaphore(limite)
+        self._lock = threading.Lock()
+        self.en_cola = 0
+        self.en_curso = 0
+        self.admitidos = 0
+        self.rechazados_cola = 0
+        self.rechazados_espera = 0
+
+    def admitir(self, espera):
+        """
+        Retorna None si se admitio, o el status HTTP con el que se debe rechazar
+        """
+        with self._lock:
+            if self.en_cola >= self.max_cola:
+                self.rechazados_cola += 1
+                return 429
+            self.en_cola += 1
+        try:
+            obtenido = self._cupos.acquire(timeout=espera)
+        finally:
+            with self._lock:
+                self.en_cola -= 1
+        with self._lock:
+            if not obtenido:
+                self.rechazados_espera += 1
+                return 503
+            self.en_curso += 1
+            self.admitidos += 1
+        return None
+
+    def liberar(self):
+        with self._lock:
+            self.en_curso -= 1
+        self._cupos.release()
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "limite": self.limite,
+                "en_curso": self.en_curso,
+                "en_cola": self.en_cola,
+                "admitidos": self.admitidos,
+                "rechazados_cola": self.rechazados_cola,
+                "rechazados_espera": self.rechazados_espera
+            }
+
+ADMISION = {
+    "from_waba": ControlAdmision("from_waba", ADMISSION_LIMIT_WABA, ADMISSION_MAX_QUEUE),
+    "from_zoho": ControlAdmision("from_zoho", ADMISSION_LIMIT_ZOHO, ADMISSION_MAX_QUEUE),
+    "salud": ControlAdmision("salud", ADMISSION_LIMIT_HEALTH, ADMISSION_MAX_QUEUE)
+}
+
+def respuesta_saturado(status, motivo):
+    return jsonify({"error": "Service overloaded", "reason": motivo}), status, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+
+def con_admision(nombre):
+    """
+    Decorador: el endpoint solo se ejecuta si hay cupo en ADMISION[nombre] y en el cupo
+    del portal (con varios portales, uno ruidoso no se queda con todo el cupo del endpoint)
+    """
+    control = ADMISION[nombre]
+
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            if APAGANDO.is_set() and nombre != "salud":
+                return respuesta_saturado(503, "shutting_down")
+            if (request.content_length or 0) > WEBHOOK_MAX_BYTES:
+                # el 413 se sabe por el header, sin esperar cupo
+                abort(413)
+            control_portal = portal_actual().admision.get(nombre)
+            if control_portal:
+                rechazo = control_portal.admitir(ADMISSION_QUEUE_WAIT_MS / 1000)
+                if rechazo:
+                    logging.warning(f"admision: {control_portal.nombre} saturado ({rechazo}), en_curso={control_portal.en_curso}, en_cola={control_portal.en_cola}")
+                    return respuesta_saturado(rechazo, "portal_queue_full" if rechazo == 429 else "portal_queue_wait_exceeded")
+            try:
+                rechazo = control.admitir(ADMISSION_QUEUE_WAIT_MS / 1000)
+                if rechazo:
+                    logging.warning(f"admision: {nombre} saturado ({rechazo}), en_curso={control.en_curso}, en_cola={control.en_cola}")
+                    return respuesta_saturado(rechazo, "queue_full" if rechazo == 429 else "queue_wait_exceeded")
+                if nombre == "salud":
+                    try:
+                        return funcion(*args, **kwargs)
+                    finally:
+                        control.liberar()
+                guardado = False
+                try:
+                    # leer el cuerpo puede lanzar el 413 (sin Content-Length, ej: chunked): el cupo se libera igual
+                    clave_en_curso = registrar_en_curso(nombre)
+                    token_en_curso = _EN_CURSO_ACTUAL.set(clave_en_curso)
+                    try:
+                        respuesta = funcion(*args, **kwargs)
+                    except TrabajoGuardado:
+                        guardado = True
+                    finally:
+                        _EN_CURSO_ACTUAL.reset(token_en_curso)
+                        entrada = terminar_en_curso(clave_en_curso)
+                finally:
+                    control.liberar()
+                if guardado or (entrada or {}).get("guardado"):
+                    # se reenvia desde el checkpoint al iniciar
+                    return respuesta_saturado(503, "shutting_down")
+                return respuesta
+            finally:
+                if control_portal:
+                    control_portal.liberar()
+        return envoltura
+    return decorador
+
+@app.route("/admin/admission", methods=["GET"])
+def admin_admision():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    metricas = {nombre: control.metricas() for nombre, control in ADMISION.items()}
+    metricas["portales"] = {
+        portal.id: {nombre: control.metricas() for nombre, control in portal.admision.items()}
+        for portal in PORTALES.values() if portal.admision
+    }
+    return jsonify(metricas), 200
+
+#________________________________________________________________________________________
+#Apagado ordenado y reanudación de pendientes
+#________________________________________________________________________________________
+"""
+Al recibir SIGTERM: se dejan de aceptar webhooks (503 con Retry-After), se espera hasta
+SHUTDOWN_DRAIN_SECONDS a que terminen los requests en curso y lo que siga pendiente se guarda en
+SHUTDOWN_CHECKPOINT_PATH (junto con los buffers del modo diferido si el estado es en memoria).
+Solo se guardan los requests que aun no hicieron ninguna llamada de escritura (no GET) a Zoho o
+App A; los que ya empezaron no se pueden reenviar sin duplicar. Si un request guardado intenta
+escribir despues, la llamada se corta con TrabajoGuardado y se responde 503.
+Al iniciar, un hilo reenvia esos pendientes a los mismos endpoints.
+Importar el modulo no instala nada: iniciar_app() pone el manejador de SIGTERM, el atexit y el
+hilo de reanudación. Con gunicorn llamarla desde post_worker_init (y apagado_ordenado() desde
+worker_exit, porque el arbiter envia SIGTERM al worker y este lo maneja por su cuenta). El drenaje
+no corre dentro del manejador de la señal sino en un hilo aparte (ver _manejar_sigterm).
+"""
+APAGANDO = threading.Event()
+EN_CURSO = {}                     # id -> request webhook en proceso
+_EN_CURSO_LOCK = threading.Lock()
+_EN_CURSO_ACTUAL = contextvars.ContextVar("en_curso", default=None)
+METRICAS_APAGADO = {
+    "apagando": False,
+    "motivo": None,
+    "en_curso_al_iniciar": None,
+    "drain_ms": None,
+    "pendientes_guardados": None,
+    "pendientes_ya_iniciados": None,
+    "estado_guardado": None,
+    "reanudados": 0,
+    "reanudados_error": 0
+}
+
+def registrar_en_curso(endpoint):
+    clave = uuid.uuid4().hex
+    traza = traza_actual()
+    with _EN_CURSO_LOCK:
+        EN_CURSO[clave] = {
+            "endpoint": request.path,
+            "portal": portal_actual().id,
+            "payload": request.get_json(silent=True),
+            "trace_id": traza["trace_id"] if traza else None,
+            "recibido": datetime.now().isoformat(),
+            "upstream": False,
+            "guardado": False
+        }
+    return clave
+
+def terminar_en_curso(clave):
+    with _EN_CURSO_LOCK:
+        return EN_CURSO.pop(clave, None)
+
+class TrabajoGuardado(Exception):
+    """
+    El request ya quedo en el checkpoint del apagado, no debe escribir en Zoho/App A
+    """
+
+def marcar_trabajo_upstream():
+    """
+    Lo llama SesionTrazada antes de cada escritura: desde aqui el request ya no se puede reenviar
+    """
+    clave = _EN_CURSO_ACTUAL.get()
+    if clave is None:
+        return
+    with _EN_CURSO_LOCK:
+        entrada = EN_CURSO.get(clave)
+        if entrada is None:
+            return
+        if entrada["guardado"]:
+            raise TrabajoGuardado(clave)
+        entrada["upstream"] = True
+
+def _entradas_estado_local():
+    """
+    Buffers del modo diferido que se perderian al apagar (solo aplica al estado en memoria)
+    """
+    if not isinstance(ESTADO, EstadoMemoria):
+        return []
+    ahora = time.time()
+    with ESTADO._lock:
+        return [
+            {"tipo": "estado", "clave": clave, "valor": valor, "ttl": (expira - ahora) if expira else None}
+            for clave, (valor, expira) in ESTADO._datos.items()
+            if "lazy:" in clave and (expira is None or expira > ahora)
+        ]
+
+def guardar_checkpoint(pendientes):
+    """
+    Escribe en SHUTDOWN_CHECKPOINT_PATH los requests pendientes (que no han empezado trabajo
+    upstream) y el estado local a conservar
+    """
+    campos_internos = ("upstream", "guardado")
+    entradas = [{"tipo": "request", **{k: v for k, v in p.items() if k not in campos_internos}} for p in pendientes]
+    estado = _entradas_estado_local()
+    entradas += estado
+
+    if entradas:
+        with open(SHUTDOWN_CHECKPOINT_PATH, "a", encoding="utf-8") as archivo:
+            for entrada in entradas:
+                archivo.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+
+    for p in pendientes:
+        # el reenvio no debe quedar bloqueado por el dedupe del intento que no termino
+        message_id = (((p.get("payload") or {}).get("entity") or {}).get("message") or {}).get("id")
+        if p["endpoint"].endswith("/api/from-zoho") and message_id:
+            portal = PORTALES.get(p.get("portal")) or portal_actual()
+            liberar_dedupe(portal.clave(f"dedupe:zoho:{message_id}"))
+    return len(pendientes), len(estado)
+
+def apagado_ordenado(motivo="SIGTERM"):
+    """
+    Deja de aceptar trabajo, drena lo que esta en curso y guarda lo pendiente. Idempotente.
+    """
+    if APAGANDO.is_set():
+        return
+    APAGANDO.set()
+    inicio = time.monotonic()
+    with _EN_CURSO_LOCK:
+        en_curso_inicial = len(EN_CURSO)
+    nivel = logging.WARNING if en_curso_inicial else logging.INFO
+    logging.log(nivel, f"apagado: {motivo} recibido, drenando {en_curso_inicial} requests en curso (max {SHUTDOWN_DRAIN_SECONDS}s)")
+
+    while time.monotonic() - inicio < SHUTDOWN_DRAIN_SECONDS:
+        with _EN_CURSO_LOCK:
+            if not EN_CURSO:
+                break
+        time.sleep(0.05)
+
+    pendientes, ya_iniciados = [], 0
+    with _EN_CURSO_LOCK:
+        for entrada in EN_CURSO.values():
+            if entrada["upstream"] or not SHUTDOWN_CHECKPOINT_PATH:
+                ya_iniciados += 1
+                continue
+            # desde aqui una escritura de ese request lanza TrabajoGuardado
+            entrada["guardado"] = True
+            pendientes.append(dict(entrada))
+    guardados, estado = 0, 0
+    if SHUTDOWN_CHECKPOINT_PATH:
+        try:
+            guardados, estado = guardar_checkpoint(pendientes)
+        except Exception as e:
+            logging.error(f"apagado: No se pudo guardar el checkpoint -> {e}")
+    if ya_iniciados:
+        logging.warning(f"apagado: {ya_iniciados} requests siguen en curso y no se guardan (ya escribieron en Zoho/App A o no hay checkpoint)")
+
+    METRICAS_APAGADO.update({
+        "apagando": True,
+        "motivo": motivo,
+        "en_curso_al_iniciar": en_curso_inicial,
+        "drain_ms": round((time.monotonic() - inicio) * 1000, 2),
+        "pendientes_guardados": guardados,
+        "pendientes_ya_iniciados": ya_iniciados,
+        "estado_guardado": estado
+    })
+    logging.log(
+        logging.WARNING if (guardados or estado) else nivel,
+        f"apagado: drenado en {METRICAS_APAGADO['drain_ms']}ms, en curso al iniciar={en_curso_inicial}, "
+        f"pendientes guardados={guardados}, entradas de estado guardadas={estado}"
+    )
+
+def _drenar_y_reenviar(signum):
+    try:
+        apagado_ordenado("SIGTERM")
+    finally:
+        _SIGTERM_DRENADO.set()
+        os.kill(os.getpid(), signum)
+
+def _manejar_sigterm(signum, frame):
+    """
+    El drenaje corre en otro hilo y el manejador retorna de inmediato: con un worker sync el hilo
+    interrumpido es el mismo que atiende el request en curso, que asi puede terminar. Al acabar el
+    drenaje la señal se reenvia y en esa segunda llegada se pasa al manejador anterior.
+    """
+    anterior = _SIGTERM_ANTERIOR
+    if anterior == signal.SIG_IGN:
+        return
+    if not _SIGTERM_DRENADO.is_set():
+        # los manejadores de señales solo corren en el hilo principal, no hace falta candado
+        if _SIGTERM_DRENANDO.is_set():
+            return
+        _SIGTERM_DRENANDO.set()
+        threading.Thread(target=_drenar_y_reenviar, args=(signum,), name="apagado", daemon=True).start()
+        return
+    if callable(anterior):
+        anterior(signum, frame)
+    else:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+def reanudar_pendientes():
+    """
+    Reenvia los pendientes guardados en el apagado anterior. El archivo se renombra antes de
+    leerlo para que solo un worker lo procese.
+    """
+    if not SHUTDOWN_CHECKPOINT_PATH or not os.path.exists(SHUTDOWN_CHECKPOINT_PATH):
+        return
+    en_proceso = f"{SHUTDOWN_CHECKPOINT_PATH}.{os.getpid()}"
+    try:
+        os.replace(SHUTDOWN_CHECKPOINT_PATH, en_proceso)
+    except OSError:
+        return      # otro worker lo tomo
+
+    with open(en_proceso, encoding="utf-8") as archivo:
+        entradas = [json.loads(linea) for linea in archivo if linea.strip()]
+    logging.info(f"reanudar_pendientes: {len(entradas)} entradas del apagado anterior")
+
+    cliente = app.test_client()
+    for entrada in entradas:
+        try:
+            if entrada["tipo"] == "estado":
+                ESTADO.set(entrada["clave"], entrada["valor"], ttl=entrada.get("ttl"))
+                continue
+            respuesta = cliente.post(
+                entrada["endpoint"],
+                json=entrada.get("payload"),
+                headers={
+                    "X-Trace-Id": entrada.get("trace_id") or uuid.uuid4().hex,
+                    "X-Replay": "checkpoint",
+                    PORTAL_HEADER: entrada.get("portal") or PORTAL_DEFAULT
+                }
+            )
+            if respuesta.status_code < 500:
+                METRICAS_APAGADO["reanudados"] += 1
+            else:
+                METRICAS_APAGADO["reanudados_error"] += 1
+                logging.error(f"reanudar_pendientes: {entrada['endpoint']} respondio {respuesta.status_code}")
+        except Exception as e:
+            METRICAS_APAGADO["reanudados_error"] += 1
+            logging.error(f"reanudar_pendientes: Error reenviando {entrada.get('endpoint')} -> {e}")
+    os.remove(en_proceso)
+
+@app.route("/admin/drain", methods=["GET"])
+def admin_apagado():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    with _EN_CURSO_LOCK:
+        en_curso = len(EN_CURSO)
+    return jsonify({"en_curso": en_curso, **METRICAS_APAGADO}), 200
+
+_SIGTERM_ANTERIOR = None
+_SIGTERM_DRENANDO = threading.Event()
+_SIGTERM_DRENADO = threading.Event()
+_APP_INICIADA = False
+_APP_INICIADA_LOCK = threading.Lock()
+
+def _reanudar_al_iniciar():
+    # se espera a que la app termine de cargar antes de reenviar
+    time.sleep(2)
+    try:
+        reanudar_pendientes()
+    except Exception as e:
+        logging.error(f"reanudar_pendientes: Error procesando el checkpoint -> {e}")
+
+def iniciar_app():
+    """
+    Instala el manejador de SIGTERM (si no se esta ignorando y estamos en el hilo principal), el
+    apagado al salir y, con SHUTDOWN_CHECKPOINT_PATH, el hilo que reanuda los pendientes. Idempotente.
+    """
+    global _APP_INICIADA, _SIGTERM_ANTERIOR
+    with _APP_INICIADA_LOCK:
+        if _APP_INICIADA:
+            return
+        _APP_INICIADA = True
+    if threading.current_thread() is threading.main_thread():
+        actual = signal.getsignal(signal.SIGTERM)
+        if actual == signal.SIG_IGN:
+            logging.info("apagado: SIGTERM esta ignorado, no se instala el manejador")
+        else:
+            _SIGTERM_ANTERIOR = signal.signal(signal.SIGTERM, _manejar_sigterm)
+    atexit.register(apagado_ordenado, "exit")
+    if SHUTDOWN_CHECKPOINT_PATH:
+        threading.Thread(target=_reanudar_al_iniciar, name="reanudar_pendientes", daemon=True).start()
+
+#________________________________________________________________________________________
+#JSON y esquemas de payload
+#________________________________________________________________________________________
+"""
+ProveedorJSON usa orjson si esta instalado (si no, el json de la libreria estandar) para
+request.get_json, jsonify y los logs. Los esquemas se compilan una vez al cargar la app y
+extraen/validan en una sola pasada los campos que usan los endpoints, con sus alternativas
+(user_id/phone, message/text, entity.message.sender.name).
+"""
+
+class ProveedorJSON(DefaultJSONProvider):
+    """
+    Proveedor JSON de Flask que usa orjson cuando esta disponible
+    """
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.get("indent"):
+            return super().dumps(obj, **kwargs)
+        opciones = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            opciones |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=opciones).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+app.json_provider_class = ProveedorJSON
+app.json = ProveedorJSON(app)
+app.config["MAX_CONTENT_LENGTH"] = WEBHOOK_MAX_BYTES
+
+@app.errorhandler(413)
+def payload_muy_grande(error):
+    # mismo formato que los 400 de validación, no la pagina HTML de werkzeug
+    logging.error(f"{request.path}: Payload de {request.content_length} bytes rechazado (max {WEBHOOK_MAX_BYTES})")
+    return jsonify({
+        "error": "Payload too large",
+        "details": [f"el cuerpo supera WEBHOOK_MAX_BYTES ({WEBHOOK_MAX_BYTES} bytes)"]
+    }), 413
+
+class ErrorPayload(ValueError):
+    """El payload no cumple el esquema, errores trae el detalle por campo"""
+    def __init__(self, errores):
+        super().__init__("; ".join(errores))
+        self.errores = errores
+
+class EsquemaPayload:
+    """
+    Esquema precompilado: nombre -> (rutas alternativas, tipos, requerido, default).
+    Una ruta es una tupla de llaves, ej: ("entity", "message", "text"). Se toma la primera
+    ruta con un valor no vacio, igual que el patron data.get('a') or data.get('b').
+    """
+    def __init__(self, campos):
+        self._campos = tuple(
+            (
+                nombre,
+                tuple(tuple(ruta.split(".")) for ruta in spec["rutas"]),
+                spec.get("tipos", (str,)),
+                spec.get("requerido", False),
+                spec.get("default")
+            )
+            for nombre, spec in campos.items()
+        )
+
+    def extraer(self, data):
+        if not isinstance(data, dict):
+            raise ErrorPayload(["el payload debe ser un objeto JSON"])
+        resultado = {}
+        errores = []
+        for nombre, rutas, tipos, requerido, default in self._campos:
+            valor = None
+            for ruta in rutas:
+                actual = data
+                for llave in ruta:
+                    if not isinstance(actual, dict):
+                        actual = None
+                        break
+                    actual = actual.get(llave)
+                if actual not in (None, ""):
+                    valor = actual
+                    break
+            if valor is None:
+                if requerido:
+                    errores.append(f"falta {nombre} ({' o '.join('.'.join(r) for r in rutas)})")
+                resultado[nombre] = default
+            elif not isinstance(valor, tipos) or isinstance(valor, bool):
+                errores.append(f"{nombre} tiene tipo invalido: {type(valor).__name__}")
+                resultado[nombre] = default
+            else:
+                resultado[nombre] = valor
+        if errores:
+            raise ErrorPayload(errores)
+        return resultado
+
+ESQUEMA_WABA = EsquemaPayload({
+    "telefono": {"rutas": ["user_id", "phone"], "tipos": (str, int), "requerido": True},
+    "mensaje": {"rutas": ["message", "text"], "tipos": (str,), "requerido": True},
+    "tag": {"rutas": ["tag"], "default": "soporte_urgente"}
+})
+
+ESQUEMA_ZOHO = EsquemaPayload({
+    "event": {"rutas": ["event"]},
+    "message_id": {"rutas": ["entity.message.id"], "tipos": (str, int)},
+    "message_text": {"rutas": ["entity.message.text"]},
+    "sender_name": {"rutas": ["entity.message.sender.name"]},
+    "visitor_phone": {"rutas": ["entity.visitor.phone"], "tipos": (str, int)}
+})
+
+def resumen_log(data, limite=500):
+    """
+    Texto corto del payload para los logs (los payloads grandes no se serializan completos)
+    """
+    texto = json.dumps(data, ensure_ascii=False) if not isinstance(data, str) else data
+    return texto if len(texto) <= limite else f"{texto[:limite]}... ({len(texto)} caracteres)"
+
+#________________________________________________________________________________________
+#Carriles de prioridad para el trabajo hacia Zoho / App A
+#________________________________________________________________________________________
+"""
+En rafagas los espejos del bot (respuesta_bot) compiten con los mensajes de clientes y las
+respuestas de agentes. El trabajo hacia Zoho/App A pasa por un planificador con UPSTREAM_CONCURRENCY
+cupos por portal; cuando hay cola se elige el carril por peso (round robin ponderado, PRIORITY_WEIGHTS) y si
+alguien de un carril bajo lleva mas de PRIORITY_MAX_WAIT_MS esperando pasa primero (anti-inanición).
+La espera por carril se expone en /admin/lanes.
+"""
+
+class SinCupoUpstream(RuntimeError):
+    """No se obtuvo cupo para llamar a Zoho/App A dentro del tiempo disponible"""
+
+def _leer_pesos(texto):
+    pesos = {}
+    for parte in texto.split(","):
+        if ":" in parte:
+            clase, peso = parte.split(":", 1)
+            pesos[clase.strip()] = max(int(peso), 1)
+    return pesos
+
+class PlanificadorPrioridad:
+    """
+    Cupos compartidos para el trabajo upstream, repartidos por carril segun su peso
+    """
+    def __init__(self, limite, pesos, max_espera):
+        self.limite = limite
+        self.pesos = pesos
+        self.max_espera = max_espera
+        self._lock = threading.Lock()
+        self._colas = {clase: deque() for clase in pesos}
+        self._credito = {clase: 0 for clase in pesos}
+        self.activos = 0
+        self._metricas = {
+            clase: {"atendidos": 0, "sin_cupo": 0, "espera_total_ms": 0.0, "espera_max_ms": 0.0, "esperas": deque(maxlen=512)}
+            for clase in pesos
+        }
+
+    def _elegir_carril(self, ahora):
+        con_cola = [clase for clase, cola in self._colas.items() if cola]
+        if not con_cola:
+            return None
+        # anti-inanición: el que mas haya esperado por encima del limite pasa primero
+        vencidos = [c for c in con_cola if ahora - self._colas[c][0]["llegada"] > self.max_espera]
+        if vencidos:
+            return min(vencidos, key=lambda c: self._colas[c][0]["llegada"])
+        # round robin ponderado suave (igual que nginx)
+        total = sum(self.pesos[c] for c in con_cola)
+        for clase in con_cola:
+            self._credito[clase] += self.pesos[clase]
+        elegido = max(con_cola, key=lambda c: self._credito[c])
+        self._credito[elegido] -= total
+        return elegido
+
+    def _despachar(self):
+        # se llama con el lock tomado
+        ahora = time.monotonic()
+        while self.activos < self.limite:
+            clase = self._elegir_carril(ahora)
+            if clase is None:
+                return
+            turno = self._colas[clase].popleft()
+            turno["otorgado"] = True
+            self.activos += 1
+            espera_ms = (ahora - turno["llegada"]) * 1000
+            metricas = self._metricas[clase]
+            metricas["atendidos"] += 1
+            metricas["espera_total_ms"] += espera_ms
+            metricas["espera_max_ms"] = max(metricas["espera_max_ms"], espera_ms)
+            metricas["esperas"].append(espera_ms)
+            turno["evento"].set()
+
+    def adquirir(self, clase, timeout):
+        """
+        Espera cupo en el carril 'clase', retorna True si se obtuvo
+        """
+        if clase not in self._colas:
+            clase = min(self.pesos, key=self.pesos.get)
+        turno = {"llegada": time.monotonic(), "evento": threading.Event(), "otorgado": False}
+        with self._lock:
+            self._colas[clase].append(turno)
+            self._despachar()
+        if turno["evento"].wait(timeout):
+            return True
+        with self._lock:
+            if turno["otorgado"]:
+                return True
+            self._colas[clase].remove(turno)
+            self._metricas[clase]["sin_cupo"] += 1
+        return False
+
+    def liberar(self):
+        with self._lock:
+            self.activos -= 1
+            self._despachar()
+
+    def metricas(self):
+        with self._lock:
+            resultado = {"limite": self.limite, "activos": self.activos, "carriles": {}}
+            for clase, metricas in self._metricas.items():
+                esperas = sorted(metricas["esperas"])
+                resultado["carriles"][clase] = {
+                    "peso": self.pesos[clase],
+                    "en_cola": len(self._colas[clase]),
+                    "atendidos": metricas["atendidos"],
+                    "sin_cupo": metricas["sin_cupo"],
+                    "espera_promedio_ms": round(metricas["espera_total_ms"] / metricas["atendidos"], 2) if metricas["atendidos"] else 0,
+                    "espera_p50_ms": round(esperas[len(esperas) // 2], 2) if esperas else 0,
+                    "espera_p95_ms": round(esperas[int(len(esperas) * 0.95)], 2) if esperas else 0,
+                    "espera_max_ms": round(metricas["espera_max_ms"], 2)
+                }
+            return resultado
+
+def clasificar_prioridad(mensaje, tag_name):
+    """
+    Carril de un mensaje de App A: escalación a humano, mensaje de usuario o espejo del bot
+    """
+    if tag_name == "respuesta_bot":
+        return "bot"
+    if es_escalacion(mensaje, tag_name):
+        return "escalacion"
+    return "usuario"
+
+@contextmanager
+def carril_prioridad(clase):
+    """
+    Ocupa un cupo upstream en el carril 'clase' del portal actual mientras dura el bloque
+    """
+    planificador = portal_actual().planificador
+    if presupuesto_agotado():
+        # sin tiempo no se espera el carril: es un 504 (plazo), no un 503 (sin cupo)
+        raise PresupuestoAgotado(f"presupuesto de {_PLAZO.get()['total']}s agotado antes del carril {clase}")
+    restante = presupuesto_restante()
+    with span(f"cola_{clase}"):
+        obtenido = planificador.adquirir(clase, restante if restante is not None else PRIORITY_QUEUE_TIMEOUT)
+    if not obtenido and presupuesto_agotado():
+        raise PresupuestoAgotado(f"presupuesto de {_PLAZO.get()['total']}s agotado esperando el carril {clase}")
+    if not obtenido:
+        raise SinCupoUpstream(f"sin cupo upstream en el carril {clase}")
+    try:
+        yield
+    finally:
+        planificador.liberar()
+
+@app.route("/admin/lanes", methods=["GET"])
+def admin_carriles():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify({portal.id: portal.planificador.metricas() for portal in PORTALES.values()}), 200
+
+#________________________________________________________________________________________
+#Estadisticas de trafico (/stats)
+#________________________________________________________________________________________
+"""
+Contadores en anillos de buckets: segundos del ultimo minuto, minutos de la ultima hora y horas
+del ultimo dia. Incrementar es O(1) (se recicla el bucket si quedo de una vuelta anterior) y la
+memoria es fija: cada anillo es una matriz buckets x STATS_MAX_COUNTERS de enteros. Los nombres
+nuevos (ej: boton:btn_7) toman un indice libre; si se acaban se cuentan en "otros".
+"""
+
+class AnilloContadores:
+    """
+    'buckets' buckets de 'ancho' segundos, cada uno con un entero por contador
+    """
+    def __init__(self, buckets, ancho, max_contadores):
+        self.buckets = buckets
+        self.ancho = ancho
+        self._epocas = [-1] * buckets
+        self._valores = [[0] * max_contadores for _ in range(buckets)]
+
+    def _bucket(self, ahora):
+        epoca = int(ahora // self.ancho)
+        posicion = epoca % self.buckets
+        if self._epocas[posicion] != epoca:
+            # el bucket es de una vuelta anterior del anillo, se reinicia
+            fila = self._valores[posicion]
+            for i in range(len(fila)):
+                fila[i] = 0
+            self._epocas[posicion] = epoca
+        return self._valores[posicion]
+
+    def sumar(self, indice, ahora):
+        self._bucket(ahora)[indice] += 1
+
+    def buckets_vigentes(self, ahora):
+        """
+        (epoca, valores) de los buckets dentro de la ventana, del mas viejo al mas nuevo
+        """
+        actual = int(ahora // self.ancho)
+        vigentes = [(e, self._valores[p]) for p, e in enumerate(self._epocas) if actual - self.buckets < e <= actual]
+        return sorted(vigentes, key=lambda x: x[0])
+
+class EstadisticasTrafico:
+    def __init__(self, max_contadores):
+        self.max_contadores = max_contadores
+        self._lock = threading.Lock()
+        self._indices = {"otros": 0}
+        self._nombres = ["otros"]
+        self._totales = [0] * max_contadores
+        self.inicio = time.time()
+        self.anillos = {
+            "minuto": AnilloContadores(60, 1, max_contadores),
+            "hora": AnilloContadores(60, 60, max_contadores),
+            "dia": AnilloContadores(24, 3600, max_contadores)
+        }
+
+    def _indice(self, nombre):
+        indice = self._indices.get(nombre)
+        if indice is None:
+            if len(self._nombres) >= self.max_contadores:
+                return 0
+            indice = self._indices[nombre] = len(self._nombres)
+            self._nombres.append(nombre)
+        return indice
+
+    def contar(self, *nombres):
+        ahora = time.time()
+        with self._lock:
+            for nombre in nombres:
+                indice = self._indice(nombre)
+                self._totales[indice] += 1
+                for anillo in self.anillos.values():
+                    anillo.sumar(indice, ahora)
+
+    def _a_dict(self, valores):
+        return {nombre: valores[i] for i, nombre in enumerate(self._nombres) if valores[i]}
+
+    def resumen(self, serie=None):
+        ahora = time.time()
+        with self._lock:
+            ventanas = {}
+            for nombre_ventana, anillo in (("ultimo_minuto", self.anillos["minuto"]), ("ultima_hora", self.anillos["hora"]), ("ultimo_dia", self.anillos["dia"])):
+                suma = [0] * self.max_contadores
+                for _, valores in anillo.buckets_vigentes(ahora):
+                    for i in range(len(self._nombres)):
+                        suma[i] += valores[i]
+                ventanas[nombre_ventana] = self._a_dict(suma)
+            resultado = {
+                "desde": datetime.fromtimestamp(self.inicio).isoformat(),
+                "contadores_en_uso": len(self._nombres),
+                "ventanas": ventanas,
+                "total": self._a_dict(self._totales)
+            }
+            if serie in self.anillos:
+                anillo = self.anillos[serie]
+                resultado["serie"] = [
+                    {"inicio": datetime.fromtimestamp(epoca * anillo.ancho).isoformat(), **self._a_dict(valores)}
+                    for epoca, valores in anillo.buckets_vigentes(ahora)
+                ]
+        return resultado
+
+ESTADISTICAS = EstadisticasTrafico(STATS_MAX_COUNTERS)
+
+def id_boton(mensaje):
+    """
+    Id del boton de WhatsApp en el mensaje (btn_0, btn_si1, ...) o None
+    """
+    if "btn_" not in mensaje:
+        return None
+    inicio = mensaje.index("btn_")
+    fin = inicio + 4
+    while fin < len(mensaje) and mensaje[fin].isalnum():
+        fin += 1
+    return mensaje[inicio:fin]
+
+@app.route("/stats", methods=["GET"])
+@app.route("/admin/stats", methods=["GET"])
+def admin_estadisticas():
+    """
+    ?serie=minuto|hora|dia agrega el detalle por bucket (por segundo, por minuto o por hora)
+    """
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify(ESTADISTICAS.resumen(request.args.get("serie"))), 200
+
+#________________________________________________________________________________________
+#Cache de lecturas a Zoho (GET condicionales), ver cache_http.py
+#________________________________________________________________________________________
+
+@app.route("/admin/cache", methods=["GET"])
+def admin_cache():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify({portal.id: portal.http.cache.metricas() if portal.http.cache else None for portal in PORTALES.values()}), 200
+
+#________________________________________________________________________________________
+#Captura de trafico (CAPTURE_PATH) para replay.py
+#________________________________________________________________________________________
+"""
+Con CAPTURE_PATH cada webhook de from_waba / from_zoho se escribe como una linea JSON compacta con
+su timestamp. No se guarda ningun dato personal: telefonos e ids de mensaje se reemplazan por un
+hash con sal (CAPTURE_SALT, el mismo telefono da el mismo hash dentro de la captura) y de los textos
+solo queda el id del boton (btn_*), el prefijo de eco y el largo. Los requests reenviados
+(X-Replay) no se capturan. Al llegar a CAPTURE_MAX_BYTES se deja de capturar.
+La sal es obligatoria: una sal aleatoria por proceso daria hashes distintos del mismo telefono en
+cada worker y en cada reinicio, y la captura ya no serviria para reconstruir conversaciones.
+"""
+_CAPTURA_LOCK = threading.Lock()
+_CAPTURA = {"archivo": None, "bytes": 0, "lineas": 0, "llena": False, "sin_sal": False}
+
+def hash_captura(valor):
+    if not valor:
+        return None
+    return hashlib.sha256(f"{CAPTURE_SALT}:{valor}".encode("utf-8")).hexdigest()[:16]
+
+def _texto_captura(texto):
+    texto = texto or ""
+    resumen = {"largo": len(texto)}
+    boton = id_boton(texto)
+    if boton:
+        resumen["boton"] = boton
+    for prefijo in ("[🤖 Bot]:", "[👤 Usuario]:"):
+        if texto.strip().startswith(prefijo):
+            resumen["prefijo"] = prefijo
+    return resumen
+
+def capturar(endpoint, campos):
+    """
+    Agrega el webhook (ya validado por su esquema) a la captura
+    """
+    if not CAPTURE_PATH or _CAPTURA["llena"] or request.headers.get("X-Replay"):
+        return
+    if not CAPTURE_SALT:
+        if not _CAPTURA["sin_sal"]:
+            _CAPTURA["sin_sal"] = True
+            logging.error("captura: CAPTURE_PATH esta definido sin CAPTURE_SALT, no se captura")
+        return
+    if CAPTURE_SAMPLE_RATE < 1 and random.random() >= CAPTURE_SAMPLE_RATE:
+        return
+    if endpoint == "waba":
+        registro = {
+            "tel": hash_captura(limpiar_telefono(str(campos["telefono"]))),
+            "tag": campos["tag"],
+            **_texto_captura(campos["mensaje"])
+        }
+    else:
+        registro = {
+            "ev": campos["event"],
+            "id": hash_captura(campos["message_id"]),
+            "tel": hash_captura(limpiar_telefono(campos["visitor_phone"])) if campos["visitor_phone"] else None,
+            "bot": campos["sender_name"] == "TicAll-Bot",
+            **_texto_captura(campos["message_text"])
+        }
+    linea = json.dumps({"ts": round(time.time() * 1000), "e": endpoint, "p": portal_actual().id, **registro}, ensure_ascii=False, separators=(",", ":")) + "\n"
+    # CAPTURE_MAX_BYTES es en bytes del archivo, no en caracteres (los prefijos de eco traen emojis)
+    tamano = len(linea.encode("utf-8"))
+
+    try:
+        with _CAPTURA_LOCK:
+            if _CAPTURA["archivo"] is None:
+                _CAPTURA["archivo"] = open(CAPTURE_PATH, "a", encoding="utf-8", buffering=1)
+                _CAPTURA["bytes"] = os.path.getsize(CAPTURE_PATH)
+            if _CAPTURA["bytes"] + tamano > CAPTURE_MAX_BYTES:
+                _CAPTURA["llena"] = True
+                logging.warning(f"captura: {CAPTURE_PATH} llego a CAPTURE_MAX_BYTES, se deja de capturar")
+                return
+            _CAPTURA["archivo"].write(linea)
+            _CAPTURA["bytes"] += tamano
+            _CAPTURA["lineas"] += 1
+    except OSError as e:
+        logging.error(f"captura: No se pudo escribir en {CAPTURE_PATH} -> {e}")
+
+#________________________________________________________________________________________
+#Portales (varios Zoho / App A en un mismo proceso)
+#________________________________________________________________________________________
+"""
+Cada portal (marca o pais) tiene sus credenciales, su token, su pool de conexiones, sus cupos
+upstream y de admisión, su departamento y sus claves en ESTADO (prefijo portal:<id>:, el portal
+por defecto usa las claves sin prefijo). El portal se elige por ruta (/t/<portal>/api/from-waba)
+o por el header PORTAL_HEADER; sin ninguno de los dos se usa PORTAL_DEFAULT.
+"""
+_PORTAL = contextvars.ContextVar("portal", default=None)
+
+def _valor_config(valor):
+    # "$VARIABLE" se toma del entorno, asi los secretos no van dentro del JSON
+    if isinstance(valor, str) and valor.startswith("$"):
+        return os.getenv(valor[1:])
+    return valor
+
+class Portal:
+    """
+    Configuración y recursos aislados de un portal de Zoho
+    """
+    def __init__(self, id, config, total_portales=1):
+        config = {clave: _valor_config(valor) for clave, valor in config.items()}
+        self.id = id
+        self.portal_name = config.get("portal_name")
+        self.client_id = config.get("client_id")
+        self.client_secret = config.get("client_secret")
+        self.refresh_token = config.get("refresh_token")
+        self.salesiq_base = config.get("salesiq_base") or ZOHO_SALESIQ_BASE
+        self.visitor_base = config.get("visitor_base") or ZOHO_VISITOR_BASE
+        self.accounts_url = config.get("accounts_url") or ZOHO_ACCOUNTS_URL
+        self.app_a_url = config.get("app_a_url")
+        self.app_id = config.get("app_id")
+        self.department_id = config.get("department_id")
+        self._prefijo = "" if id == PORTAL_DEFAULT else f"portal:{id}:"
+
+        ttl_cache = float(config.get("cache_ttl") if config.get("cache_ttl") is not None else ZOHO_CACHE_TTL)
+        cache = CacheHTTP(
+            [f"{self.salesiq_base}/{self.portal_name}/"], ttl_cache, ZOHO_CACHE_TTLS,
+            ZOHO_CACHE_MAX_ENTRIES, ZOHO_CACHE_MAX_BYTES, cargar_json=app.json.loads
+        ) if ttl_cache > 0 else None
+        self.http = SesionTrazada(cache)
+        self.token = None
+        self.token_expira = None
+        self.planificador = PlanificadorPrioridad(
+            int(config.get("upstream_concurrency") or UPSTREAM_CONCURRENCY),
+            _leer_pesos(config.get("priority_weights") or PRIORITY_WEIGHTS),
+            PRIORITY_MAX_WAIT_MS / 1000
+        )
+        # con un solo portal basta el cupo global de cada endpoint
+        self.admision = {}
+        if total_portales > 1:
+            participacion = float(config.get("admission_share") or PORTAL_ADMISSION_SHARE)
+            for nombre in ("from_waba", "from_zoho"):
+                limite = max(1, int(ADMISION[nombre].limite * participacion))
+                self.admision[nombre] = ControlAdmision(f"{id}:{nombre}", limite, ADMISSION_MAX_QUEUE)
+        self.metricas_reconciliador = dict(METRICAS_RECONCILIADOR_INICIALES)
+
+    @property
+    def api_base(self):
+        return f"{self.salesiq_base}/{self.portal_name}"
+
+    @property
+    def visitor_api_base(self):
+        return f"{self.visitor_base}/{self.portal_name}"
+
+    def clave(self, clave):
+        """
+        Clave de ESTADO aislada para este portal
+        """
+        return self._prefijo + clave
+
+    def resumen(self):
+        return {
+            "portal_name": self.portal_name,
+            "department_id": self.department_id,
+            "app_a_url": self.app_a_url,
+            "credenciales": bool(self.client_id and self.client_secret and self.refresh_token),
+            "token_valido_hasta": self.token_expira.isoformat() if self.token_expira else None,
+            "upstream_concurrency": self.planificador.limite,
+            "admision": {nombre: control.limite for nombre, control in self.admision.items()}
+        }
+
+def cargar_portales():
+    """
+    Portal "default" desde las variables de siempre + los de ZOHO_PORTALS
+    """
+    configuraciones = {}
+    if ZOHO_PORTAL_NAME or ZOHO_CLIENT_ID or not ZOHO_PORTALS:
+        configuraciones["default"] = {
+            "portal_name": ZOHO_PORTAL_NAME,
+            "client_id": ZOHO_CLIENT_ID,
+            "client_secret": ZOHO_CLIENT_SECRET,
+            "refresh_token": ZOHO_REFRESH_TOKEN,
+            "app_a_url": APP_A_URL,
+            "app_id": SALESIQ_APP_ID,
+            "department_id": SALESIQ_DEPARTMENT_ID
+        }
+    if ZOHO_PORTALS:
+        if ZOHO_PORTALS.lstrip().startswith("{"):
+            configuraciones.update(json.loads(ZOHO_PORTALS))
+        else:
+            with open(ZOHO_PORTALS, encoding="utf-8") as archivo:
+                configuraciones.update(json.load(archivo))
+    if PORTAL_DEFAULT not in configuraciones:
+        raise RuntimeError(f"PORTAL_DEFAULT '{PORTAL_DEFAULT}' no esta en la configuración de portales")
+    return {id: Portal(id, config, len(configuraciones)) for id, config in configuraciones.items()}
+
+PORTALES = cargar_portales()
+
+def portal_actual():
+    return _PORTAL.get() or PORTALES[PORTAL_DEFAULT]
+
+@app.before_request
+def _resolver_portal():
+    portal_id = (request.view_args or {}).pop("portal", None) or request.headers.get(PORTAL_HEADER)
+    if not portal_id:
+        return
+    portal = PORTALES.get(portal_id)
+    if portal is None:
+        logging.warning(f"portales: Portal desconocido '{portal_id}' en {request.path}")
+        return jsonify({"error": "Unknown portal", "portal": portal_id}), 404
+    request.environ["portal.token"] = _PORTAL.set(portal)
+
+@app.teardown_request
+def _cerrar_portal(error=None):
+    token = request.environ.pop("portal.token", None)
+    if token is not None:
+        _PORTAL.reset(token)
+
+@app.route("/admin/portals", methods=["GET"])
+def admin_portales():
+    if not admin_autorizado():
+        return jsonify({"status": "forbidden"}), 403
+    return jsonify({"default": PORTAL_DEFAULT, "portales": {id: portal.resumen() for id, portal in PORTALES.items()}}), 200
+
+#________________________________________________________________________________________
 
 #Recepcion de mensajes de Whatsapp - Zoho
 
 @app.route('/api/from-waba', methods=['POST'])
+@app.route('/t/<portal>/api/from-waba', methods=['POST'])
+@con_admision("from_waba")
+@con_plazo(WABA_DEADLINE_SECONDS)
 def from_waba():
     """
     # 1. Recibe datos de WhatsApp desde App A
@@ -783,28 +2782,42 @@ def from_waba():
         #========================================================
         # Paso 1: Recibir y Validar Datos
         #========================================================
-        data = request.json or {}
-        
-        #if not data:
-            #logging.error(f"from-waba: No se recibieron datos en el request")
-            #return jsonify({"error":"No data received"}), 400
-        logging.info(f"from-waba: mensaje recibido: {data}")
+        data = request.get_json(silent=True)
+        if data is None:
+            logging.error(f"from-waba: El request no trae un JSON valido")
+            return jsonify({"error": "Invalid JSON"}), 400
+
+        logging.info(f"from-waba: mensaje recibido: {resumen_log(data)}")
         
-        #extraer información del mensaje de whatsapp
-        telefono = data.get('user_id') or data.get('phone') #or data.get('from') or data.get('telefono')
-        mensaje = data.get('message') or data.get('text')# or data.get('body')
-        tag_name = data.get("tag", "soporte_urgente")
+        #extraer y validar información del mensaje de whatsapp (user_id/phone, message/text, tag)
+        try:
+            campos = ESQUEMA_WABA.extraer(data)
+        except ErrorPayload as e:
+            logging.error(f"from-waba: Datos incompletos: {e}")
+            return jsonify({
+                "error": "Missing phone or message",
+                "details": e.errores
+                }), 400
+
+        capturar("waba", campos)
+        telefono = str(campos["telefono"])
+        mensaje = campos["mensaje"]
+        tag_name = campos["tag"]
 
-        mensaje_formateado = f"[👤 Usuario]: {mensaje}"
+        mensaje_formateado = formatear_boton(f"[👤 Usuario]: {mensaje}")
         if tag_name == "respuesta_bot":
             mensaje_formateado = f"[🤖 Bot]: {mensaje}"
 
-        #validar que se cuenta con los datos minimos
-        if not telefono or not mensaje:
-            logging.error(f"from-waba: Datos incompletos: - telefono: {telefono}, mensaje: {mensaje_formateado}")
-            return jsonify({
-                "error": "Missing phone or message"
-                }), 400
+        # clave canonica del telefono (E.164), se calcula una sola vez y se usa en todo el estado local
+        clave_telefono = limpiar_telefono(telefono)
+
+        contadores = ["mensajes_entrada", "mensajes_entrada:bot" if tag_name == "respuesta_bot" else "mensajes_entrada:usuario"]
+        boton = id_boton(mensaje) if tag_name != "respuesta_bot" else None
+        if boton:
+            contadores.append(f"boton:{boton}")
+        if es_escalacion(mensaje, tag_name):
+            contadores.append("escalaciones")
+        ESTADISTICAS.contar(*contadores)
 
         logging.info(f"\n{'='*70}")
         logging.info(f"Mensaje de Whatsapp recibido:")
@@ -812,6 +2825,22 @@ def from_waba():
         logging.info(f"Mensaje: {mensaje_formateado[:100]}...")
         logging.info(f"\n{'='*70}\n")
 
+        #========================================================
+        # Paso 1b: Modo diferido, guardar localmente hasta que el usuario escale
+        #========================================================
+        transcripcion = []
+        if ZOHO_LAZY_CONVERSATIONS:
+            if not esta_materializada(clave_telefono) and not es_escalacion(mensaje, tag_name):
+                return diferir_mensaje(telefono, clave_telefono, mensaje_formateado)
+
+            mensaje_individual = mensaje_formateado
+            transcripcion = leer_transcripcion(clave_telefono)
+            if transcripcion:
+                logging.info(f"from-waba: Escalación detectada, enviando transcripción de {len(transcripcion)} mensajes a Zoho")
+                # cada linea ya va formateada (las de buffers anteriores se formatean aqui), el
+                # texto unido se envia tal cual
+                mensaje_formateado = "\n".join(formatear_boton(m) for m in transcripcion + [mensaje_formateado])
+
         #========================================================
         # Paso 2: Obtener o crear visitante
         #========================================================
@@ -830,52 +2859,101 @@ def from_waba():
         """
         visitor_id = f"whatsapp_{telefono}" #dato provisional
 
-        #========================================================
-        # Paso 3: Buscar conversaciones abiertas
-        #========================================================
-        logging.info(f"PASO 2: buscando conversación abierta... ")
-        #conversacion_abierta = buscar_conversacion_abierta_por_visitor(visitor_id)
-        conversacion_abierta = buscar_conversacion_abierta_por_visitor(telefono)
-
-        chat_id = None
-        #========================================================
-        # Paso 4: Enviar mensaje a conversación existente o crear nueva
-        #========================================================
-        if conversacion_abierta:
-            #caso A: Ya existe una conversación abierta
-            #chat_id = conversacion_abierta.get('chat_id')
-            #logging.info(f"PASO 3: Conversación abierta encontrada: {chat_id}")
-            logging.info(f"PASO 3: Conversación abierta encontrada: {conversacion_abierta}")
-            logging.info(f"PASO 3: Enviando mensaje a conversación existente... ")
-
-            #resultado_envio = enviar_mensaje_a_conversacion(chat_id, mensaje)
-            resultado_envio = enviar_mensaje_a_conversacion(conversacion_abierta, mensaje_formateado)
-
-            if not resultado_envio:
-                logging.error(f"PASO 3: Error al enviar mensaje a conversación: {chat_id}")
-                return jsonify({
-                    "error": "Failed to send message",
-                    "chat_id": chat_id
-                }),500
+        # candado por telefono (dos mensajes seguidos no deben crear dos conversaciones) y luego el
+        # carril de prioridad: quien espera el candado no ocupa un cupo upstream mientras tanto
+        prioridad = clasificar_prioridad(mensaje, tag_name)
+        with candado_estado(portal_actual().clave(f"lock:tel:{clave_telefono}"), ttl=60, espera=15), carril_prioridad(prioridad):
+            #========================================================
+            # Paso 3: Buscar conversaciones abiertas
+            #========================================================
+            logging.info(f"PASO 2: buscando conversación abierta... ")
+            #conversacion_abierta = buscar_conversacion_abierta_por_visitor(visitor_id)
+            # primero el mapa local (lo mantiene el reconciliador), solo si no esta se lista en Zoho
+            conversacion_abierta = conversacion_local(clave_telefono)
+            desde_mapa_local = bool(conversacion_abierta)
+            if not conversacion_abierta:
+                conversacion_abierta = buscar_conversacion_abierta_por_visitor(telefono, clave_telefono)
+                guardar_conversacion_local(clave_telefono, conversacion_abierta)
+
+            if presupuesto_agotado():
+                # sin tiempo no se crea ni se envia (se evitaria un duplicado si App A reintenta)
+                logging.error(f"PASO 2: Presupuesto agotado tras la busqueda: {resumen_presupuesto()}")
+                return respuesta_plazo_agotado(telefono)
+
+            chat_id = None
+            #========================================================
+            # Paso 4: Enviar mensaje a conversación existente o crear nueva
+            #========================================================
+            if conversacion_abierta:
+                #caso A: Ya existe una conversación abierta
+                #chat_id = conversacion_abierta.get('chat_id')
+                #logging.info(f"PASO 3: Conversación abierta encontrada: {chat_id}")
+                logging.info(f"PASO 3: Conversación abierta encontrada: {conversacion_abierta}")
+                logging.info(f"PASO 3: Enviando mensaje a conversación existente... ")
+
+                #resultado_envio = enviar_mensaje_a_conversacion(chat_id, mensaje)
+                resultado_envio = enviar_mensaje_a_conversacion(conversacion_abierta, mensaje_formateado)
+
+                if not resultado_envio and desde_mapa_local:
+                    # el mapa local estaba desactualizado (conversación cerrada), se consulta a Zoho
+                    logging.info(f"PASO 3: La conversación {conversacion_abierta} del mapa local fallo, buscando en Zoho...")
+                    olvidar_conversacion_local(clave_telefono, conversacion_abierta)
+                    conversacion_abierta = buscar_conversacion_abierta_por_visitor(telefono, clave_telefono, refrescar=True)
+                    guardar_conversacion_local(clave_telefono, conversacion_abierta)
+                    if conversacion_abierta:
+                        resultado_envio = enviar_mensaje_a_conversacion(conversacion_abierta, mensaje_formateado)
+                    elif ZOHO_LAZY_CONVERSATIONS and not es_escalacion(mensaje, tag_name):
+                        # el agente cerro la conversación: sin escalación no se abre otra
+                        return diferir_mensaje(telefono, clave_telefono, mensaje_individual)
+
+                if not resultado_envio and not conversacion_abierta and not presupuesto_agotado():
+                    resultado = crear_conversacion_con_visitante(visitor_id, telefono, mensaje_formateado)
+                    if creacion_exitosa(resultado) and resultado.get('conversacion_id'):
+                        guardar_conversacion_local(clave_telefono, resultado['conversacion_id'])
+                    resultado_envio = creacion_exitosa(resultado)
+
+                if not resultado_envio and presupuesto_agotado():
+                    logging.error(f"PASO 3: Presupuesto agotado enviando el mensaje: {resumen_presupuesto()}")
+                    return respuesta_plazo_agotado(telefono)
+
+                if not resultado_envio:
+                    logging.error(f"PASO 3: Error al enviar mensaje a conversación: {chat_id}")
+                    return jsonify({
+                        "error": "Failed to send message",
+                        "chat_id": chat_id
+                    }),500
             
-            logging.info(f"PASO 3: Mensaje Enviando exitosamente a: {conversacion_abierta} ")
-        else:
-            #Caso B: No existe conversación, crear nueva
-            logging.info(f"PASO 3: No hay conversación abierta ")
-            logging.info(f"PASO 3: Creando Nueva Conversación...")
-
-            resultado = crear_conversacion_con_visitante(visitor_id, telefono, mensaje_formateado)
+                logging.info(f"PASO 3: Mensaje Enviando exitosamente a: {conversacion_abierta} ")
+                # si la conversación se cerro y se creo otra, conversacion_abierta quedo en None
+                ESTADISTICAS.contar("mensajes_salida:zoho", "conversaciones_reutilizadas" if conversacion_abierta else "conversaciones_creadas")
+            else:
+                #Caso B: No existe conversación, crear nueva
+                logging.info(f"PASO 3: No hay conversación abierta ")
+                logging.info(f"PASO 3: Creando Nueva Conversación...")
+
+                resultado = crear_conversacion_con_visitante(visitor_id, telefono, mensaje_formateado)
+                if creacion_exitosa(resultado) and resultado.get('conversacion_id'):
+                    guardar_conversacion_local(clave_telefono, resultado['conversacion_id'])
             
-            if not resultado:
-                logging.error(f"PASO 3: Error al crear conversación...")
-
-                return jsonify({
-                    "error": "Failed to create conversation",
-                    "visitor_id": visitor_id
-                }),500
+                if not creacion_exitosa(resultado) and presupuesto_agotado():
+                    logging.error(f"PASO 3: Presupuesto agotado creando la conversación: {resumen_presupuesto()}")
+                    return respuesta_plazo_agotado(telefono)
+
+                if not creacion_exitosa(resultado):
+                    logging.error(f"PASO 3: Error al crear conversación...")
+
+                    return jsonify({
+                        "error": "Failed to create conversation",
+                        "visitor_id": visitor_id
+                    }),500
+                ESTADISTICAS.contar("mensajes_salida:zoho", "conversaciones_creadas")
             
-            #chat_id = resultado['chat_id']
-            #logging.error(f"PASO 3: Nueva Conversación creada: {chat_id}")
+                #chat_id = resultado['chat_id']
+                #logging.error(f"PASO 3: Nueva Conversación creada: {chat_id}")
+
+            if ZOHO_LAZY_CONVERSATIONS:
+                descartar_transcripcion(clave_telefono, len(transcripcion))
+                marcar_materializada(clave_telefono)
 
         #========================================================
         # Paso 5: Respuesta exitosa
@@ -894,6 +2972,12 @@ def from_waba():
             "action": "conversation_exists" if conversacion_abierta else "conversation_created"
         }), 200
 
+    except PresupuestoAgotado as e:
+        logging.error(f"from-waba: {e}: {resumen_presupuesto()}")
+        return respuesta_plazo_agotado(telefono)
+    except SinCupoUpstream as e:
+        logging.warning(f"from-waba: {e}")
+        return respuesta_saturado(503, "priority_queue_timeout")
     except Exception as e:
         logging.error(f"from-waba: Error Critico en form-waba: {str(e)}")
         import traceback
@@ -908,16 +2992,35 @@ def from_waba():
 
 #Envío de Mensajes desde Zoho - Whatsapp
 
+def liberar_dedupe(clave_dedupe):
+    if not clave_dedupe:
+        return
+    try:
+        ESTADO.desmarcar(clave_dedupe)
+    except Exception as e:
+        logging.error(f"from-zoho: No se pudo liberar el dedupe {clave_dedupe} -> {e}")
+
 @app.route('/api/from-zoho', methods=['POST'])
+@app.route('/t/<portal>/api/from-zoho', methods=['POST'])
+@con_admision("from_zoho")
+@con_plazo(ZOHO_DEADLINE_SECONDS)
 def from_zoho():
     """
     Este endpoint, recibo las respuestas enviadas al webhooks de zoho, cuando un agente responde
     """
     try:
-        zoho_data = request.json
-        logging.info(f"from-zoho: Webhook recibida de Zoho: {zoho_data}")
+        zoho_data = request.get_json(silent=True)
+        logging.info(f"from-zoho: Webhook recibida de Zoho: {resumen_log(zoho_data)}")
 
-        event_type = zoho_data.get('event')
+        try:
+            campos = ESQUEMA_ZOHO.extraer(zoho_data)
+        except ErrorPayload as e:
+            logging.error(f"from-zoho: Payload invalido: {e}")
+            return jsonify({"error": "Invalid payload", "details": e.errores}), 400
+
+        capturar("zoho", campos)
+        event_type = campos["event"]
+        ESTADISTICAS.contar("webhooks_zoho")
         if event_type != "conversation.operator.replied":
             logging.warning(f"Evento ignorado porque no es una respuesta de operador: '{event_type}'")
             return {"status": "evento ignorado"}, 200
@@ -942,35 +3045,44 @@ def from_zoho():
             logging.info(f"Eco de mensaje de bot detectado. Se ignora para evitar bucle...")
             return {"status":"eco de bot ignorado"}, 200
         """
-        main_entity = zoho_data.get("entity", {})
-        message_info = main_entity.get("message", {}) # Obtenemos el diccionario 'message' completo
-
-        # Extraemos los datos del diccionario 'message_info'
-        message_text = message_info.get("text")
-        sender_name = message_info.get("sender", {}).get("name")
+        # Zoho reintenta los webhooks, un mismo mensaje solo se reenvia una vez a App A
+        # la marca se toma antes de reenviar (un reintento simultaneo no pasa) y se libera si el reenvio falla
+        message_id = campos["message_id"]
+        clave_dedupe = portal_actual().clave(f"dedupe:zoho:{message_id}") if message_id else None
+        if clave_dedupe and not ESTADO.marcar_una_vez(clave_dedupe, DEDUPE_TTL):
+            logging.info(f"from-zoho: Webhook duplicado para el mensaje {message_id}. Se ignora.")
+            ESTADISTICAS.contar("duplicados_zoho")
+            return {"status": "duplicado ignorado"}, 200
+
+        # Datos extraidos por el esquema (entity.message.text, entity.message.sender.name)
+        message_text = campos["message_text"] or ""
+        sender_name = campos["sender_name"]
 
         # Inicio lógica anti-bucle
         # Se añade 'message_text and' para evitar errores si el mensaje está vacío
         if sender_name == "TicAll-Bot" and message_text and message_text.strip().startswith("[🤖 Bot]:"):
             logging.info("Eco de mensaje de bot detectado. Ignorando para evitar segundo envío.")
+            ESTADISTICAS.contar("ecos_suprimidos")
             return {"status": "eco de bot ignorado"}, 200
         
         #No muestra redundancia en el chat que esta en el whatsapp
         if message_text.strip().startswith("[🤖 Bot]:") or message_text.strip().startswith("[👤 Usuario]:"):
             logging.info(f"Eco de mensaje de bot detectado. Se ignora para evitar bucle...")
+            ESTADISTICAS.contar("ecos_suprimidos")
             return {"status":"eco de bot ignorado"}, 200
 
         
-        visitor_info = main_entity.get("visitor", {})
-        visitor_phone = visitor_info.get("phone")
+        visitor_phone = campos["visitor_phone"]
 
         if not message_text or not visitor_phone:
             logging.error(f"Faltan datos en la webhook tras procesar 'entity': Mensaje='{message_text}', Telefono='{visitor_phone}'")
             return {"status": "datos incompletos"}, 400
 
+        if ZOHO_LAZY_CONVERSATIONS:
+            # un agente humano ya esta atendiendo, no se vuelve a guardar en buffer
+            marcar_materializada(limpiar_telefono(visitor_phone))
 
-
-            
+        ESTADISTICAS.contar("mensajes_entrada", "mensajes_entrada:agente")
         payload_for_app_a = {
             "phone_number": visitor_phone,
             "message": message_text,
@@ -978,15 +3090,28 @@ def from_zoho():
         }
 
         logging.info(f"Payload que App B va a enviar a App A: {payload_for_app_a}")
-        url = f"{APP_A_URL}/api/envio_whatsapp"
+        url = f"{portal_actual().app_a_url}/api/envio_whatsapp"
         
-        response = requests.post(url, json=payload_for_app_a, timeout=20)
-        
-        logging.info(f"Respuesta recibida de App A: Status={response.status_code}, Body='{response.text}'")
-        response.raise_for_status()
+        try:
+            with carril_prioridad("agente"), span("forward"):
+                response = HTTP.post(url, json=payload_for_app_a, timeout=20)
+
+            logging.info(f"Respuesta recibida de App A: Status={response.status_code}, Body='{response.text}'")
+            response.raise_for_status()
+        except Exception:
+            # el mensaje no llego a App A: el reintento de Zoho no debe quedar como duplicado
+            liberar_dedupe(clave_dedupe)
+            raise
+        ESTADISTICAS.contar("mensajes_salida:app_a")
         
         return {"status": "enviado a App A"}, 200
 
+    except PresupuestoAgotado as e:
+        logging.error(f"from-zoho: {e}: {resumen_presupuesto()}")
+        return respuesta_plazo_agotado(visitor_phone)
+    except SinCupoUpstream as e:
+        logging.warning(f"from-zoho: {e}")
+        return respuesta_saturado(503, "priority_queue_timeout")
     except requests.exceptions.RequestException as e:
         logging.error(f"Error de CONEXIÓN al llamar a App A: {e}")
         return {"status": "error de conexión"}, 500
@@ -998,6 +3123,8 @@ def from_zoho():
 # GET verification endpoint for Zoho webhook subscription
 # -----------------------
 @app.route("/webhook", methods=["GET"])
+@app.route("/t/<portal>/webhook", methods=["GET"])
+@con_admision("salud")
 def webhook_verify():
     token = request.args.get("verify_token")
     if token == VERIFY_TOKEN:
@@ -1016,6 +3143,7 @@ def debug_token():
 # Verify endpoint for app health
 # -----------------------
 @app.route("/verify", methods=["GET"])
+@con_admision("salud")
 def verify():
     token = request.args.get("token")
     if token == VERIFY_TOKEN:
@@ -1024,6 +3152,7 @@ def verify():
 #________________________________________________________________________________________
 
 if __name__=="__main__":
+    iniciar_app()
     #port = int(os.environ.get("PORT",5000))
     app.run(host='0.0.0.0', port=5000, debug=False)
 #________________________________________________________________________________________
\ No newline at end of file
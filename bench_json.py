@@ -0,0 +1,99 @@
+"""
+Microbenchmark del parseo y validación de los webhooks
+
+Mide por request el costo de:
+- parsear el cuerpo JSON (json estandar vs ProveedorJSON de la app, que usa orjson si esta instalado)
+- extraer los campos con los .get() encadenados originales vs los esquemas precompilados
+- rechazar un payload malformado
+- el ciclo completo dentro de Flask (request.get_json + esquema)
+
+Uso: python bench_json.py [iteraciones]
+"""
+import sys
+import json as json_std
+import timeit
+
+import app
+
+PAYLOAD_WABA = {
+    "user_id": "573001234567",
+    "message": "Hola, quiero información sobre micropigmentación de cejas",
+    "tag": "soporte_urgente"
+}
+
+PAYLOAD_ZOHO = {
+    "event": "conversation.operator.replied",
+    "entity": {
+        "id": "1234567890123",
+        "message": {
+            "id": "987654321",
+            "text": "Hola, con gusto te ayudo. ¿Qué día te queda bien para la cita?",
+            "sender": {"name": "Laura", "id": "5566", "type": "operator"},
+            "time": "1760000000000"
+        },
+        "visitor": {"phone": "573001234567", "name": "Visitante 573001234567", "id": "whatsapp_573001234567"},
+        "chat_status": {"status_key": "open", "state": 2},
+        "department": {"id": "11", "name": "Ventas"},
+        "tags": ["soporte_urgente"] * 5
+    }
+}
+
+def extraer_waba_original(data):
+    telefono = data.get('user_id') or data.get('phone')
+    mensaje = data.get('message') or data.get('text')
+    tag_name = data.get("tag", "soporte_urgente")
+    return telefono, mensaje, tag_name
+
+def extraer_zoho_original(data):
+    main_entity = data.get("entity", {})
+    message_info = main_entity.get("message", {})
+    return (
+        data.get('event'),
+        message_info.get("id"),
+        message_info.get("text"),
+        message_info.get("sender", {}).get("name"),
+        main_entity.get("visitor", {}).get("phone")
+    )
+
+def rechazar_malformado(cuerpo):
+    try:
+        app.ESQUEMA_WABA.extraer(app.app.json.loads(cuerpo))
+    except (ValueError, app.ErrorPayload):
+        return True
+    return False
+
+def ciclo_flask(cuerpo, esquema):
+    with app.app.test_request_context("/api/from-zoho", method="POST", data=cuerpo, content_type="application/json"):
+        esquema.extraer(app.request.get_json(silent=True))
+
+def medir(nombre, funcion, iteraciones):
+    total = timeit.timeit(funcion, number=iteraciones)
+    print(f"{nombre:<50} {total / iteraciones * 1e6:9.2f} us/op")
+
+def main():
+    iteraciones = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    proveedor = app.app.json
+    motor = "orjson" if app.orjson else "json estandar"
+    cuerpo_waba = json_std.dumps(PAYLOAD_WABA).encode("utf-8")
+    cuerpo_zoho = json_std.dumps(PAYLOAD_ZOHO).encode("utf-8")
+    malformado = b'{"user_id": "573001234567", "message": '
+
+    print(f"iteraciones={iteraciones}, ProveedorJSON usa {motor}\n")
+    medir("json.loads waba (estandar)", lambda: json_std.loads(cuerpo_waba), iteraciones)
+    medir(f"ProveedorJSON.loads waba ({motor})", lambda: proveedor.loads(cuerpo_waba), iteraciones)
+    medir("json.loads zoho (estandar)", lambda: json_std.loads(cuerpo_zoho), iteraciones)
+    medir(f"ProveedorJSON.loads zoho ({motor})", lambda: proveedor.loads(cuerpo_zoho), iteraciones)
+    print()
+    medir(".get() encadenados waba", lambda: extraer_waba_original(PAYLOAD_WABA), iteraciones)
+    medir("ESQUEMA_WABA.extraer", lambda: app.ESQUEMA_WABA.extraer(PAYLOAD_WABA), iteraciones)
+    medir(".get() encadenados zoho", lambda: extraer_zoho_original(PAYLOAD_ZOHO), iteraciones)
+    medir("ESQUEMA_ZOHO.extraer", lambda: app.ESQUEMA_ZOHO.extraer(PAYLOAD_ZOHO), iteraciones)
+    medir("rechazo de payload malformado", lambda: rechazar_malformado(malformado), iteraciones)
+    print()
+    medir("Flask get_json + ESQUEMA_ZOHO (por request)", lambda: ciclo_flask(cuerpo_zoho, app.ESQUEMA_ZOHO), iteraciones // 10)
+    medir("json.dumps log del payload zoho (estandar)", lambda: json_std.dumps(PAYLOAD_ZOHO), iteraciones)
+    with app.app.app_context():
+        medir(f"resumen_log del payload zoho ({motor})", lambda: app.resumen_log(PAYLOAD_ZOHO), iteraciones)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Cache de lecturas GET a Zoho (GET condicionales) para SesionTrazada
+
+Los GET a /visitors y /conversations suelen repetirse con los mismos datos en pocos segundos.
+Cada respuesta 200 se guarda (LRU acotada por entradas y bytes) con su TTL por coleccion; vencido
+el TTL se revalida con If-None-Match / If-Modified-Since si Zoho entrego ETag / Last-Modified (304
+= se reutiliza el cuerpo). GETs identicos simultaneos se unen en una sola llamada. Un POST exitoso a
+una coleccion (crear visitante o conversación) borra lo guardado de esa coleccion y sube su
+generación: un GET que ya estaba en vuelo entrega su respuesta pero no la guarda. Quien necesite
+el dato fresco envia "Cache-Control: no-cache". El JSON parseado se comparte: es de solo lectura.
+
+Uso:
+    cache = CacheHTTP(["https://salesiq.zoho.com/api/v2/portal/"], 5, "conversations:2", 512, 8 * 1024 * 1024)
+    respuesta = cache.obtener(url, opciones, lambda opciones: sesion.request("GET", url, **opciones))
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+
+def _coleccion(url):
+    return urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+
+class RespuestaCacheada(requests.Response):
+    """
+    Response construida desde una entrada de la cache, json() no vuelve a parsear
+    """
+    def json(self, **kwargs):
+        return self._entrada.json()
+
+class _EntradaCache:
+    def __init__(self, respuesta, ttl, cargar_json):
+        self.status_code = respuesta.status_code
+        self.contenido = respuesta.content
+        self.headers = dict(respuesta.headers)
+        self.url = respuesta.url
+        self.encoding = respuesta.encoding
+        self.reason = respuesta.reason
+        self.etag = respuesta.headers.get("ETag")
+        self.last_modified = respuesta.headers.get("Last-Modified")
+        self.coleccion = _coleccion(respuesta.url or "")
+        self.tamano = len(self.contenido or b"")
+        self.expira = time.monotonic() + ttl
+        self._cargar_json = cargar_json
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = self._cargar_json(self.contenido)
+        return self._json
+
+    def respuesta(self):
+        copia = RespuestaCacheada()
+        copia._entrada = self
+        copia.status_code = self.status_code
+        copia._content = self.contenido
+        copia.headers = requests.structures.CaseInsensitiveDict(self.headers)
+        copia.url = self.url
+        copia.encoding = self.encoding
+        copia.reason = self.reason
+        return copia
+
+class _Vuelo:
+    """
+    GET en curso al que se unen los requests identicos
+    """
+    def __init__(self):
+        self.listo = threading.Event()
+        self.resultado = None
+        self.error = None
+
+class CacheHTTP:
+    def __init__(self, prefijos, ttl, ttls, max_entradas, max_bytes, cargar_json=json.loads):
+        self.prefijos = tuple(prefijos)
+        self.ttl = ttl
+        self.ttls = {}
+        for parte in ttls.split(","):
+            if ":" in parte:
+                coleccion, segundos = parte.split(":", 1)
+                self.ttls[coleccion.strip()] = float(segundos)
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.cargar_json = cargar_json
+        self._lock = threading.Lock()
+        self._entradas = OrderedDict()
+        self._vuelos = {}
+        self._generaciones = {}        # coleccion -> cuantas veces se invalido
+        self.bytes = 0
+        self.aciertos = 0
+        self.revalidaciones = 0
+        self.fallos = 0
+        self.coalescidas = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+
+    def ttl_para(self, url):
+        return self.ttls.get(_coleccion(url), self.ttl)
+
+    def aplica(self, url, opciones):
+        return (
+            url.startswith(self.prefijos)
+            and self.ttl_para(url) > 0
+            and not opciones.get("json")
+            and not opciones.get("data")
+            and not opciones.get("stream")
+        )
+
+    def _clave(self, url, params):
+        return (url, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())))
+
+    def _guardar(self, clave, entrada):
+        anterior = self._entradas.pop(clave, None)
+        if anterior:
+            self.bytes -= anterior.tamano
+        if entrada.tamano > self.max_bytes:
+            return
+        self._entradas[clave] = entrada
+        self.bytes += entrada.tamano
+        while len(self._entradas) > self.max_entradas or self.bytes > self.max_bytes:
+            _, vieja = self._entradas.popitem(last=False)
+            self.bytes -= vieja.tamano
+            self.desalojos += 1
+
+    def obtener(self, url, opciones, enviar):
+        clave = self._clave(url, opciones.get("params"))
+        sin_cache = "no-cache" in str((opciones.get("headers") or {}).get("Cache-Control", ""))
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada and not sin_cache and entrada.expira > time.monotonic():
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return entrada.respuesta()
+            vuelo = self._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._vuelos[clave] = _Vuelo()
+                generacion = self._generaciones.get(_coleccion(url), 0)
+            else:
+                self.coalescidas += 1
+
+        if not lider:
+            # el timeout ya viene recortado al presupuesto del request (SesionTrazada)
+            if not vuelo.listo.wait(opciones.get("timeout")):
+                raise requests.exceptions.Timeout(f"cache: vencio la espera del GET coalescido a {url}")
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.resultado()
+
+        try:
+            headers = dict(opciones.get("headers") or {})
+            if entrada and entrada.etag:
+                headers["If-None-Match"] = entrada.etag
+            if entrada and entrada.last_modified:
+                headers["If-Modified-Since"] = entrada.last_modified
+            respuesta = enviar({**opciones, "headers": headers})
+
+            with self._lock:
+                # si una escritura invalido la coleccion durante el GET, la respuesta puede ser
+                # anterior a esa escritura: se entrega pero no se guarda
+                vigente = self._generaciones.get(_coleccion(url), 0) == generacion
+                if respuesta.status_code == 304 and entrada:
+                    self.revalidaciones += 1
+                    entrada.expira = time.monotonic() + self.ttl_para(url)
+                    if vigente and clave not in self._entradas:
+                        self._guardar(clave, entrada)
+                    vuelo.resultado = entrada.respuesta
+                elif respuesta.status_code == 200:
+                    self.fallos += 1
+                    nueva = _EntradaCache(respuesta, self.ttl_para(url), self.cargar_json)
+                    if vigente:
+                        self._guardar(clave, nueva)
+                    vuelo.resultado = nueva.respuesta
+                else:
+                    self.fallos += 1
+                    vuelo.resultado = lambda: respuesta
+            return vuelo.resultado()
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._lock:
+                # invalidar() pudo haberlo quitado y otro lider ya estar en vuelo con la misma clave
+                if self._vuelos.get(clave) is vuelo:
+                    del self._vuelos[clave]
+            vuelo.listo.set()
+
+    def invalidar(self, url):
+        """
+        Una escritura exitosa a la coleccion (ej: POST /conversations) borra sus lecturas guardadas,
+        sube su generación (los GET en curso no guardan lo que traigan) y suelta esos GET en curso
+        para que los siguientes no se unan a una lectura anterior a la escritura
+        """
+        coleccion = _coleccion(url)
+        if coleccion not in ("visitors", "conversations"):
+            return
+        with self._lock:
+            self._generaciones[coleccion] = self._generaciones.get(coleccion, 0) + 1
+            for clave in [c for c, entrada in self._entradas.items() if entrada.coleccion == coleccion]:
+                self.bytes -= self._entradas.pop(clave).tamano
+                self.invalidaciones += 1
+            for clave in [c for c in self._vuelos if _coleccion(c[0]) == coleccion]:
+                del self._vuelos[clave]
+
+    def metricas(self):
+        with self._lock:
+            consultas = self.aciertos + self.revalidaciones + self.fallos
+            return {
+                "aciertos": self.aciertos,
+                "revalidaciones": self.revalidaciones,
+                "fallos": self.fallos,
+                "coalescidas": self.coalescidas,
+                "tasa_aciertos": round((self.aciertos + self.revalidaciones) / consultas, 3) if consultas else 0,
+                "entradas": len(self._entradas),
+                "bytes": self.bytes,
+                "desalojos": self.desalojos,
+                "invalidaciones": self.invalidaciones
+            }
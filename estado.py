@@ -0,0 +1,315 @@
+"""
+Estado compartido por los workers / instancias del puente WhatsApp <-> Zoho
+
+Todo el estado que deben compartir varios workers de gunicorn o varias instancias de Render
+pasa por un backend de estado. Los valores siempre son str, quien los usa se encarga de serializar.
+- EstadoMemoria: dentro del proceso (comportamiento original, un solo worker)
+- EstadoSQLite: archivo local, sirve para varios workers en la misma maquina
+- EstadoRedis: cualquier servidor que hable el protocolo de Redis (varias instancias)
+
+Uso:
+    ESTADO = crear_backend_estado(os.getenv("STATE_BACKEND_URL", "memoria"))
+"""
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+class ErrorEstado(RuntimeError):
+    """Error del backend de estado compartido"""
+
+class EstadoBase:
+    """
+    Operaciones comunes, las implementaciones solo definen get/set/delete/cas/cas_borrar
+    """
+    def adquirir_lease(self, clave, dueno, ttl):
+        """
+        Toma el lease si esta libre o lo renueva si ya es del mismo dueño, retorna True si quedo tomado
+        """
+        return self.cas(clave, None, dueno, ttl) or self.cas(clave, dueno, dueno, ttl)
+
+    def liberar_lease(self, clave, dueno):
+        """
+        Libera el lease solo si sigue siendo del dueño (si vencio y lo tomo otro no se toca)
+        """
+        return self.cas_borrar(clave, dueno)
+
+    def marcar_una_vez(self, clave, ttl):
+        """
+        Retorna True solo la primera vez que se marca la clave dentro del ttl (dedupe)
+        """
+        return self.cas(clave, None, "1", ttl)
+
+    def desmarcar(self, clave):
+        """
+        Deshace marcar_una_vez, ej: el trabajo fallo y el reintento se debe procesar
+        """
+        self.delete(clave)
+
+class EstadoMemoria(EstadoBase):
+    """
+    Estado dentro del proceso, con vencimiento por clave
+    """
+    def __init__(self):
+        self._datos = {}            # clave -> (valor, expira_epoch o None)
+        self._lock = threading.Lock()
+        self._ultima_purga = 0
+
+    def _vigente(self, clave, ahora):
+        item = self._datos.get(clave)
+        if item and item[1] is not None and item[1] <= ahora:
+            del self._datos[clave]
+            return None
+        return item
+
+    def _purgar(self, ahora):
+        if ahora - self._ultima_purga < 60:
+            return
+        self._ultima_purga = ahora
+        for clave in [c for c, (_, expira) in self._datos.items() if expira is not None and expira <= ahora]:
+            del self._datos[clave]
+
+    def get(self, clave):
+        with self._lock:
+            item = self._vigente(clave, time.time())
+            return item[0] if item else None
+
+    def set(self, clave, valor, ttl=None):
+        ahora = time.time()
+        with self._lock:
+            self._purgar(ahora)
+            self._datos[clave] = (valor, ahora + ttl if ttl else None)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def cas(self, clave, esperado, nuevo, ttl=None):
+        ahora = time.time()
+        with self._lock:
+            item = self._vigente(clave, ahora)
+            actual = item[0] if item else None
+            if actual != esperado:
+                return False
+            self._purgar(ahora)
+            self._datos[clave] = (nuevo, ahora + ttl if ttl else None)
+            return True
+
+    def cas_borrar(self, clave, esperado):
+        with self._lock:
+            item = self._vigente(clave, time.time())
+            if not item or item[0] != esperado:
+                return False
+            del self._datos[clave]
+            return True
+
+class EstadoSQLite(EstadoBase):
+    """
+    Estado en un archivo SQLite, compartido por los procesos de la misma maquina
+    """
+    def __init__(self, ruta):
+        self._ruta = ruta
+        self._local = threading.local()
+        self._ultima_purga = 0
+        with self._conexion() as conexion:
+            conexion.execute("CREATE TABLE IF NOT EXISTS estado (clave TEXT PRIMARY KEY, valor TEXT, expira REAL)")
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = sqlite3.connect(self._ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            self._local.conexion = conexion
+        return conexion
+
+    @contextmanager
+    def _transaccion(self):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            yield conexion
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def _leer(self, conexion, clave, ahora):
+        fila = conexion.execute("SELECT valor, expira FROM estado WHERE clave = ?", (clave,)).fetchone()
+        if fila and fila[1] is not None and fila[1] <= ahora:
+            conexion.execute("DELETE FROM estado WHERE clave = ?", (clave,))
+            return None
+        return fila[0] if fila else None
+
+    def _escribir(self, conexion, clave, valor, ttl, ahora):
+        if ahora - self._ultima_purga >= 60:
+            self._ultima_purga = ahora
+            conexion.execute("DELETE FROM estado WHERE expira IS NOT NULL AND expira <= ?", (ahora,))
+        conexion.execute(
+            "INSERT OR REPLACE INTO estado (clave, valor, expira) VALUES (?, ?, ?)",
+            (clave, valor, ahora + ttl if ttl else None)
+        )
+
+    def get(self, clave):
+        # lectura sin transacción de escritura: las filas vencidas se filtran en la consulta
+        # (las borra la purga de _escribir), asi las lecturas no esperan el candado de escritura
+        fila = self._conexion().execute(
+            "SELECT valor FROM estado WHERE clave = ? AND (expira IS NULL OR expira > ?)", (clave, time.time())
+        ).fetchone()
+        return fila[0] if fila else None
+
+    def set(self, clave, valor, ttl=None):
+        with self._transaccion() as conexion:
+            self._escribir(conexion, clave, valor, ttl, time.time())
+
+    def delete(self, clave):
+        with self._transaccion() as conexion:
+            conexion.execute("DELETE FROM estado WHERE clave = ?", (clave,))
+
+    def cas(self, clave, esperado, nuevo, ttl=None):
+        ahora = time.time()
+        with self._transaccion() as conexion:
+            if self._leer(conexion, clave, ahora) != esperado:
+                return False
+            self._escribir(conexion, clave, nuevo, ttl, ahora)
+            return True
+
+    def cas_borrar(self, clave, esperado):
+        with self._transaccion() as conexion:
+            if self._leer(conexion, clave, time.time()) != esperado:
+                return False
+            conexion.execute("DELETE FROM estado WHERE clave = ?", (clave,))
+            return True
+
+class EstadoRedis(EstadoBase):
+    """
+    Estado en un servidor que hable el protocolo de Redis (RESP), sin dependencias extra.
+    Una conexión por hilo, se reconecta una vez si la conexión se cae.
+    """
+    _SCRIPT_CAS = (
+        "if redis.call('GET', KEYS[1]) == ARGV[1] then "
+        "if tonumber(ARGV[3]) > 0 then redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3]) "
+        "else redis.call('SET', KEYS[1], ARGV[2]) end return 1 end return 0"
+    )
+    _SCRIPT_CAS_BORRAR = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0"
+
+    def __init__(self, host, port=6379, db=0, password=None, timeout=5):
+        self._direccion = (host, port)
+        self._db = db
+        self._password = password
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def _conectar(self):
+        """
+        Abre la conexión y hace AUTH/SELECT, solo queda guardada si el saludo salio bien
+        """
+        sock = socket.create_connection(self._direccion, timeout=self._timeout)
+        conexion = (sock, sock.makefile("rb"))
+        try:
+            if self._password:
+                self._enviar(conexion, "AUTH", self._password)
+            if self._db:
+                self._enviar(conexion, "SELECT", self._db)
+        except BaseException:
+            sock.close()
+            raise
+        self._local.conexion = conexion
+        return conexion
+
+    def _cerrar(self):
+        conexion = getattr(self._local, "conexion", None)
+        self._local.conexion = None
+        if conexion:
+            try:
+                conexion[0].close()
+            except OSError:
+                pass
+
+    def _enviar(self, conexion, *args):
+        sock, lector = conexion
+        partes = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            dato = str(arg).encode("utf-8")
+            partes.append(f"${len(dato)}\r\n".encode() + dato + b"\r\n")
+        sock.sendall(b"".join(partes))
+        return self._leer_respuesta(lector)
+
+    def _leer_respuesta(self, lector):
+        linea = lector.readline()
+        if not linea:
+            raise ConnectionError("conexión cerrada por el servidor de estado")
+        tipo, resto = linea[:1], linea[1:-2].decode("utf-8")
+        if tipo == b"+":
+            return resto
+        if tipo == b"-":
+            raise ErrorEstado(resto)
+        if tipo == b":":
+            return int(resto)
+        if tipo == b"$":
+            largo = int(resto)
+            if largo < 0:
+                return None
+            return lector.read(largo + 2)[:-2].decode("utf-8")
+        if tipo == b"*":
+            largo = int(resto)
+            return None if largo < 0 else [self._leer_respuesta(lector) for _ in range(largo)]
+        raise ErrorEstado(f"respuesta RESP desconocida: {linea[:50]!r}")
+
+    def _comando(self, *args, idempotente=True):
+        """
+        Envia el comando, si la conexión se cae se reconecta y reintenta una vez. Los comandos no
+        idempotentes (SET NX, compare-and-set) solo se reintentan si la falla fue al conectar: una
+        vez enviados no se sabe si el servidor los aplico
+        """
+        for intento in (1, 2):
+            enviado = False
+            try:
+                conexion = getattr(self._local, "conexion", None) or self._conectar()
+                enviado = True
+                return self._enviar(conexion, *args)
+            except (OSError, ConnectionError):
+                self._cerrar()
+                if intento == 2 or (enviado and not idempotente):
+                    raise
+
+    def get(self, clave):
+        return self._comando("GET", clave)
+
+    def set(self, clave, valor, ttl=None):
+        if ttl:
+            self._comando("SET", clave, valor, "PX", int(ttl * 1000))
+        else:
+            self._comando("SET", clave, valor)
+
+    def delete(self, clave):
+        self._comando("DEL", clave)
+
+    def cas(self, clave, esperado, nuevo, ttl=None):
+        if esperado is None:
+            args = ["SET", clave, nuevo, "NX"]
+            if ttl:
+                args += ["PX", int(ttl * 1000)]
+            return self._comando(*args, idempotente=False) == "OK"
+        return self._comando("EVAL", self._SCRIPT_CAS, 1, clave, esperado, nuevo, int(ttl * 1000) if ttl else 0, idempotente=False) == 1
+
+    def cas_borrar(self, clave, esperado):
+        return self._comando("EVAL", self._SCRIPT_CAS_BORRAR, 1, clave, esperado, idempotente=False) == 1
+
+def crear_backend_estado(url):
+    """
+    Crea el backend de estado segun STATE_BACKEND_URL
+    """
+    if not url or url == "memoria":
+        return EstadoMemoria()
+
+    destino = urlparse(url)
+    if destino.scheme == "sqlite":
+        ruta = destino.path[1:] if destino.path.startswith("//") else destino.path
+        return EstadoSQLite(ruta or "estado.db")
+    if destino.scheme in ("redis", "tcp"):
+        db = int(destino.path.strip("/") or 0)
+        return EstadoRedis(destino.hostname or "localhost", destino.port or 6379, db, destino.password)
+
+    raise ValueError(f"STATE_BACKEND_URL no soportado: {url}")
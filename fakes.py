@@ -0,0 +1,506 @@
+"""
+Zoho SalesIQ y App A falsos para pruebas locales (soak.py, replay)
+
+Servidores HTTP en hilos, sin dependencias externas, que responden lo minimo que usa app.py:
+- Zoho:  POST /oauth/v2/token, GET /api/v2/<portal>/visitors, GET /api/v2/<portal>/conversations,
+         POST /api/v2/<portal>/conversations/<id>/messages, POST /api/v2/<portal>/conversations/<id>/tags,
+         POST /visitor/v2/<portal>/conversations
+- App A: POST /api/envio_whatsapp
+- Redis: servidor RESP minimo para el backend de estado (STATE_BACKEND_URL=redis://...)
+
+Los GET responden con ETag y 304 si el If-None-Match coincide.
+Cada respuesta puede llevar fallas inyectadas segun Fallas: latencia, 429, 5xx,
+200 con cuerpo vacio (el JSONDecodeError de response.json()) y conexiones reseteadas.
+
+Uso:
+    zoho = FakeZoho(Fallas(p_429=0.02)).iniciar()
+    app_a = FakeAppA().iniciar()
+    os.environ["ZOHO_SALESIQ_BASE"] = f"{zoho.url}/api/v2"
+    ...
+    zoho.detener(); app_a.detener()
+"""
+import os
+import json
+import hashlib
+import logging
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+import itertools
+from collections import Counter, OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class Fallas:
+    """
+    Probabilidades (0..1) de cada falla por request y rango de latencia en ms
+    """
+    def __init__(self, latencia_min_ms=5, latencia_max_ms=40, p_429=0.0, p_5xx=0.0, p_vacio=0.0, p_reset=0.0):
+        self.latencia_min_ms = latencia_min_ms
+        self.latencia_max_ms = latencia_max_ms
+        self.p_429 = p_429
+        self.p_5xx = p_5xx
+        self.p_vacio = p_vacio
+        self.p_reset = p_reset
+
+    @classmethod
+    def desde_texto(cls, texto):
+        """
+        'latencia=5-40,429=0.02,5xx=0.01,vacio=0.01,reset=0.005'
+        """
+        fallas = cls()
+        for parte in (texto or "").split(","):
+            if "=" not in parte:
+                continue
+            clave, valor = (x.strip() for x in parte.split("=", 1))
+            if clave == "latencia":
+                minimo, _, maximo = valor.partition("-")
+                fallas.latencia_min_ms = float(minimo)
+                fallas.latencia_max_ms = float(maximo or minimo)
+            elif clave in ("429", "5xx", "vacio", "reset"):
+                setattr(fallas, f"p_{clave}", float(valor))
+            else:
+                raise ValueError(f"falla desconocida: {clave}")
+        return fallas
+
+    def sortear(self):
+        """
+        Retorna la falla que toca en esta request (o None)
+        """
+        azar = random.random()
+        for nombre, probabilidad in (("reset", self.p_reset), ("429", self.p_429), ("5xx", self.p_5xx), ("vacio", self.p_vacio)):
+            if azar < probabilidad:
+                return nombre
+            azar -= probabilidad
+        return None
+
+class _Manejador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # silencioso: en una prueba de horas el log del servidor falso no aporta
+        pass
+
+    def _cuerpo(self):
+        largo = int(self.headers.get("Content-Length") or 0)
+        if not largo:
+            return {}
+        try:
+            return json.loads(self.rfile.read(largo) or b"{}")
+        except ValueError:
+            return {}
+
+    def _responder(self, status, data=None, headers=None):
+        cuerpo = b"" if data is None else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        for clave, valor in (headers or {}).items():
+            self.send_header(clave, valor)
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _resetear(self):
+        # SO_LINGER en 0: close() envia RST en lugar de FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        self.connection.close()
+        self.close_connection = True
+
+    def _atender(self, metodo):
+        servidor = self.server.fake
+        ruta = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(ruta.query).items()}
+        cuerpo = self._cuerpo()
+        nombre_ruta = servidor.nombre_ruta(metodo, ruta.path)
+        servidor.contar(nombre_ruta)
+        servidor.registrar(nombre_ruta, ruta.path, params, cuerpo, dict(self.headers))
+
+        fallas = servidor.fallas
+        time.sleep(random.uniform(fallas.latencia_min_ms, fallas.latencia_max_ms) / 1000)
+        falla = servidor.falla_forzada(nombre_ruta) or fallas.sortear()
+        if falla:
+            servidor.contar(f"falla_{falla}")
+        if falla == "reset":
+            return self._resetear()
+        if falla == "429":
+            return self._responder(429, {"error": {"code": 1015, "message": "rate limit"}}, {"Retry-After": "1"})
+        if falla == "5xx":
+            return self._responder(random.choice((500, 502, 503)), {"error": {"message": "falla inyectada"}})
+        if falla == "vacio":
+            return self._responder(200)
+
+        status, data = servidor.responder(metodo, ruta.path, params, cuerpo)
+        if metodo == "GET" and status == 200:
+            # lecturas con ETag, como Zoho: si no cambio se responde 304 sin cuerpo
+            etag = '"%s"' % hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+            if self.headers.get("If-None-Match") == etag:
+                servidor.contar("304")
+                return self._responder(304, headers={"ETag": etag})
+            return self._responder(status, data, {"ETag": etag})
+        self._responder(status, data)
+
+    def do_GET(self):
+        self._atender("GET")
+
+    def do_POST(self):
+        self._atender("POST")
+
+class _ServidorFalso:
+    """
+    Base de los servidores falsos: hilo propio, puerto efimero y contadores por ruta
+    """
+    def __init__(self, fallas=None, host="127.0.0.1", puerto=0):
+        self.fallas = fallas or Fallas()
+        self._servidor = ThreadingHTTPServer((host, puerto), _Manejador)
+        self._servidor.daemon_threads = True
+        self._servidor.fake = self
+        self._hilo = None
+        self._lock = threading.Lock()
+        self.llamadas = Counter()
+        self.recibidos = deque(maxlen=500)     # ultimos requests (ruta, cuerpo, headers) para las pruebas
+        self._forzadas = {}                    # nombre_ruta -> [falla, veces]
+
+    @property
+    def url(self):
+        host, puerto = self._servidor.server_address[:2]
+        return f"http://{host}:{puerto}"
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._servidor.serve_forever, name=type(self).__name__, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def contar(self, nombre):
+        with self._lock:
+            self.llamadas[nombre] += 1
+
+    def registrar(self, nombre_ruta, ruta, params, cuerpo, headers):
+        with self._lock:
+            self.recibidos.append({"ruta": nombre_ruta, "path": ruta, "params": params, "cuerpo": cuerpo, "headers": headers})
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.llamadas.clear()
+            self.recibidos.clear()
+            self._forzadas.clear()
+
+    def forzar(self, nombre_ruta, falla, veces=1):
+        """
+        Las proximas 'veces' llamadas a nombre_ruta fallan con 'falla' (reset, 429, 5xx, vacio)
+        """
+        with self._lock:
+            self._forzadas[nombre_ruta] = [falla, veces]
+
+    def falla_forzada(self, nombre_ruta):
+        with self._lock:
+            forzada = self._forzadas.get(nombre_ruta)
+            if not forzada:
+                return None
+            forzada[1] -= 1
+            if forzada[1] <= 0:
+                del self._forzadas[nombre_ruta]
+            return forzada[0]
+
+    def recibidos_en(self, nombre_ruta):
+        with self._lock:
+            return [r for r in self.recibidos if r["ruta"] == nombre_ruta]
+
+    def total_llamadas(self):
+        with self._lock:
+            return sum(v for k, v in self.llamadas.items() if not k.startswith("falla_") and k != "304")
+
+    def nombre_ruta(self, metodo, ruta):
+        return f"{metodo} {ruta}"
+
+    def responder(self, metodo, ruta, params, cuerpo):
+        return 404, {"error": {"message": f"ruta desconocida {metodo} {ruta}"}}
+
+class FakeZoho(_ServidorFalso):
+    """
+    Zoho SalesIQ en memoria: visitantes y conversaciones por telefono.
+    Guarda como maximo max_conversaciones (las mas viejas se cierran y se olvidan),
+    asi la memoria del falso no crece durante la prueba.
+    """
+    def __init__(self, fallas=None, max_conversaciones=5000, max_listado=200, **kwargs):
+        super().__init__(fallas, **kwargs)
+        self.max_conversaciones = max_conversaciones
+        self.max_listado = max_listado
+        self._ids = itertools.count(1_000_000)
+        self._conversaciones = OrderedDict()   # conv_id -> conversación
+        self._por_telefono = {}                # telefono -> conv_id abierta
+
+    def nombre_ruta(self, metodo, ruta):
+        partes = ruta.strip("/").split("/")
+        if ruta.endswith("/oauth/v2/token"):
+            return "token"
+        if partes[-1] in ("messages", "tags"):
+            return f"{metodo} conversations/{partes[-1]}"
+        if partes[0] == "visitor":
+            return f"{metodo} visitor/conversations"
+        return f"{metodo} {partes[-1]}"
+
+    def _nueva_conversacion(self, telefono):
+        conv_id = str(next(self._ids))
+        ahora = int(time.time() * 1000)
+        conv = {
+            "id": conv_id,
+            "visitor": {"phone": telefono, "id": f"whatsapp_{telefono.lstrip('+')}"},
+            "chat_status": {"status_key": "open"},
+            "last_modified_time": str(ahora)
+        }
+        self._conversaciones[conv_id] = conv
+        self._por_telefono[telefono] = conv_id
+        while len(self._conversaciones) > self.max_conversaciones:
+            _, vieja = self._conversaciones.popitem(last=False)
+            self._por_telefono.pop(vieja["visitor"]["phone"], None)
+        return conv
+
+    def cerrar_conversacion(self, telefono):
+        """
+        Simula que un agente cerro la conversación (el mapa local de la app queda viejo)
+        """
+        with self._lock:
+            conv_id = self._por_telefono.pop(telefono, None)
+            if conv_id and conv_id in self._conversaciones:
+                conv = self._conversaciones[conv_id]
+                conv["chat_status"] = {"status_key": "closed"}
+                conv["last_modified_time"] = str(int(time.time() * 1000))
+                self._conversaciones.move_to_end(conv_id)
+
+    def responder(self, metodo, ruta, params, cuerpo):
+        partes = ruta.strip("/").split("/")
+        if ruta.endswith("/oauth/v2/token"):
+            return 200, {"access_token": f"fake-{random.getrandbits(32):08x}", "expires_in": 3600, "token_type": "Bearer"}
+
+        with self._lock:
+            if metodo == "GET" and partes[-1] == "visitors":
+                visitantes = [c["visitor"] for c in list(self._conversaciones.values())[-self.max_listado:]]
+                return 200, {"data": visitantes}
+
+            if metodo == "GET" and partes[-1] == "conversations":
+                telefono = params.get("phone")
+                if telefono:
+                    conv_id = self._por_telefono.get(telefono)
+                    return 200, {"data": [self._conversaciones[conv_id]] if conv_id else []}
+                limite = int(params.get("limit", self.max_listado))
+                desde = int(params.get("from_index", 0))
+                despues = int(params.get("modified_after", 0) or 0)
+                lista = [c for c in self._conversaciones.values() if int(c["last_modified_time"]) > despues]
+                lista.sort(key=lambda c: int(c["last_modified_time"]))
+                return 200, {"data": lista[desde:desde + limite]}
+
+            if metodo == "POST" and partes[0] == "visitor" and partes[-1] == "conversations":
+                telefono = (cuerpo.get("visitor") or {}).get("phone") or ""
+                conv = self._nueva_conversacion(telefono)
+                return 200, {"id": conv["id"], "visitor": conv["visitor"], "data": conv}
+
+            if metodo == "POST" and partes[-1] == "messages":
+                conv = self._conversaciones.get(partes[-2])
+                if not conv or conv["chat_status"]["status_key"] != "open":
+                    return 400, {"error": {"code": 1018, "message": "conversation closed"}}
+                conv["last_modified_time"] = str(int(time.time() * 1000))
+                return 200, {"data": {"id": str(next(self._ids)), "text": cuerpo.get("text")}}
+
+            if metodo == "POST" and partes[-1] == "tags":
+                return 200, {"data": {"tag_ids": cuerpo.get("tag_ids", [])}}
+
+        return super().responder(metodo, ruta, params, cuerpo)
+
+class FakeAppA(_ServidorFalso):
+    """
+    App A (envio a WhatsApp): solo acepta POST /api/envio_whatsapp
+    """
+    def responder(self, metodo, ruta, params, cuerpo):
+        if metodo == "POST" and ruta == "/api/envio_whatsapp":
+            if not cuerpo.get("phone_number") or not cuerpo.get("message"):
+                return 400, {"status": "datos incompletos"}
+            return 200, {"status": "enviado"}
+        return super().responder(metodo, ruta, params, cuerpo)
+
+class _ManejadorRESP(socketserver.StreamRequestHandler):
+    def _leer_comando(self):
+        linea = self.rfile.readline()
+        if not linea:
+            return None
+        if not linea.startswith(b"*"):
+            raise ValueError(f"comando RESP invalido: {linea[:50]!r}")
+        args = []
+        for _ in range(int(linea[1:-2])):
+            largo = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(largo + 2)[:-2].decode("utf-8"))
+        return args
+
+    def handle(self):
+        servidor = self.server.fake
+        servidor.conectar(self.connection)
+        try:
+            while True:
+                try:
+                    args = self._leer_comando()
+                except (OSError, ValueError):
+                    return
+                if args is None:
+                    return
+                respuesta = servidor.ejecutar(args)
+                if servidor.sin_respuesta(args[0]):
+                    # el comando se ejecuto pero la conexión se cae antes de responder
+                    return
+                self.wfile.write(respuesta)
+        finally:
+            servidor.desconectar(self.connection)
+
+class FakeRedis:
+    """
+    Servidor RESP minimo en memoria (GET, SET NX/XX/PX/EX, DEL, PING, AUTH, SELECT y los dos
+    scripts EVAL de compare-and-set que envia estado.EstadoRedis), para probar el backend
+    redis sin un Redis real. cortar_conexiones() simula que el servidor cierra las conexiones y
+    perder_respuestas(comando, veces) que ejecuta el comando pero se cae antes de responder.
+    """
+    def __init__(self, host="127.0.0.1", puerto=0, password=None):
+        self.password = password
+        self._datos = {}            # clave -> (valor, expira_monotonic o None)
+        self._lock = threading.Lock()
+        self._conexiones = set()
+        self.comandos = Counter()
+        self._sin_respuesta = Counter()
+        self._servidor = socketserver.ThreadingTCPServer((host, puerto), _ManejadorRESP)
+        self._servidor.daemon_threads = True
+        self._servidor.fake = self
+
+    @property
+    def url(self):
+        host, puerto = self._servidor.server_address[:2]
+        return f"redis://{host}:{puerto}/0"
+
+    def iniciar(self):
+        threading.Thread(target=self._servidor.serve_forever, name="FakeRedis", daemon=True).start()
+        return self
+
+    def detener(self):
+        self.cortar_conexiones()
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    def conectar(self, conexion):
+        with self._lock:
+            self._conexiones.add(conexion)
+
+    def desconectar(self, conexion):
+        with self._lock:
+            self._conexiones.discard(conexion)
+
+    def cortar_conexiones(self):
+        with self._lock:
+            conexiones = list(self._conexiones)
+        for conexion in conexiones:
+            try:
+                conexion.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def perder_respuestas(self, comando, veces=1):
+        with self._lock:
+            self._sin_respuesta[comando.upper()] = veces
+
+    def sin_respuesta(self, comando):
+        with self._lock:
+            if self._sin_respuesta[comando.upper()] > 0:
+                self._sin_respuesta[comando.upper()] -= 1
+                return True
+            return False
+
+    @staticmethod
+    def _bulk(valor):
+        if valor is None:
+            return b"$-1\r\n"
+        dato = valor.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(dato), dato)
+
+    def _vigente(self, clave):
+        item = self._datos.get(clave)
+        if item and item[1] is not None and item[1] <= time.monotonic():
+            del self._datos[clave]
+            return None
+        return item[0] if item else None
+
+    def _set(self, clave, valor, px=None):
+        self._datos[clave] = (valor, time.monotonic() + px / 1000 if px else None)
+
+    def ejecutar(self, args):
+        comando = args[0].upper()
+        with self._lock:
+            self.comandos[comando] += 1
+            if comando == "PING":
+                return b"+PONG\r\n"
+            if comando == "AUTH":
+                return b"+OK\r\n" if args[1] == self.password else b"-WRONGPASS invalid password\r\n"
+            if comando == "SELECT":
+                return b"+OK\r\n"
+            if comando == "GET":
+                return self._bulk(self._vigente(args[1]))
+            if comando == "DEL":
+                borradas = sum(1 for clave in args[1:] if self._vigente(clave) is not None and self._datos.pop(clave))
+                return b":%d\r\n" % borradas
+            if comando == "SET":
+                clave, valor = args[1], args[2]
+                opciones = [a.upper() for a in args[3:]]
+                px = None
+                if "PX" in opciones:
+                    px = int(args[3 + opciones.index("PX") + 1])
+                elif "EX" in opciones:
+                    px = int(args[3 + opciones.index("EX") + 1]) * 1000
+                existe = self._vigente(clave) is not None
+                if ("NX" in opciones and existe) or ("XX" in opciones and not existe):
+                    return b"$-1\r\n"
+                self._set(clave, valor, px)
+                return b"+OK\r\n"
+            if comando == "EVAL":
+                script, clave, argv = args[1], args[3], args[4:]
+                if self._vigente(clave) != argv[0]:
+                    return b":0\r\n"
+                if "DEL" in script:
+                    del self._datos[clave]
+                else:
+                    self._set(clave, argv[1], int(argv[2]) or None)
+                return b":1\r\n"
+        return b"-ERR comando no soportado '%s'\r\n" % comando.encode("utf-8")
+
+def variables_entorno(zoho, app_a, portal="soak"):
+    """
+    Variables de entorno para apuntar app.py a los falsos (antes de importar app)
+    """
+    return {
+        "ZOHO_CLIENT_ID": "fake",
+        "ZOHO_CLIENT_SECRET": "fake",
+        "ZOHO_REFRESH_TOKEN": "fake",
+        "ZOHO_PORTAL_NAME": portal,
+        "ZOHO_SALESIQ_BASE": f"{zoho.url}/api/v2",
+        "ZOHO_VISITOR_BASE": f"{zoho.url}/visitor/v2",
+        "ZOHO_ACCOUNTS_URL": zoho.url,
+        "APP_A_URL": app_a.url
+    }
+
+def servir_app(zoho, app_a, nivel_log="WARNING", **entorno):
+    """
+    Importa app.py apuntando a los falsos y lo sirve en un puerto local en un hilo.
+    Retorna (modulo app, servidor werkzeug, url base)
+    """
+    os.environ.update(variables_entorno(zoho, app_a))
+    os.environ.setdefault("VERIFY_TOKEN", "fakes")
+    os.environ.update({clave: str(valor) for clave, valor in entorno.items()})
+
+    import app
+    from werkzeug.serving import make_server
+
+    logging.getLogger().setLevel(nivel_log.upper())
+    logging.getLogger("werkzeug").setLevel(nivel_log.upper())
+    servidor = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, name="app-local", daemon=True).start()
+    return app, servidor, f"http://127.0.0.1:{servidor.server_port}"
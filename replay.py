@@ -0,0 +1,210 @@
+"""
+Reenvio de una captura de trafico real (CAPTURE_PATH) con la escala de tiempo deseada
+
+Lee la captura JSONL que escribe app.py, reconstruye cada webhook (telefonos sinteticos a partir
+del hash, textos del mismo largo, mismos botones, ecos, duplicados y tags) y lo envia respetando
+los tiempos originales divididos por --velocidad (1x a 50x).
+
+Por defecto levanta app.py local contra Zoho y App A falsos (fakes.py) y reporta:
+- percentiles de latencia por endpoint y en total
+- amplificación: llamadas a Zoho / App A por webhook reenviado, por ruta
+- atraso del reenvio (si el cliente no alcanza la velocidad pedida)
+
+Con --url se envia a una instancia ya levantada (sin amplificación, no se ven sus llamadas).
+Todos los portales de la captura se envian al portal por defecto.
+
+Uso:
+    CAPTURE_PATH=captura.jsonl CAPTURE_SALT=<secreto> gunicorn app:app       # en producción, capturar
+    python replay.py captura.jsonl --velocidad 10
+    python replay.py captura.jsonl --velocidad 50 --fallas "latencia=20-80,429=0.01" --reporte replay.json
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import fakes
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description="Reenvia una captura de trafico contra app.py local")
+    parser.add_argument("captura", help="archivo JSONL escrito con CAPTURE_PATH")
+    parser.add_argument("--velocidad", type=float, default=1.0, help="escala de tiempo, 1 a 50 (default 1x)")
+    parser.add_argument("--url", help="instancia ya levantada (por defecto app.py local con falsos)")
+    parser.add_argument("--hilos", type=int, default=64, help="requests simultaneos maximos")
+    parser.add_argument("--limite", type=int, help="reenviar solo los primeros N registros")
+    parser.add_argument("--fallas", default="latencia=5-40", help="fallas de los falsos (ver fakes.Fallas)")
+    parser.add_argument("--log-level", default="ERROR", help="nivel de log de app.py local")
+    parser.add_argument("--reporte", help="ruta para guardar el reporte en JSON")
+    argumentos = parser.parse_args()
+    if not 1 <= argumentos.velocidad <= 50:
+        parser.error("--velocidad debe estar entre 1 y 50")
+    return argumentos
+
+def leer_captura(ruta, limite=None):
+    registros = []
+    with open(ruta, encoding="utf-8") as archivo:
+        for linea in archivo:
+            if linea.strip():
+                registros.append(json.loads(linea))
+            if limite and len(registros) >= limite:
+                break
+    registros.sort(key=lambda r: r["ts"])
+    return registros
+
+def telefono_sintetico(hash_telefono):
+    # mismo hash -> mismo telefono colombiano valido (+57 3xx xxx xxxx)
+    if not hash_telefono:
+        return None
+    return f"+573{int(hash_telefono[:12], 16) % 10**9:09d}"
+
+def texto_sintetico(registro):
+    if registro.get("boton"):
+        return registro["boton"]
+    prefijo = registro.get("prefijo", "")
+    relleno = max(registro.get("largo", 0) - len(prefijo), 1)
+    return f"{prefijo}{'x' * relleno}"
+
+def reconstruir(registro):
+    """
+    (ruta, payload) del webhook original a partir del registro sanitizado
+    """
+    if registro["e"] == "waba":
+        return "/api/from-waba", {
+            "user_id": telefono_sintetico(registro.get("tel")),
+            "message": texto_sintetico(registro),
+            "tag": registro.get("tag")
+        }
+    return "/api/from-zoho", {
+        "event": registro.get("ev"),
+        "entity": {
+            "message": {
+                "id": registro.get("id"),
+                "text": texto_sintetico(registro),
+                "sender": {"name": "TicAll-Bot" if registro.get("bot") else "Agente Replay"}
+            },
+            "visitor": {"phone": telefono_sintetico(registro.get("tel"))}
+        }
+    }
+
+def percentiles(valores):
+    if not valores:
+        return {}
+    ordenados = sorted(valores)
+    def p(q):
+        return round(ordenados[min(int(len(ordenados) * q), len(ordenados) - 1)], 2)
+    return {"n": len(ordenados), "p50": p(0.5), "p90": p(0.9), "p95": p(0.95), "p99": p(0.99), "max": round(ordenados[-1], 2)}
+
+class Reenvio:
+    def __init__(self, base_url, hilos):
+        self.base_url = base_url
+        self.pool = ThreadPoolExecutor(max_workers=hilos)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.status = Counter()
+        self.errores_cliente = 0
+        self.atrasos = []
+
+    def _sesion(self):
+        if not hasattr(self._local, "sesion"):
+            self._local.sesion = requests.Session()
+        return self._local.sesion
+
+    def _enviar(self, ruta, payload, programado):
+        inicio = time.perf_counter()
+        atraso = (time.monotonic() - programado) * 1000
+        try:
+            respuesta = self._sesion().post(f"{self.base_url}{ruta}", json=payload, headers={"X-Replay": "capture"}, timeout=60)
+            status = respuesta.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        latencia = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            self.atrasos.append(atraso)
+            if status is None:
+                self.errores_cliente += 1
+                return
+            self.status[f"{ruta} {status}"] += 1
+            self.latencias[ruta].append(latencia)
+
+    def ejecutar(self, registros, velocidad):
+        if not registros:
+            return 0.0
+        ts0 = registros[0]["ts"]
+        inicio = time.monotonic()
+        futuros = []
+        for registro in registros:
+            programado = inicio + (registro["ts"] - ts0) / 1000 / velocidad
+            espera = programado - time.monotonic()
+            if espera > 0:
+                time.sleep(espera)
+            ruta, payload = reconstruir(registro)
+            futuros.append(self.pool.submit(self._enviar, ruta, payload, programado))
+        for futuro in futuros:
+            futuro.result()
+        self.pool.shutdown()
+        return time.monotonic() - inicio
+
+def main():
+    argumentos = leer_argumentos()
+    registros = leer_captura(argumentos.captura, argumentos.limite)
+    if not registros:
+        print(f"replay: {argumentos.captura} no tiene registros")
+        return 1
+    duracion_original = (registros[-1]["ts"] - registros[0]["ts"]) / 1000
+    tipos = Counter(r["e"] for r in registros)
+    print(f"replay: {len(registros)} webhooks ({dict(tipos)}) en {duracion_original:.1f}s originales, velocidad {argumentos.velocidad}x")
+
+    zoho = app_a = servidor = None
+    base_url = argumentos.url
+    if not base_url:
+        fallas = fakes.Fallas.desde_texto(argumentos.fallas)
+        zoho = fakes.FakeZoho(fallas).iniciar()
+        app_a = fakes.FakeAppA(fallas).iniciar()
+        _, servidor, base_url = fakes.servir_app(zoho, app_a, argumentos.log_level)
+    print(f"replay: enviando a {base_url}")
+
+    reenvio = Reenvio(base_url, argumentos.hilos)
+    duracion = reenvio.ejecutar(registros, argumentos.velocidad)
+
+    todas = [l for lista in reenvio.latencias.values() for l in lista]
+    reporte = {
+        "webhooks": len(registros),
+        "velocidad": argumentos.velocidad,
+        "duracion_original_s": round(duracion_original, 2),
+        "duracion_s": round(duracion, 2),
+        "req_s": round(len(registros) / duracion, 2) if duracion else None,
+        "status": dict(reenvio.status),
+        "errores_cliente": reenvio.errores_cliente,
+        "latencia_ms": {"total": percentiles(todas), **{ruta: percentiles(l) for ruta, l in reenvio.latencias.items()}},
+        "atraso_ms": percentiles(reenvio.atrasos)
+    }
+    if zoho:
+        llamadas_zoho = zoho.total_llamadas()
+        llamadas_app_a = app_a.total_llamadas()
+        reporte["upstream"] = {
+            "zoho": dict(zoho.llamadas),
+            "app_a": dict(app_a.llamadas),
+            "llamadas_zoho_por_webhook": round(llamadas_zoho / len(registros), 3),
+            "llamadas_app_a_por_webhook": round(llamadas_app_a / len(registros), 3),
+            "amplificacion": round((llamadas_zoho + llamadas_app_a) / len(registros), 3)
+        }
+
+    print(json.dumps(reporte, indent=2, ensure_ascii=False))
+    if argumentos.reporte:
+        with open(argumentos.reporte, "w") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+    if servidor:
+        servidor.shutdown()
+        zoho.detener()
+        app_a.detener()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+Prueba de resistencia (soak) del puente WhatsApp <-> Zoho
+
+Levanta Zoho y App A falsos (fakes.py), sirve app.py en un servidor local y lo bombardea durante
+horas con la mezcla real de trafico: mensajes de usuario, botones (btn_*), espejos del bot,
+respuestas de agentes, webhooks duplicados y ecos. Los falsos inyectan latencia, 429, 5xx,
+200 vacios y conexiones reseteadas.
+
+Cada intervalo se toma una muestra de tracemalloc y de RSS. Al final la prueba falla (exit 1) si:
+- la memoria asignada desde app.py y sus modulos (ARCHIVOS_APP) crecio mas del limite desde el fin
+  del calentamiento; el RSS y el total de tracemalloc incluyen los falsos, el cliente y el allocator,
+  se reportan pero no deciden
+- el throughput de los ultimos intervalos cayo mas del limite frente a los primeros
+
+Uso:
+    python soak.py --duracion 14400 --hilos 8
+    python soak.py --duracion 120 --calentamiento 20 --intervalo 10 --fallas "429=0.05,reset=0.01"
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+from collections import Counter
+
+import requests
+
+import fakes
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+# modulos de la app cuya memoria se vigila (una asignación cuenta si alguno esta en su traceback)
+ARCHIVOS_APP = ("app.py", "estado.py", "cache_http.py")
+
+FALLAS_POR_DEFECTO = "latencia=5-40,429=0.02,5xx=0.01,vacio=0.01,reset=0.005"
+
+# escenario: peso en la mezcla de trafico
+MEZCLA = {
+    "usuario": 30,
+    "boton": 10,
+    "bot": 35,
+    "agente": 15,
+    "duplicado": 5,
+    "eco": 5
+}
+
+def leer_argumentos():
+    parser = argparse.ArgumentParser(description="Prueba de resistencia de app.py contra Zoho y App A falsos")
+    parser.add_argument("--duracion", type=float, default=7200, help="segundos totales (default 2h)")
+    parser.add_argument("--calentamiento", type=float, default=120, help="segundos antes de tomar la linea base")
+    parser.add_argument("--intervalo", type=float, default=30, help="segundos entre muestras")
+    parser.add_argument("--hilos", type=int, default=8, help="clientes concurrentes")
+    parser.add_argument("--telefonos", type=int, default=500, help="telefonos distintos en la mezcla")
+    parser.add_argument("--fallas", default=FALLAS_POR_DEFECTO, help="fallas inyectadas por los falsos")
+    parser.add_argument("--max-memoria-app-mb", type=float, default=16, help="crecimiento maximo de la memoria asignada desde ARCHIVOS_APP")
+    parser.add_argument("--max-caida-throughput", type=float, default=0.3, help="caida maxima de req/s (0..1)")
+    parser.add_argument("--cierres", type=int, default=5, help="conversaciones cerradas por intervalo en el Zoho falso")
+    parser.add_argument("--log-level", default="WARNING", help="nivel de log de app.py durante la prueba")
+    parser.add_argument("--reporte", help="ruta para guardar el reporte en JSON")
+    return parser.parse_args()
+
+def rss_mb():
+    """
+    Memoria residente del proceso en MB (Linux: /proc, otros: pico de getrusage)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+def memoria_app_mb(snapshot):
+    """
+    MB vivos asignados con algun modulo de la app en el traceback. Se agrupa por traceback y se
+    compara el nombre exacto: Filter(all_frames=True) hace fnmatch por frame y tarda segundos
+    """
+    archivos = {os.path.join(RAIZ, archivo) for archivo in ARCHIVOS_APP}
+    return sum(
+        stat.size for stat in snapshot.statistics("traceback")
+        if any(frame.filename in archivos for frame in stat.traceback)
+    ) / (1024 * 1024)
+
+class Carga:
+    """
+    Clientes que envian la mezcla de trafico y acumulan resultados por intervalo
+    """
+    def __init__(self, base_url, hilos, telefonos):
+        self.base_url = base_url
+        self.hilos = hilos
+        self.telefonos = [f"+57300{n:07d}" for n in range(telefonos)]
+        self.detener = threading.Event()
+        self._lock = threading.Lock()
+        self._mensajes_zoho = []
+        self._reiniciar()
+
+    def _reiniciar(self):
+        self.completadas = 0
+        self.errores_cliente = 0
+        self.status = Counter()
+        self.latencias = []
+
+    def tomar_intervalo(self):
+        with self._lock:
+            resultado = (self.completadas, self.errores_cliente, self.status, self.latencias)
+            self._reiniciar()
+        return resultado
+
+    def _request(self, escenario):
+        telefono = random.choice(self.telefonos)
+        if escenario in ("usuario", "boton", "bot"):
+            mensaje = {
+                "usuario": f"Hola, quiero información #{random.randint(1, 10**6)}",
+                "boton": random.choice(("btn_0", "btn_1", "btn_2", "btn_3")),
+                "bot": f"Estas son nuestras opciones #{random.randint(1, 10**6)}"
+            }[escenario]
+            tag = "respuesta_bot" if escenario == "bot" else "soporte_urgente"
+            return "/api/from-waba", {"user_id": telefono, "message": mensaje, "tag": tag}
+
+        with self._lock:
+            if escenario == "duplicado" and self._mensajes_zoho:
+                message_id = random.choice(self._mensajes_zoho)
+            else:
+                message_id = f"{random.getrandbits(48):012x}"
+                self._mensajes_zoho = (self._mensajes_zoho + [message_id])[-200:]
+        texto = "[🤖 Bot]: eco del bot" if escenario == "eco" else f"Con gusto te ayudo #{random.randint(1, 10**6)}"
+        remitente = "TicAll-Bot" if escenario == "eco" else "Agente Soak"
+        return "/api/from-zoho", {
+            "event": "conversation.operator.replied",
+            "entity": {
+                "message": {"id": message_id, "text": texto, "sender": {"name": remitente}},
+                "visitor": {"phone": telefono}
+            }
+        }
+
+    def _cliente(self):
+        sesion = requests.Session()
+        escenarios, pesos = zip(*MEZCLA.items())
+        while not self.detener.is_set():
+            ruta, payload = self._request(random.choices(escenarios, pesos)[0])
+            inicio = time.perf_counter()
+            try:
+                respuesta = sesion.post(f"{self.base_url}{ruta}", json=payload, timeout=60)
+                status = respuesta.status_code
+            except requests.exceptions.RequestException:
+                status = None
+            latencia = (time.perf_counter() - inicio) * 1000
+            with self._lock:
+                if status is None:
+                    self.errores_cliente += 1
+                    continue
+                self.completadas += 1
+                self.status[status] += 1
+                self.latencias.append(latencia)
+            if status in (429, 503):
+                # el control de admision pide esperar, un cliente real haria backoff
+                time.sleep(0.05)
+
+    def iniciar(self):
+        self._hilos = [threading.Thread(target=self._cliente, name=f"soak-{n}", daemon=True) for n in range(self.hilos)]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def parar(self):
+        self.detener.set()
+        for hilo in self._hilos:
+            hilo.join(timeout=70)
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p), len(ordenados) - 1)]
+
+def crecimiento_estable(muestras, campo, base):
+    # el minimo de las ultimas 3 muestras evita fallar por un pico puntual (ej: gc pendiente)
+    return min(m[campo] for m in muestras[-3:]) - base
+
+def evaluar(muestras, argumentos):
+    """
+    Compara la linea base (fin del calentamiento) con el final de la prueba
+    """
+    medidas = [m for m in muestras if not m["calentamiento"]]
+    if len(medidas) < 2:
+        return ["muy pocas muestras despues del calentamiento, aumente --duracion"], {}
+
+    base = medidas[0]
+    memoria_app = crecimiento_estable(medidas, "memoria_app_mb", base["memoria_app_mb"])
+    rss = crecimiento_estable(medidas, "rss_mb", base["rss_mb"])
+    traza = crecimiento_estable(medidas, "traza_mb", base["traza_mb"])
+    n = min(3, len(medidas) // 2)
+    inicial = sum(m["req_s"] for m in medidas[:n]) / n
+    final = sum(m["req_s"] for m in medidas[-n:]) / n
+    caida = 1 - final / inicial if inicial else 0.0
+
+    fallas = []
+    if memoria_app > argumentos.max_memoria_app_mb:
+        fallas.append(f"memoria de la app crecio {memoria_app:.1f} MB (limite {argumentos.max_memoria_app_mb} MB)")
+    if caida > argumentos.max_caida_throughput:
+        fallas.append(f"throughput cayo {caida:.0%} ({inicial:.1f} -> {final:.1f} req/s, limite {argumentos.max_caida_throughput:.0%})")
+    resumen = {
+        "crecimiento_memoria_app_mb": round(memoria_app, 2),
+        "crecimiento_rss_mb": round(rss, 2),
+        "crecimiento_traza_mb": round(traza, 2),
+        "req_s_inicial": round(inicial, 2),
+        "req_s_final": round(final, 2),
+        "caida_throughput": round(caida, 3)
+    }
+    return fallas, resumen
+
+def mayores_crecimientos(base, actual, limite=10):
+    filtros = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    diferencias = actual.filter_traces(filtros).compare_to(base.filter_traces(filtros), "lineno")
+    return [str(d) for d in diferencias[:limite] if d.size_diff > 0]
+
+def main():
+    argumentos = leer_argumentos()
+
+    fallas = fakes.Fallas.desde_texto(argumentos.fallas)
+    zoho = fakes.FakeZoho(fallas).iniciar()
+    app_a = fakes.FakeAppA(fallas).iniciar()
+    _, servidor, base_url = fakes.servir_app(zoho, app_a, argumentos.log_level)
+    # despues de importar: las asignaciones de los imports no crecen y harian lentas las muestras
+    tracemalloc.start(5)
+    print(f"soak: app en {base_url}, zoho falso en {zoho.url}, app A falsa en {app_a.url}")
+    print(f"soak: duracion={argumentos.duracion}s calentamiento={argumentos.calentamiento}s hilos={argumentos.hilos} fallas='{argumentos.fallas}'")
+
+    carga = Carga(base_url, argumentos.hilos, argumentos.telefonos)
+    inicio = time.monotonic()
+    carga.iniciar()
+
+    muestras = []
+    base_traza = None
+    ultimo = inicio
+    try:
+        while time.monotonic() - inicio < argumentos.duracion:
+            time.sleep(min(argumentos.intervalo, max(argumentos.duracion - (time.monotonic() - inicio), 0.1)))
+            ahora = time.monotonic()
+            completadas, errores_cliente, status, latencias = carga.tomar_intervalo()
+            for _ in range(argumentos.cierres):
+                zoho.cerrar_conversacion(random.choice(carga.telefonos))
+
+            calentando = ahora - inicio < argumentos.calentamiento
+            if not calentando and base_traza is None:
+                base_traza = tracemalloc.take_snapshot()
+            actual, pico = tracemalloc.get_traced_memory()
+            muestra = {
+                "t": round(ahora - inicio, 1),
+                "calentamiento": calentando,
+                "memoria_app_mb": round(memoria_app_mb(tracemalloc.take_snapshot()), 2),
+                "rss_mb": round(rss_mb(), 2),
+                "traza_mb": round(actual / (1024 * 1024), 2),
+                "traza_pico_mb": round(pico / (1024 * 1024), 2),
+                "req_s": round(completadas / (ahora - ultimo), 2),
+                "errores_cliente": errores_cliente,
+                "status": dict(status),
+                "p50_ms": round(percentil(latencias, 0.5), 1),
+                "p95_ms": round(percentil(latencias, 0.95), 1),
+                "p99_ms": round(percentil(latencias, 0.99), 1)
+            }
+            muestras.append(muestra)
+            ultimo = ahora
+            print(
+                f"soak: t={muestra['t']:>7}s app={muestra['memoria_app_mb']:.1f}MB rss={muestra['rss_mb']:.1f}MB traza={muestra['traza_mb']:.1f}MB "
+                f"req/s={muestra['req_s']:.1f} p95={muestra['p95_ms']}ms status={muestra['status']} "
+                f"errores_cliente={errores_cliente}{' (calentamiento)' if calentando else ''}",
+                flush=True
+            )
+    except KeyboardInterrupt:
+        print("soak: interrumpido, evaluando lo medido...")
+    finally:
+        carga.parar()
+
+    crecimientos = mayores_crecimientos(base_traza, tracemalloc.take_snapshot()) if base_traza else []
+    fallas_prueba, resumen = evaluar(muestras, argumentos)
+    reporte = {
+        "argumentos": vars(argumentos),
+        "resumen": resumen,
+        "fallas": fallas_prueba,
+        "llamadas_zoho": dict(zoho.llamadas),
+        "llamadas_app_a": dict(app_a.llamadas),
+        "mayores_crecimientos": crecimientos,
+        "muestras": muestras
+    }
+
+    print("\nsoak: mayores crecimientos de memoria desde la linea base:")
+    for linea in crecimientos:
+        print(f"  {linea}")
+    print(f"soak: llamadas a Zoho falso {dict(zoho.llamadas)}")
+    print(f"soak: llamadas a App A falsa {dict(app_a.llamadas)}")
+    print(f"soak: resumen {resumen}")
+    if argumentos.reporte:
+        with open(argumentos.reporte, "w") as f:
+            json.dump(reporte, f, indent=2, ensure_ascii=False)
+
+    servidor.shutdown()
+    zoho.detener()
+    app_a.detener()
+
+    if fallas_prueba:
+        for falla in fallas_prueba:
+            print(f"soak: FALLA - {falla}")
+        return 1
+    print("soak: OK")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Configuración comun de las pruebas: Zoho y App A falsos (fakes.py) sin latencia ni fallas,
+app.py importado apuntando a ellos, con un segundo portal "b" para las rutas /t/<portal>/...
+
+Uso: python -m pytest -q
+"""
+import os
+import sys
+import json
+import logging
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import fakes
+
+ZOHO = fakes.FakeZoho(fakes.Fallas(latencia_min_ms=0, latencia_max_ms=0)).iniciar()
+APP_A = fakes.FakeAppA(fakes.Fallas(latencia_min_ms=0, latencia_max_ms=0)).iniciar()
+
+os.environ.update(fakes.variables_entorno(ZOHO, APP_A, portal="pruebas"))
+os.environ.update({
+    "VERIFY_TOKEN": "pruebas",
+    "ZOHO_PORTALS": json.dumps({
+        "b": {
+            "portal_name": "b",
+            "client_id": "fake",
+            "client_secret": "fake",
+            "refresh_token": "fake",
+            "app_a_url": APP_A.url
+        }
+    }),
+    "ZOHO_CACHE_TTL": "0",                  # la cache tiene sus propias pruebas (test_cache_http.py)
+    "SHUTDOWN_CHECKPOINT_PATH": "",
+    "WABA_DEADLINE_SECONDS": "3",
+    "ZOHO_DEADLINE_SECONDS": "3",
+    "ADMISSION_QUEUE_WAIT_MS": "100",
+    "PRIORITY_QUEUE_TIMEOUT": "2"
+})
+
+import app as modulo_app
+
+logging.getLogger().setLevel(logging.WARNING)
+
+ADMIN = {"X-Admin-Token": "pruebas"}
+
+@pytest.fixture
+def app():
+    return modulo_app
+
+@pytest.fixture
+def cliente():
+    return modulo_app.app.test_client()
+
+@pytest.fixture
+def zoho():
+    return ZOHO
+
+@pytest.fixture
+def app_a():
+    return APP_A
+
+@pytest.fixture(autouse=True)
+def _estado_limpio():
+    """
+    Cada prueba parte del estado en memoria vacio y de los falsos sin llamadas registradas
+    """
+    modulo_app.ESTADO._datos.clear()
+    ZOHO.reiniciar_contadores()
+    APP_A.reiniciar_contadores()
+    yield
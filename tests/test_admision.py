@@ -0,0 +1,57 @@
+"""
+Control de admisión: sin cupo se responde rapido 429 (cola llena) o 503 (espera agotada) con Retry-After
+"""
+import threading
+import time
+
+from contextlib import contextmanager
+
+@contextmanager
+def ocupado(control, cupos):
+    for _ in range(cupos):
+        assert control.admitir(0) is None
+    try:
+        yield
+    finally:
+        for _ in range(cupos):
+            control.liberar()
+
+def test_cola_llena_429_y_espera_agotada_503(app):
+    control = app.ControlAdmision("prueba", limite=1, max_cola=1)
+    assert control.admitir(0) is None
+    assert control.admitir(0.05) == 503
+
+    en_cola = threading.Thread(target=control.admitir, args=(0.5,))
+    en_cola.start()
+    while control.metricas()["en_cola"] < 1:
+        time.sleep(0.005)
+    assert control.admitir(0.05) == 429
+
+    control.liberar()
+    en_cola.join()
+    assert control.metricas() == {
+        "limite": 1, "en_curso": 1, "en_cola": 0, "admitidos": 2, "rechazados_cola": 1, "rechazados_espera": 1
+    }
+    control.liberar()
+    assert control.admitir(0) is None
+
+def test_salud_sin_cupo_responde_503_con_retry_after(cliente, app):
+    salud = app.ADMISION["salud"]
+    with ocupado(salud, salud.limite):
+        respuesta = cliente.get("/verify?token=pruebas")
+        assert respuesta.status_code == 503
+        assert respuesta.headers["Retry-After"] == str(app.ADMISSION_RETRY_AFTER)
+        assert respuesta.get_json() == {"error": "Service overloaded", "reason": "queue_wait_exceeded"}
+        # los webhooks tienen su propio cupo
+        assert cliente.post("/api/from-zoho", json={"event": "otro"}).status_code == 200
+    assert cliente.get("/verify?token=pruebas").status_code == 200
+
+def test_cupo_por_portal(cliente, app):
+    control = app.PORTALES["b"].admision["from_zoho"]
+    assert control.limite < app.ADMISION["from_zoho"].limite
+    with ocupado(control, control.limite):
+        respuesta = cliente.post("/t/b/api/from-zoho", json={"event": "otro"})
+        assert respuesta.status_code == 503
+        assert respuesta.get_json()["reason"] == "portal_queue_wait_exceeded"
+        # el portal por defecto no se ve afectado
+        assert cliente.post("/api/from-zoho", json={"event": "otro"}).status_code == 200
@@ -0,0 +1,141 @@
+"""
+Apagado ordenado: importar no instala nada, SIGTERM ignorado se respeta y el checkpoint solo
+guarda los requests que no han escrito en Zoho/App A
+"""
+import json
+import signal
+import threading
+import time
+
+import pytest
+
+@pytest.fixture
+def apagado(app, monkeypatch, tmp_path):
+    ruta = tmp_path / "pendientes.jsonl"
+    monkeypatch.setattr(app, "SHUTDOWN_CHECKPOINT_PATH", str(ruta))
+    monkeypatch.setattr(app, "SHUTDOWN_DRAIN_SECONDS", 0)
+    yield ruta
+    app.APAGANDO.clear()
+
+def test_importar_no_tiene_efectos(app):
+    assert signal.getsignal(signal.SIGTERM) is not app._manejar_sigterm
+    assert "reanudar_pendientes" not in [hilo.name for hilo in threading.enumerate()]
+    assert not app._APP_INICIADA
+
+@pytest.mark.parametrize("actual, instalado", [(signal.SIG_IGN, False), (signal.SIG_DFL, True)])
+def test_iniciar_app_respeta_sig_ign(app, monkeypatch, actual, instalado):
+    instalados, registrados = [], []
+    monkeypatch.setattr(app, "_APP_INICIADA", False)
+    monkeypatch.setattr(app, "_SIGTERM_ANTERIOR", None)
+    monkeypatch.setattr(app.signal, "getsignal", lambda signum: actual)
+    monkeypatch.setattr(app.signal, "signal", lambda signum, manejador: instalados.append(manejador) or actual)
+    monkeypatch.setattr(app.atexit, "register", lambda *args: registrados.append(args))
+
+    app.iniciar_app()
+    app.iniciar_app()
+    assert instalados == ([app._manejar_sigterm] if instalado else [])
+    assert registrados == [(app.apagado_ordenado, "exit")]
+
+def test_manejador_con_anterior_ignorado_no_apaga(app, monkeypatch):
+    monkeypatch.setattr(app, "_SIGTERM_ANTERIOR", signal.SIG_IGN)
+    app._manejar_sigterm(signal.SIGTERM, None)
+    assert not app.APAGANDO.is_set()
+
+def test_sigterm_drena_fuera_del_manejador(app, apagado, monkeypatch):
+    anteriores, reenvios = [], []
+    monkeypatch.setattr(app, "SHUTDOWN_DRAIN_SECONDS", 5)
+    monkeypatch.setattr(app, "_SIGTERM_ANTERIOR", lambda signum, frame: anteriores.append(signum))
+    monkeypatch.setattr(app, "_SIGTERM_DRENANDO", threading.Event())
+    monkeypatch.setattr(app, "_SIGTERM_DRENADO", threading.Event())
+    monkeypatch.setattr(app.os, "kill", lambda pid, signum: reenvios.append(signum))
+    monkeypatch.setitem(app.EN_CURSO, "en-curso", {"upstream": True, "guardado": False})
+
+    # el manejador retorna sin esperar el drenaje: el request en curso puede terminar
+    inicio = time.monotonic()
+    app._manejar_sigterm(signal.SIGTERM, None)
+    app._manejar_sigterm(signal.SIGTERM, None)
+    assert time.monotonic() - inicio < 0.5
+    assert app.APAGANDO.is_set() and not reenvios
+    del app.EN_CURSO["en-curso"]
+
+    # drenado: la señal se reenvia una vez y en la segunda llegada pasa al manejador anterior
+    esperar(lambda: reenvios)
+    assert reenvios == [signal.SIGTERM] and app.METRICAS_APAGADO["drain_ms"] < 5000
+    app._manejar_sigterm(signal.SIGTERM, None)
+    assert anteriores == [signal.SIGTERM]
+
+def esperar(condicion, maximo=5):
+    limite = time.monotonic() + maximo
+    while not condicion():
+        assert time.monotonic() < limite
+        time.sleep(0.01)
+
+def test_checkpoint_solo_de_lo_no_iniciado(cliente, app, zoho, app_a, apagado, monkeypatch):
+    app.get_access_token()               # el token ya en cache, from_waba solo lee antes de escribir
+    monkeypatch.setattr(zoho.fallas, "latencia_min_ms", 300)
+    monkeypatch.setattr(zoho.fallas, "latencia_max_ms", 300)
+    monkeypatch.setattr(app_a.fallas, "latencia_min_ms", 600)
+    monkeypatch.setattr(app_a.fallas, "latencia_max_ms", 600)
+    zoho.reiniciar_contadores()
+
+    respuestas = {}
+    def enviar(nombre, ruta, payload):
+        respuestas[nombre] = app.app.test_client().post(ruta, json=payload)
+    agente = {
+        "event": "conversation.operator.replied",
+        "entity": {"message": {"id": "m-apagado", "text": "Hola", "sender": {"name": "Agente"}}, "visitor": {"phone": "3001110033"}}
+    }
+    hilos = [
+        threading.Thread(target=enviar, args=("waba", "/api/from-waba", {"user_id": "3001110034", "message": "hola"})),
+        threading.Thread(target=enviar, args=("zoho", "/api/from-zoho", agente))
+    ]
+    for hilo in hilos:
+        hilo.start()
+    # from_zoho ya esta reenviando a App A, from_waba todavia lee en Zoho
+    esperar(lambda: len(app.EN_CURSO) == 2 and any(e["upstream"] for e in list(app.EN_CURSO.values())))
+    app.apagado_ordenado("prueba")
+    for hilo in hilos:
+        hilo.join()
+
+    assert app.METRICAS_APAGADO["pendientes_guardados"] == 1
+    assert app.METRICAS_APAGADO["pendientes_ya_iniciados"] == 1
+    (guardado,) = [json.loads(linea) for linea in apagado.read_text().splitlines()]
+    assert guardado["endpoint"] == "/api/from-waba" and guardado["payload"]["user_id"] == "3001110034"
+    assert "upstream" not in guardado
+
+    # el guardado no escribio nada en Zoho y se responde 503; el iniciado termina normal
+    assert respuestas["waba"].status_code == 503
+    assert respuestas["waba"].get_json()["reason"] == "shutting_down"
+    assert all(r["ruta"].startswith("GET") for r in zoho.recibidos)
+    assert respuestas["zoho"].status_code == 200
+
+    # al iniciar de nuevo se reenvia y crea la conversación
+    app.APAGANDO.clear()
+    monkeypatch.setattr(zoho.fallas, "latencia_min_ms", 0)
+    monkeypatch.setattr(zoho.fallas, "latencia_max_ms", 0)
+    app.reanudar_pendientes()
+    assert not apagado.exists()
+    assert [r["cuerpo"]["visitor"]["phone"] for r in zoho.recibidos_en("POST visitor/conversations")] == ["3001110034"]
+
+def test_refrescar_el_token_no_cuenta_como_escritura(cliente, app, zoho, apagado, monkeypatch):
+    # token frio: la primera llamada del request es el POST a /oauth/v2/token
+    portal = app.portal_actual()
+    monkeypatch.setattr(portal, "token", None)
+    monkeypatch.setattr(portal, "token_expira", None)
+    monkeypatch.setattr(zoho.fallas, "latencia_min_ms", 300)
+    monkeypatch.setattr(zoho.fallas, "latencia_max_ms", 300)
+
+    respuestas = {}
+    hilo = threading.Thread(target=lambda: respuestas.update(
+        waba=app.app.test_client().post("/api/from-waba", json={"user_id": "3001110035", "message": "hola"})
+    ))
+    hilo.start()
+    esperar(lambda: len(app.EN_CURSO) == 1)
+    time.sleep(0.1)
+    assert not any(e["upstream"] for e in list(app.EN_CURSO.values()))
+    app.apagado_ordenado("prueba")
+    hilo.join()
+
+    assert app.METRICAS_APAGADO["pendientes_guardados"] == 1
+    assert respuestas["waba"].status_code == 503
+    assert zoho.recibidos_en("POST visitor/conversations") == []
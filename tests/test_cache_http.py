@@ -0,0 +1,126 @@
+"""
+CacheHTTP: LRU acotada por bytes, revalidación 304, GETs unidos y generación por coleccion
+"""
+import threading
+import time
+
+import requests
+
+from cache_http import CacheHTTP
+
+BASE = "https://zoho.prueba/api/v2/portal/"
+
+def nueva_cache(ttl=60, max_entradas=100, max_bytes=10_000):
+    return CacheHTTP([BASE], ttl, "", max_entradas, max_bytes)
+
+def respuesta(url, cuerpo, status=200, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r._content = cuerpo.encode("utf-8")
+    r.url = url
+    r.headers.update(headers or {})
+    return r
+
+class Upstream:
+    """enviar() falso: cuenta las llamadas y puede quedar bloqueado hasta soltar()"""
+    def __init__(self, bloquear=False):
+        self.llamadas = 0
+        self._soltar = threading.Event()
+        if not bloquear:
+            self._soltar.set()
+        self._lock = threading.Lock()
+
+    def soltar(self):
+        self._soltar.set()
+
+    def enviar(self, url, cuerpo):
+        def _enviar(opciones):
+            with self._lock:
+                self.llamadas += 1
+            self._soltar.wait(5)
+            return respuesta(url, cuerpo)
+        return _enviar
+
+def test_lru_acotada_por_bytes():
+    cache = nueva_cache(max_bytes=250)
+    upstream = Upstream()
+    urls = [f"{BASE}conversations?n={n}" for n in "abc"]
+    cache.obtener(urls[0], {}, upstream.enviar(urls[0], "a" * 100))
+    cache.obtener(urls[1], {}, upstream.enviar(urls[1], "b" * 100))
+    cache.obtener(urls[0], {}, upstream.enviar(urls[0], "a" * 100))       # acierto, pasa al final
+    cache.obtener(urls[2], {}, upstream.enviar(urls[2], "c" * 100))
+    metricas = cache.metricas()
+    assert (metricas["entradas"], metricas["bytes"], metricas["desalojos"]) == (2, 200, 1)
+    # se desalojo el menos usado (b), a sigue guardada
+    cache.obtener(urls[0], {}, upstream.enviar(urls[0], "a" * 100))
+    assert upstream.llamadas == 3 and cache.metricas()["aciertos"] == 2
+
+    # una respuesta mas grande que el limite no se guarda ni desaloja nada
+    grande = f"{BASE}visitors"
+    assert cache.obtener(grande, {}, upstream.enviar(grande, "x" * 300)).content == b"x" * 300
+    assert cache.metricas()["entradas"] == 2 and cache.bytes <= 250
+
+def test_revalidacion_304_contra_zoho_falso(zoho):
+    url = f"{zoho.url}/api/v2/pruebas/conversations"
+    cache = CacheHTTP([f"{zoho.url}/api/v2/"], 0.05, "", 100, 10_000)
+    sesion = requests.Session()
+    def enviar(opciones):
+        return sesion.get(url, **opciones)
+
+    primera = cache.obtener(url, {"params": {"limit": 5}, "timeout": 5}, enviar)
+    time.sleep(0.1)
+    segunda = cache.obtener(url, {"params": {"limit": 5}, "timeout": 5}, enviar)
+    assert segunda.status_code == 200 and segunda.json() == primera.json()
+    assert cache.metricas()["revalidaciones"] == 1
+    (condicional,) = [r for r in zoho.recibidos_en("GET conversations") if "If-None-Match" in r["headers"]]
+    assert condicional["params"] == {"limit": "5"}
+    assert zoho.llamadas["304"] >= 1
+
+def test_gets_identicos_se_unen():
+    cache = nueva_cache()
+    upstream = Upstream(bloquear=True)
+    url = f"{BASE}visitors"
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(cache.obtener(url, {"timeout": 5}, upstream.enviar(url, "[]")).json())) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    while cache.metricas()["coalescidas"] < 3:
+        time.sleep(0.005)
+    upstream.soltar()
+    for hilo in hilos:
+        hilo.join()
+    assert upstream.llamadas == 1
+    assert resultados == [[]] * 4
+
+def test_escritura_durante_el_get_no_deja_lectura_vieja():
+    cache = nueva_cache()
+    lento = Upstream(bloquear=True)
+    url = f"{BASE}conversations"
+    resultado = []
+    hilo = threading.Thread(target=lambda: resultado.append(cache.obtener(url, {"timeout": 5}, lento.enviar(url, '["vieja"]')).json()))
+    hilo.start()
+    while lento.llamadas < 1:
+        time.sleep(0.005)
+
+    cache.invalidar(f"{BASE}conversations")          # POST exitoso mientras el GET esta en vuelo
+    # un GET posterior no se une al que empezo antes de la escritura
+    nuevo = Upstream()
+    assert cache.obtener(url, {"timeout": 5}, nuevo.enviar(url, '["nueva"]')).json() == ["nueva"]
+    assert nuevo.llamadas == 1
+
+    lento.soltar()
+    hilo.join()
+    assert resultado == [["vieja"]]
+    # lo que quedo guardado es la lectura posterior a la escritura
+    assert cache.obtener(url, {"timeout": 5}, Upstream().enviar(url, "[]")).json() == ["nueva"]
+    assert cache.metricas()["aciertos"] == 1
+
+def test_invalidar_solo_su_coleccion():
+    cache = nueva_cache()
+    upstream = Upstream()
+    for coleccion in ("visitors", "conversations"):
+        cache.obtener(f"{BASE}{coleccion}", {}, upstream.enviar(f"{BASE}{coleccion}", "[]"))
+    cache.invalidar(f"{BASE}conversations/123/messages")
+    assert cache.metricas()["entradas"] == 2              # messages no es una coleccion cacheada
+    cache.invalidar(f"{BASE}conversations")
+    assert cache.metricas()["entradas"] == 1 and cache.metricas()["invalidaciones"] == 1
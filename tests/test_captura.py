@@ -0,0 +1,57 @@
+"""
+Captura de trafico: sin datos personales, hashes estables con la sal y tamaño contado en bytes
+"""
+import json
+
+import pytest
+
+@pytest.fixture
+def captura(app, monkeypatch, tmp_path):
+    ruta = tmp_path / "captura.jsonl"
+    monkeypatch.setattr(app, "CAPTURE_PATH", str(ruta))
+    monkeypatch.setattr(app, "CAPTURE_SALT", "sal-de-prueba")
+    monkeypatch.setattr(app, "_CAPTURA", {"archivo": None, "bytes": 0, "lineas": 0, "llena": False, "sin_sal": False})
+    yield ruta
+    if app._CAPTURA["archivo"]:
+        app._CAPTURA["archivo"].close()
+
+def leer(ruta):
+    return [json.loads(linea) for linea in ruta.read_text(encoding="utf-8").splitlines()]
+
+def test_sin_datos_personales_y_hash_estable(cliente, app, captura):
+    cliente.post("/api/from-waba", json={"user_id": "3001110041", "message": "mi cedula es 123", "tag": "respuesta_bot"})
+    cliente.post("/api/from-waba", json={"user_id": "+57 300 111 0041", "message": "btn_2"})
+    cliente.post("/api/from-waba", json={"user_id": "3001110042", "message": "hola"}, headers={"X-Replay": "capture"})
+
+    texto = captura.read_text(encoding="utf-8")
+    assert "3001110041" not in texto and "cedula" not in texto
+    primero, segundo = leer(captura)
+    # el mismo telefono en dos formatos da el mismo hash
+    assert primero["tel"] == segundo["tel"] == app.hash_captura(app.limpiar_telefono("3001110041"))
+    assert primero["largo"] == len("mi cedula es 123") and segundo["boton"] == "btn_2"
+
+def test_bytes_contados_en_utf8(cliente, app, captura):
+    eco = {
+        "event": "conversation.operator.replied",
+        "entity": {"message": {"id": "m-41", "text": "[🤖 Bot]: ñandú", "sender": {"name": "TicAll-Bot"}}, "visitor": {"phone": "3001110041"}}
+    }
+    cliente.post("/api/from-zoho", json=eco)
+    cliente.post("/api/from-waba", json={"user_id": "3001110041", "message": "[👤 Usuario]: canción"})
+    app._CAPTURA["archivo"].flush()
+    assert app._CAPTURA["bytes"] == captura.stat().st_size
+    assert app._CAPTURA["lineas"] == 2
+
+def test_limite_en_bytes(cliente, app, captura, monkeypatch):
+    cliente.post("/api/from-waba", json={"user_id": "3001110041", "message": "[👤 Usuario]: 🌟🌟🌟"})
+    tamano = captura.stat().st_size
+    # cabe por caracteres pero no por bytes: no se escribe
+    monkeypatch.setattr(app, "CAPTURE_MAX_BYTES", tamano * 2 - 1)
+    cliente.post("/api/from-waba", json={"user_id": "3001110041", "message": "[👤 Usuario]: 🌟🌟🌟"})
+    assert app._CAPTURA["llena"] and captura.stat().st_size == tamano
+
+def test_sin_sal_no_se_captura(cliente, app, captura, monkeypatch, caplog):
+    monkeypatch.setattr(app, "CAPTURE_SALT", "")
+    for _ in range(2):
+        assert cliente.post("/api/from-waba", json={"user_id": "3001110041", "message": "hola"}).status_code == 200
+    assert not captura.exists()
+    assert [r.message for r in caplog.records].count("captura: CAPTURE_PATH esta definido sin CAPTURE_SALT, no se captura") == 1
@@ -0,0 +1,58 @@
+"""
+Carriles de prioridad: reparto por peso, anti-inanición y el cupo solo alrededor del trabajo upstream
+"""
+import threading
+import time
+
+def cola_llena(planificador, clase, cantidad, llegada):
+    for _ in range(cantidad):
+        planificador._colas[clase].append({"llegada": llegada, "evento": threading.Event(), "otorgado": False})
+
+def test_reparto_por_peso(app):
+    planificador = app.PlanificadorPrioridad(1, {"escalacion": 4, "bot": 1}, max_espera=60)
+    ahora = time.monotonic()
+    cola_llena(planificador, "escalacion", 20, ahora)
+    cola_llena(planificador, "bot", 20, ahora)
+    elegidos = []
+    for _ in range(10):
+        clase = planificador._elegir_carril(ahora)
+        planificador._colas[clase].popleft()
+        elegidos.append(clase)
+    assert elegidos.count("escalacion") == 8 and elegidos.count("bot") == 2
+    # suave: el bot no queda al final de la ronda
+    assert elegidos.index("bot") < 5
+
+def test_anti_inanicion(app):
+    planificador = app.PlanificadorPrioridad(1, {"escalacion": 100, "bot": 1}, max_espera=0.5)
+    ahora = time.monotonic()
+    cola_llena(planificador, "escalacion", 5, ahora)
+    cola_llena(planificador, "bot", 1, ahora - 1)
+    assert planificador._elegir_carril(ahora) == "bot"
+
+def test_sin_cupo_y_metricas(app):
+    planificador = app.PlanificadorPrioridad(1, {"usuario": 2, "bot": 1}, max_espera=60)
+    assert planificador.adquirir("usuario", 0.1)
+    assert not planificador.adquirir("bot", 0.05)
+    planificador.liberar()
+    assert planificador.adquirir("desconocido", 0.1)         # va al carril de menor peso
+    metricas = planificador.metricas()
+    assert metricas["activos"] == 1
+    assert metricas["carriles"]["bot"]["sin_cupo"] == 1 and metricas["carriles"]["bot"]["atendidos"] == 1
+
+def test_esperar_el_candado_no_ocupa_cupo(app):
+    planificador = app.portal_actual().planificador
+    clave = app.portal_actual().clave(f"lock:tel:{app.limpiar_telefono('3001110036')}")
+    assert app.ESTADO.adquirir_lease(clave, "otro-proceso", 30)
+
+    respuestas = []
+    hilo = threading.Thread(target=lambda: respuestas.append(
+        app.app.test_client().post("/api/from-waba", json={"user_id": "3001110036", "message": "hola"})
+    ))
+    hilo.start()
+    time.sleep(0.3)
+    # el request esta esperando el candado del telefono sin tomar cupo upstream
+    assert app.EN_CURSO and planificador.activos == 0
+    app.ESTADO.liberar_lease(clave, "otro-proceso")
+    hilo.join()
+    assert respuestas[0].status_code == 200
+    assert planificador.activos == 0
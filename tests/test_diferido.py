@@ -0,0 +1,83 @@
+"""
+Modo diferido (ZOHO_LAZY_CONVERSATIONS) y traducción de botones
+"""
+import pytest
+
+def test_formatear_boton_solo_con_el_id_exacto(app):
+    assert app.formatear_boton("[👤 Usuario]: btn_1") == "[👤 Usuario]: 🌟Micropigmen. Ceja"
+    assert app.formatear_boton("[👤 Usuario]: btn_10") == "[👤 Usuario]: 🪷Depilación Facial"
+    assert app.formatear_boton("btn_si1") == "[👤 Usuario]: Si"
+    assert app.formatear_boton("[🤖 Bot]: Elige btn_1 o btn_10") == "[🤖 Bot]: Elige btn_1 o btn_10"
+    assert app.formatear_boton("[👤 Usuario]: quiero btn_2 mañana") == "[👤 Usuario]: quiero btn_2 mañana"
+    # idempotente: una linea ya traducida no cambia
+    assert app.formatear_boton("[👤 Usuario]: 🌟Micropigmen. Ceja") == "[👤 Usuario]: 🌟Micropigmen. Ceja"
+
+@pytest.fixture
+def diferido(app, monkeypatch):
+    monkeypatch.setattr(app, "ZOHO_LAZY_CONVERSATIONS", True)
+
+def test_transcripcion_al_escalar_conserva_cada_linea(cliente, zoho, diferido):
+    telefono = "3001110001"
+    mensajes = [
+        {"user_id": telefono, "message": "Elige btn_1 o btn_10", "tag": "respuesta_bot"},
+        {"user_id": telefono, "message": "btn_10"}
+    ]
+    for payload in mensajes:
+        respuesta = cliente.post("/api/from-waba", json=payload)
+        assert respuesta.get_json()["action"] == "buffered"
+    assert zoho.recibidos_en("POST visitor/conversations") == []
+
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "btn_0"})
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()["action"] == "conversation_created"
+
+    creadas = zoho.recibidos_en("POST visitor/conversations")
+    assert len(creadas) == 1
+    assert creadas[0]["cuerpo"]["question"].split("\n") == [
+        "[🤖 Bot]: Elige btn_1 o btn_10",
+        "[👤 Usuario]: 🪷Depilación Facial",
+        "[👤 Usuario]: 📞Hablar con una experta"
+    ]
+
+    # ya materializada: el siguiente mensaje va directo a la conversación, traducido una sola vez
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "btn_1"})
+    assert respuesta.get_json()["action"] == "conversation_exists"
+    enviados = zoho.recibidos_en("POST conversations/messages")
+    assert [e["cuerpo"]["text"] for e in enviados] == ["[👤 Usuario]: 🌟Micropigmen. Ceja"]
+
+def test_escalacion_solo_con_el_trigger_exacto(app):
+    assert app.es_escalacion("btn_0", None)
+    assert app.es_escalacion(" [👤 Usuario]: btn_0 ", None)
+    assert not app.es_escalacion("btn_01", None)
+    assert not app.es_escalacion("no quiero btn_0", None)
+    assert not app.es_escalacion("btn_0", "respuesta_bot")
+
+def _materializar(cliente, telefono):
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "btn_0"})
+    assert respuesta.get_json()["action"] == "conversation_created"
+
+def test_cierre_por_reconciliador_vuelve_al_buffer(cliente, app, zoho, diferido):
+    telefono = "3001110002"
+    _materializar(cliente, telefono)
+    zoho.cerrar_conversacion(telefono)
+    app.reconciliar_conversaciones(completo=True)
+    assert not app.esta_materializada(app.limpiar_telefono(telefono))
+
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "Hola de nuevo", "tag": "respuesta_bot"})
+    assert respuesta.get_json()["action"] == "buffered"
+
+def test_cierre_detectado_al_enviar_vuelve_al_buffer(cliente, app, zoho, diferido):
+    telefono = "3001110003"
+    _materializar(cliente, telefono)
+    zoho.cerrar_conversacion(telefono)
+    creadas = len(zoho.recibidos_en("POST visitor/conversations"))
+
+    # el mapa local todavia apunta a la conversación cerrada: el envio falla y no se abre otra
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "Hola de nuevo", "tag": "respuesta_bot"})
+    assert respuesta.get_json()["action"] == "buffered"
+    assert len(zoho.recibidos_en("POST visitor/conversations")) == creadas
+    assert app.leer_transcripcion(app.limpiar_telefono(telefono)) == ["[🤖 Bot]: Hola de nuevo"]
+
+    # la siguiente escalación abre la conversación con lo guardado
+    _materializar(cliente, telefono)
+    assert zoho.recibidos_en("POST visitor/conversations")[-1]["cuerpo"]["question"].startswith("[🤖 Bot]: Hola de nuevo\n")
@@ -0,0 +1,45 @@
+"""
+/stats: contadores en anillos de memoria fija por minuto, hora y dia
+"""
+from conftest import ADMIN
+
+def test_anillo_recicla_buckets(app):
+    anillo = app.AnilloContadores(buckets=4, ancho=1, max_contadores=2)
+    anillo.sumar(1, 100.2)
+    anillo.sumar(1, 100.7)
+    anillo.sumar(1, 102.0)
+    assert [(e, v[1]) for e, v in anillo.buckets_vigentes(102.5)] == [(100, 2), (102, 1)]
+    # una vuelta despues el bucket de 100 se reinicia en lugar de acumular
+    anillo.sumar(1, 104.1)
+    assert [(e, v[1]) for e, v in anillo.buckets_vigentes(104.5)] == [(102, 1), (104, 1)]
+    assert anillo.buckets_vigentes(200) == []
+
+def test_contadores_acotados(app):
+    estadisticas = app.EstadisticasTrafico(max_contadores=3)
+    estadisticas.contar("a", "b", "c", "d")
+    estadisticas.contar("a")
+    resumen = estadisticas.resumen("minuto")
+    # sin espacio para mas nombres, lo nuevo cae en "otros"
+    assert resumen["total"] == {"otros": 2, "a": 2, "b": 1}
+    assert resumen["ventanas"]["ultimo_minuto"] == resumen["ventanas"]["ultimo_dia"] == resumen["total"]
+    assert len(resumen["serie"]) == 1
+
+def test_endpoint_stats(cliente, app):
+    assert cliente.get("/stats").status_code == 403
+    antes = cliente.get("/stats", headers=ADMIN).get_json()["total"]
+
+    cliente.post("/api/from-waba", json={"user_id": "3001110039", "message": "btn_1"})
+    cliente.post("/api/from-waba", json={"user_id": "3001110039", "message": "sigo"})
+    eco = {
+        "event": "conversation.operator.replied",
+        "entity": {"message": {"id": "eco-39", "text": "[🤖 Bot]: hola", "sender": {"name": "TicAll-Bot"}}, "visitor": {"phone": "3001110039"}}
+    }
+    cliente.post("/api/from-zoho", json=eco)
+
+    despues = cliente.get("/stats?serie=hora", headers=ADMIN).get_json()
+    def delta(nombre):
+        return despues["total"].get(nombre, 0) - antes.get(nombre, 0)
+    assert delta("conversaciones_creadas") == 1 and delta("conversaciones_reutilizadas") == 1
+    assert delta("boton:btn_1") == 1
+    assert delta("ecos_suprimidos") == 1
+    assert despues["serie"]
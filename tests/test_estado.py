@@ -0,0 +1,174 @@
+"""
+Contrato del estado compartido: el mismo comportamiento en memoria, SQLite y Redis (FakeRedis)
+"""
+import time
+import threading
+
+import pytest
+
+import fakes
+from estado import ErrorEstado, EstadoMemoria, EstadoSQLite, EstadoRedis, crear_backend_estado
+
+@pytest.fixture(scope="module")
+def redis_falso():
+    servidor = fakes.FakeRedis().iniciar()
+    yield servidor
+    servidor.detener()
+
+@pytest.fixture(params=["memoria", "sqlite", "redis"])
+def estado(request, tmp_path, redis_falso):
+    if request.param == "memoria":
+        return EstadoMemoria()
+    if request.param == "sqlite":
+        return EstadoSQLite(str(tmp_path / "estado.db"))
+    with redis_falso._lock:
+        redis_falso._datos.clear()
+    return crear_backend_estado(redis_falso.url)
+
+def test_get_set_delete_y_vencimiento(estado):
+    assert estado.get("a") is None
+    estado.set("a", "1")
+    estado.set("b", "2", ttl=0.2)
+    assert (estado.get("a"), estado.get("b")) == ("1", "2")
+    estado.delete("a")
+    assert estado.get("a") is None
+    time.sleep(0.3)
+    assert estado.get("b") is None
+
+def test_marcar_una_vez(estado):
+    assert estado.marcar_una_vez("dedupe:1", 0.2)
+    assert not estado.marcar_una_vez("dedupe:1", 0.2)
+    estado.desmarcar("dedupe:1")
+    assert estado.marcar_una_vez("dedupe:1", 0.2)
+    time.sleep(0.3)
+    assert estado.marcar_una_vez("dedupe:1", 0.2)
+
+def test_cas(estado):
+    assert estado.cas("k", None, "v1")
+    assert not estado.cas("k", None, "v2")
+    assert not estado.cas("k", "otro", "v2")
+    assert estado.cas("k", "v1", "v2", ttl=0.2)
+    assert estado.get("k") == "v2"
+    assert not estado.cas_borrar("k", "v1")
+    assert estado.cas_borrar("k", "v2")
+    assert estado.get("k") is None
+    estado.set("k", "v3", ttl=0.2)
+    time.sleep(0.3)
+    # vencida cuenta como ausente
+    assert estado.cas("k", None, "v4")
+
+def test_lease_se_renueva_y_vence(estado):
+    assert estado.adquirir_lease("lease", "a", 0.3)
+    assert not estado.adquirir_lease("lease", "b", 0.3)
+    assert estado.adquirir_lease("lease", "a", 0.3)          # renovación del mismo dueño
+    assert not estado.liberar_lease("lease", "b")
+    time.sleep(0.4)
+    assert estado.adquirir_lease("lease", "b", 0.3)          # vencio, lo toma otro
+    assert not estado.liberar_lease("lease", "a")            # el dueño anterior no lo suelta
+    assert estado.liberar_lease("lease", "b")
+    assert estado.adquirir_lease("lease", "a", 0.3)
+
+def test_candado_bajo_contencion(app, estado, monkeypatch):
+    """
+    Varios hilos leen-modifican-escriben el mismo contador con candado_estado: no se pierden incrementos
+    """
+    monkeypatch.setattr(app, "ESTADO", estado)
+    estado.set("contador", "0")
+    obtenidos = []
+
+    def incrementar():
+        for _ in range(5):
+            with app.candado_estado("lock:contador", ttl=5, espera=10) as obtenido:
+                obtenidos.append(obtenido)
+                valor = int(estado.get("contador"))
+                time.sleep(0.001)
+                estado.set("contador", str(valor + 1))
+
+    hilos = [threading.Thread(target=incrementar) for _ in range(6)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert all(obtenidos)
+    assert estado.get("contador") == "30"
+    assert estado.get("lock:contador") is None
+
+def test_redis_reconecta_si_el_servidor_corta(redis_falso):
+    estado = EstadoRedis(*redis_falso._servidor.server_address[:2])
+    estado.set("x", "1")
+    redis_falso.cortar_conexiones()
+    time.sleep(0.05)
+    assert estado.get("x") == "1"
+
+def test_redis_no_guarda_la_conexion_si_auth_falla():
+    servidor = fakes.FakeRedis(password="secreta").iniciar()
+    try:
+        host, puerto = servidor._servidor.server_address[:2]
+        estado = EstadoRedis(host, puerto, password="otra")
+        with pytest.raises(ErrorEstado):
+            estado.get("x")
+        assert getattr(estado._local, "conexion", None) is None
+        # con la clave correcta la siguiente conexión si queda
+        estado._password = "secreta"
+        assert estado.get("x") is None
+        assert estado._local.conexion is not None
+    finally:
+        servidor.detener()
+
+def test_redis_no_reintenta_un_cas_ya_enviado(redis_falso):
+    estado = EstadoRedis(*redis_falso._servidor.server_address[:2])
+    estado.delete("nx")
+    enviados = redis_falso.comandos["SET"]
+    redis_falso.perder_respuestas("SET")
+    with pytest.raises(ConnectionError):
+        estado.cas("nx", None, "1")
+    # el servidor lo aplico una sola vez: un reintento habria visto la clave y retornado False
+    assert redis_falso.comandos["SET"] == enviados + 1
+    assert estado.get("nx") == "1"
+
+def test_redis_reintenta_lecturas_sin_respuesta(redis_falso):
+    estado = EstadoRedis(*redis_falso._servidor.server_address[:2])
+    estado.set("leida", "1")
+    redis_falso.perder_respuestas("GET")
+    assert estado.get("leida") == "1"
+
+def test_sqlite_get_no_toma_el_candado_de_escritura(tmp_path):
+    ruta = str(tmp_path / "estado.db")
+    estado = EstadoSQLite(ruta)
+    estado.set("a", "1")
+    estado.set("vencida", "1", ttl=0.01)
+    time.sleep(0.02)
+    otro = EstadoSQLite(ruta)
+    with otro._transaccion():
+        # otro proceso tiene la escritura: la lectura no espera
+        inicio = time.monotonic()
+        assert estado.get("a") == "1"
+        assert estado.get("vencida") is None
+        assert time.monotonic() - inicio < 1
+
+def test_crear_backend_estado(tmp_path):
+    assert isinstance(crear_backend_estado("memoria"), EstadoMemoria)
+    assert isinstance(crear_backend_estado(f"sqlite:///{tmp_path}/e.db"), EstadoSQLite)
+    assert isinstance(crear_backend_estado("redis://localhost:6399/1"), EstadoRedis)
+    with pytest.raises(ValueError):
+        crear_backend_estado("mongodb://localhost")
+
+def webhook_agente(message_id, telefono="3001110027"):
+    return {
+        "event": "conversation.operator.replied",
+        "entity": {
+            "message": {"id": message_id, "text": "Con gusto te ayudo", "sender": {"name": "Agente"}},
+            "visitor": {"phone": telefono}
+        }
+    }
+
+@pytest.mark.parametrize("falla", ["5xx", "reset"])
+def test_from_zoho_libera_el_dedupe_si_app_a_falla(cliente, app_a, falla):
+    app_a.forzar("POST /api/envio_whatsapp", falla)
+    assert cliente.post("/api/from-zoho", json=webhook_agente(f"m-{falla}")).status_code == 500
+
+    # el reintento de Zoho se reenvia, no queda como duplicado
+    respuesta = cliente.post("/api/from-zoho", json=webhook_agente(f"m-{falla}"))
+    assert respuesta.get_json() == {"status": "enviado a App A"}
+    assert cliente.post("/api/from-zoho", json=webhook_agente(f"m-{falla}")).get_json() == {"status": "duplicado ignorado"}
+    assert len(app_a.recibidos_en("POST /api/envio_whatsapp")) == 2
@@ -0,0 +1,55 @@
+"""
+Validación de los webhooks: errores de esquema con 400 y cuerpos grandes con 413, ambos en JSON
+"""
+import io
+
+def test_payload_grande_responde_413_en_json(cliente, app, zoho):
+    texto = "x" * (app.WEBHOOK_MAX_BYTES + 1)
+    respuesta = cliente.post("/api/from-waba", json={"user_id": "3001110034", "message": texto})
+    assert respuesta.status_code == 413
+    assert respuesta.is_json
+    cuerpo = respuesta.get_json()
+    assert cuerpo["error"] == "Payload too large" and cuerpo["details"]
+    assert zoho.recibidos == type(zoho.recibidos)()
+
+def test_esquema_invalido_responde_400_con_detalle(cliente):
+    respuesta = cliente.post("/api/from-waba", json={"user_id": "3001110034"})
+    assert respuesta.status_code == 400
+    assert set(respuesta.get_json()) == {"error", "details"}
+
+    respuesta = cliente.post("/api/from-zoho", json={"event": "conversation.operator.replied", "entity": {"message": {"text": "hola"}}})
+    assert respuesta.status_code == 400
+
+    # telefono con tipo invalido: falla el esquema
+    respuesta = cliente.post("/api/from-zoho", json={
+        "event": "conversation.operator.replied",
+        "entity": {"message": {"text": "hola"}, "visitor": {"phone": ["3001110034"]}}
+    })
+    assert respuesta.status_code == 400
+    assert set(respuesta.get_json()) == {"error", "details"}
+    cuerpo = respuesta.get_json()
+    assert cuerpo["error"] == "Invalid payload" and cuerpo["details"]
+
+def test_413_tambien_en_from_zoho(cliente, app):
+    respuesta = cliente.post("/t/b/api/from-zoho", data=b"{" + b" " * app.WEBHOOK_MAX_BYTES + b"}", content_type="application/json")
+    assert respuesta.status_code == 413
+    assert respuesta.get_json()["error"] == "Payload too large"
+
+def test_413_no_deja_cupo_de_admision_tomado(cliente, app):
+    cuerpo = b"{" + b" " * app.WEBHOOK_MAX_BYTES + b"}"
+    # con Content-Length se rechaza antes de admitir, sin el (chunked) al leer el cuerpo
+    for _ in range(app.ADMISION["from_waba"].limite + 1):
+        respuesta = cliente.post("/api/from-waba", data=cuerpo, content_type="application/json")
+        assert respuesta.status_code == 413
+        respuesta = cliente.post(
+            "/api/from-waba", input_stream=io.BytesIO(cuerpo), content_type="application/json",
+            environ_overrides={"wsgi.input_terminated": True}
+        )
+        assert respuesta.status_code == 413
+    assert app.ADMISION["from_waba"].metricas()["en_curso"] == 0
+    assert app.portal_actual().admision["from_waba"].metricas()["en_curso"] == 0
+    assert app.EN_CURSO == {}
+
+def test_esquema_extrae_rutas_alternativas(app):
+    campos = app.ESQUEMA_WABA.extraer({"phone": 3001110034, "text": "hola"})
+    assert (campos["telefono"], campos["mensaje"]) == (3001110034, "hola")
@@ -0,0 +1,37 @@
+"""
+Perfilado bajo demanda: cProfile por request (X-Profile) y consulta en /admin/profile
+"""
+import marshal
+
+from conftest import ADMIN
+
+def perfilar(cliente):
+    respuesta = cliente.post("/api/from-zoho", json={"event": "otro"}, headers={"X-Profile": "pruebas"})
+    assert respuesta.status_code == 200
+    return cliente.get("/admin/profile", headers=ADMIN).get_json()[-1]
+
+def test_perfil_por_header(cliente):
+    perfil = perfilar(cliente)
+    assert perfil["ruta"] == "/api/from-zoho"
+    assert perfil["trace_id"]
+
+    texto = cliente.get(f"/admin/profile/{perfil['id']}?sort=tottime,calls&limit=5", headers=ADMIN)
+    assert texto.status_code == 200
+    assert "function calls" in texto.get_data(as_text=True)
+
+    binario = cliente.get(f"/admin/profile/{perfil['id']}?format=pstats", headers=ADMIN)
+    assert isinstance(marshal.loads(binario.data), dict)
+
+def test_sin_secreto_no_se_perfila(cliente, app):
+    antes = len(app.PERFILES)
+    cliente.post("/api/from-zoho", json={"event": "otro"}, headers={"X-Profile": "otro-secreto"})
+    assert len(app.PERFILES) == antes
+    assert cliente.get("/admin/profile").status_code == 403
+
+def test_sort_y_limit_invalidos_responden_400(cliente):
+    perfil = perfilar(cliente)
+    for query in ("sort=no_existe", "sort=cumulative,bogus", "sort=", "limit=abc", "limit=0", "limit=1.5"):
+        respuesta = cliente.get(f"/admin/profile/{perfil['id']}?{query}", headers=ADMIN)
+        assert respuesta.status_code == 400, query
+        assert "error" in respuesta.get_json()
+    assert cliente.get("/admin/profile/no-existe", headers=ADMIN).status_code == 404
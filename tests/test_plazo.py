@@ -0,0 +1,59 @@
+"""
+Presupuesto de tiempo por request: timeouts recortados a lo que queda y 504 al agotarse
+"""
+import contextvars
+import time
+
+import pytest
+
+def con_presupuesto(app, segundos, funcion):
+    def correr():
+        app._PLAZO.set({"limite": time.monotonic() + segundos, "total": segundos, "pasos": []})
+        return funcion()
+    return contextvars.copy_context().run(correr)
+
+def test_recortar_timeout(app):
+    assert app.recortar_timeout(10) == 10                      # sin presupuesto no se toca
+    assert con_presupuesto(app, 30, lambda: app.recortar_timeout(10)) == 10
+    assert con_presupuesto(app, 2, lambda: app.recortar_timeout(10)) == pytest.approx(2, abs=0.05)
+    conectar, leer = con_presupuesto(app, 2, lambda: app.recortar_timeout((1, 10)))
+    assert conectar == 1 and leer == pytest.approx(2, abs=0.05)
+    with pytest.raises(app.PresupuestoAgotado):
+        con_presupuesto(app, 0.01, lambda: app.recortar_timeout(10))
+
+def test_zoho_lento_responde_504_dentro_del_presupuesto(cliente, app, zoho, monkeypatch):
+    app.get_access_token()
+    monkeypatch.setattr(zoho.fallas, "latencia_min_ms", 1600)
+    monkeypatch.setattr(zoho.fallas, "latencia_max_ms", 1600)
+
+    inicio = time.monotonic()
+    respuesta = cliente.post("/api/from-waba", json={"user_id": "3001110035", "message": "hola"})
+    duracion = time.monotonic() - inicio
+
+    assert respuesta.status_code == 504
+    cuerpo = respuesta.get_json()
+    assert cuerpo["error"] == "Deadline exceeded" and cuerpo["budget_s"] == app.WABA_DEADLINE_SECONDS
+    assert cuerpo["steps"]
+    assert duracion < app.WABA_DEADLINE_SECONDS + 0.5
+
+def test_carril_con_presupuesto_agotado_es_504(cliente, app):
+    with pytest.raises(app.PresupuestoAgotado):
+        con_presupuesto(app, 0.01, lambda: app.carril_prioridad("usuario").__enter__())
+    assert app.portal_actual().planificador.activos == 0
+
+    # el candado del telefono consume todo el presupuesto y los carriles estan llenos: es 504 y no 503
+    planificador = app.portal_actual().planificador
+    clave = app.portal_actual().clave(f"lock:tel:{app.limpiar_telefono('3001110037')}")
+    assert app.ESTADO.adquirir_lease(clave, "otro-proceso", 30)
+    for _ in range(planificador.limite):
+        assert planificador.adquirir("agente", 0.1)
+    try:
+        respuesta = cliente.post("/api/from-waba", json={"user_id": "3001110037", "message": "hola"})
+    finally:
+        for _ in range(planificador.limite):
+            planificador.liberar()
+        app.ESTADO.liberar_lease(clave, "otro-proceso")
+    assert respuesta.status_code == 504
+    cuerpo = respuesta.get_json()
+    assert cuerpo["error"] == "Deadline exceeded" and cuerpo["phone"] == "3001110037"
+    assert cuerpo["budget_s"] == app.WABA_DEADLINE_SECONDS
@@ -0,0 +1,29 @@
+"""
+Varios portales: las rutas /t/<portal>/... tienen traza, perfilado y estado propios del portal
+"""
+from conftest import ADMIN
+
+def test_ruta_de_portal_con_traza_y_perfil(cliente, app):
+    respuesta = cliente.post("/t/b/api/from-zoho", json={"event": "otro"}, headers={"X-Trace-Id": "t-portal", "X-Profile": "pruebas"})
+    assert respuesta.status_code == 200
+    assert respuesta.headers["X-Trace-Id"] == "t-portal"
+    perfil = cliente.get("/admin/profile", headers=ADMIN).get_json()[-1]
+    assert perfil["ruta"] == "/t/b/api/from-zoho" and perfil["trace_id"] == "t-portal"
+
+    respuesta = cliente.post("/t/b/api/from-waba", json={"user_id": "3001110038", "message": "hola"})
+    assert respuesta.status_code == 200
+    assert len(respuesta.headers["X-Trace-Id"]) == 32
+
+def test_estado_por_portal(cliente, app, zoho):
+    for ruta in ("/api/from-waba", "/t/b/api/from-waba"):
+        respuesta = cliente.post(ruta, json={"user_id": "3001110039", "message": "hola"})
+        assert respuesta.get_json()["action"] in ("conversation_created", "conversation_exists")
+    clave = app.limpiar_telefono("3001110039")
+    assert app.ESTADO.get(app.PORTALES["b"].clave(f"conv:{clave}"))
+    assert app.ESTADO.get(app.PORTALES[app.PORTAL_DEFAULT].clave(f"conv:{clave}"))
+
+def test_header_de_portal_y_portal_desconocido(cliente, app):
+    assert cliente.post("/api/from-zoho", json={"event": "otro"}, headers={app.PORTAL_HEADER: "b"}).status_code == 200
+    respuesta = cliente.post("/t/no-existe/api/from-zoho", json={"event": "otro"})
+    assert respuesta.status_code == 404
+    assert respuesta.get_json() == {"error": "Unknown portal", "portal": "no-existe"}
@@ -0,0 +1,62 @@
+"""
+Mapa local de conversaciones y reconciliador contra el Zoho falso
+"""
+import pytest
+
+def test_ciclo_completo(app, monkeypatch):
+    monkeypatch.setattr(app, "RECONCILE_FULL_SCAN_EVERY", 1)
+    assert all(app.es_ciclo_completo(ciclo) for ciclo in range(1, 5))
+    monkeypatch.setattr(app, "RECONCILE_FULL_SCAN_EVERY", 3)
+    assert [app.es_ciclo_completo(ciclo) for ciclo in range(1, 8)] == [True, False, False, True, False, False, True]
+    monkeypatch.setattr(app, "RECONCILE_FULL_SCAN_EVERY", 0)
+    assert not app.es_ciclo_completo(1)
+
+@pytest.mark.parametrize("chat_status, esperado", [
+    ({"status_key": "open"}, True),
+    ({"status_key": "open", "state": 2}, True),
+    ({"state": 1}, True),
+    ({"status_key": "closed"}, False),
+    ({"status_key": "open", "state": 4}, False),
+    ({}, None),
+    (None, None)
+])
+def test_aplicar_conversacion(app, chat_status, esperado):
+    clave = app.limpiar_telefono("3001110030")
+    app.guardar_conversacion_local(clave, "viejo")
+    conv = {"id": "c-1", "visitor": {"phone": "3001110030"}, "chat_status": chat_status}
+    assert app._aplicar_conversacion(conv) is esperado
+    # estado desconocido: el mapa local no se toca
+    assert app.conversacion_local(clave) == {None: "viejo", True: "c-1", False: "viejo"}[esperado]
+
+def test_reconciliar_aplica_cierres_y_salta_sin_estado(cliente, app, zoho):
+    for telefono in ("3001110031", "3001110032"):
+        assert cliente.post("/api/from-waba", json={"user_id": telefono, "message": "hola"}).status_code == 200
+    clave_abierta, clave_cerrada, clave_sin_estado = map(app.limpiar_telefono, ("3001110031", "3001110032", "3001110033"))
+    abierta = app.conversacion_local(clave_abierta)
+    assert abierta and app.conversacion_local(clave_cerrada)
+    zoho.cerrar_conversacion("3001110032")
+    with zoho._lock:
+        zoho._nueva_conversacion("3001110033").pop("chat_status")
+
+    app.reconciliar_conversaciones(completo=True)
+    metricas = app.portal_actual().metricas_reconciliador
+    # el falso es compartido entre pruebas, puede traer conversaciones de otras
+    assert metricas["cerradas"] >= 1 and metricas["sin_estado"] >= 1 and metricas["abiertas"] >= 1
+    assert app.conversacion_local(clave_abierta) == abierta
+    assert app.conversacion_local(clave_cerrada) is None
+    assert app.conversacion_local(clave_sin_estado) is None
+
+def test_creacion_fallida_tras_mapa_viejo_es_500(cliente, app, zoho):
+    telefono = "3001110034"
+    assert cliente.post("/api/from-waba", json={"user_id": telefono, "message": "hola"}).status_code == 200
+    zoho.cerrar_conversacion(telefono)
+
+    # el mapa local apunta a la conversación cerrada y crear la nueva falla con cuerpo vacio
+    zoho.forzar("POST visitor/conversations", "vacio")
+    respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "sigo aqui"})
+    assert respuesta.status_code == 500
+
+def test_creacion_exitosa(app):
+    assert app.creacion_exitosa({"conversacion_id": "1"})
+    assert not app.creacion_exitosa({"error": "fallo"})
+    assert not app.creacion_exitosa(None)
@@ -0,0 +1,50 @@
+"""
+Criterio de soak.py: decide la memoria asignada desde la app, el RSS solo se reporta
+"""
+import argparse
+import threading
+import tracemalloc
+
+import soak
+
+ARGUMENTOS = argparse.Namespace(max_memoria_app_mb=16, max_caida_throughput=0.3)
+
+def muestra(t, memoria_app, rss, req_s=20, calentamiento=False):
+    return {"t": t, "calentamiento": calentamiento, "memoria_app_mb": memoria_app, "rss_mb": rss, "traza_mb": rss / 4, "req_s": req_s}
+
+def test_rss_no_decide():
+    muestras = [muestra(0, 5, 100, calentamiento=True)] + [muestra(t, 5.5, 100 + t * 10) for t in range(1, 8)]
+    fallas, resumen = soak.evaluar(muestras, ARGUMENTOS)
+    assert fallas == []
+    assert resumen["crecimiento_rss_mb"] == 40 and resumen["crecimiento_memoria_app_mb"] == 0
+
+def test_memoria_de_la_app_y_throughput_deciden():
+    muestras = [muestra(t, 5 + t * 5, 100, req_s=20 if t < 4 else 10) for t in range(8)]
+    fallas, _ = soak.evaluar(muestras, ARGUMENTOS)
+    assert len(fallas) == 2
+    assert "memoria de la app" in fallas[0] and "throughput" in fallas[1]
+
+def test_pocas_muestras():
+    fallas, resumen = soak.evaluar([muestra(0, 5, 100)], ARGUMENTOS)
+    assert fallas and resumen == {}
+
+def test_memoria_app_cuenta_solo_lo_asignado_desde_la_app(app, cliente):
+    tracemalloc.start(5)
+    try:
+        ajeno = [bytearray(1024) for _ in range(2000)]           # ~2 MB fuera de la app
+        for n in range(20):
+            cliente.post("/api/from-zoho", json={"event": "otro", "n": n})
+        memoria = soak.memoria_app_mb(tracemalloc.take_snapshot())
+    finally:
+        tracemalloc.stop()
+    assert 0 < memoria < 1
+    assert ajeno
+
+def test_mensajes_zoho_con_lock():
+    carga = soak.Carga("http://127.0.0.1:1", hilos=1, telefonos=3)
+    hilos = [threading.Thread(target=lambda: [carga._request("agente") for _ in range(500)]) for _ in range(4)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    assert len(carga._mensajes_zoho) == 200
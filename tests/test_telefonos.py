@@ -0,0 +1,39 @@
+"""
+Normalización de telefonos a E.164: la misma clave para todos los formatos con que llega un numero
+"""
+import pytest
+
+@pytest.mark.parametrize("telefono", [
+    "3001110031",
+    "573001110031",
+    "+573001110031",
+    "+57 300 111 0031",
+    "0057-300-111-0031",
+    "(300) 111-0031",
+    "03001110031",
+    573001110031
+])
+def test_formatos_de_un_mismo_numero(app, telefono):
+    assert app.limpiar_telefono(telefono) == "+573001110031"
+
+def test_otros_paises_y_vacios(app):
+    assert app.limpiar_telefono("+1 415 555 0100") == "+14155550100"
+    assert app.limpiar_telefono("") == ""
+    assert app.limpiar_telefono(None) == ""
+    assert app.limpiar_telefono("sin numero") == ""
+
+def test_memoizado(app):
+    app._normalizar_telefono.cache_clear()
+    for _ in range(3):
+        app.limpiar_telefono("+57 300 111 0031")
+    info = app._normalizar_telefono.cache_info()
+    assert (info.misses, info.hits) == (1, 2)
+
+def test_formatos_distintos_reusan_la_conversacion(cliente, zoho):
+    respuesta = cliente.post("/api/from-waba", json={"user_id": "573001110036", "message": "hola"})
+    assert respuesta.get_json()["action"] == "conversation_created"
+    for telefono in ("+57 300 111 0036", "3001110036"):
+        respuesta = cliente.post("/api/from-waba", json={"user_id": telefono, "message": "sigo aqui"})
+        assert respuesta.get_json()["action"] == "conversation_exists"
+    assert len(zoho.recibidos_en("POST visitor/conversations")) == 1
+    assert len(zoho.recibidos_en("POST conversations/messages")) == 2
@@ -0,0 +1,39 @@
+"""
+Trazabilidad: trace_id de entrada -> logs, headers salientes, header de respuesta y spans exportados
+"""
+import json
+
+def webhook_agente(message_id):
+    return {
+        "event": "conversation.operator.replied",
+        "entity": {
+            "message": {"id": message_id, "text": "Hola", "sender": {"name": "Agente"}},
+            "visitor": {"phone": "3001110028"}
+        }
+    }
+
+def test_trace_id_llega_a_app_a_y_a_la_respuesta(cliente, app_a):
+    respuesta = cliente.post("/api/from-zoho", json=webhook_agente("t-1"), headers={"X-Request-ID": "abc-123"})
+    assert respuesta.headers["X-Trace-Id"] == "abc-123"
+    (enviado,) = app_a.recibidos_en("POST /api/envio_whatsapp")
+    assert enviado["headers"]["X-Trace-Id"] == "abc-123"
+
+def test_traceparent_y_trace_id_generado(cliente, app):
+    traceparent = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    respuesta = cliente.post("/api/from-zoho", json={"event": "otro"}, headers={"traceparent": traceparent})
+    assert respuesta.headers["X-Trace-Id"] == "4bf92f3577b34da6a3ce929d0e0e4736"
+    respuesta = cliente.post("/api/from-zoho", json={"event": "otro"})
+    assert len(respuesta.headers["X-Trace-Id"]) == 32
+    # fuera de los webhooks no hay traza
+    assert "X-Trace-Id" not in cliente.get("/verify?token=pruebas").headers
+
+def test_spans_exportados(cliente, app, tmp_path, monkeypatch):
+    ruta = tmp_path / "trazas.jsonl"
+    monkeypatch.setattr(app, "TRACE_EXPORT_PATH", str(ruta))
+    cliente.post("/api/from-waba", json={"user_id": "3001110028", "message": "hola"}, headers={"X-Trace-Id": "t-spans"})
+    (traza,) = [json.loads(linea) for linea in ruta.read_text().splitlines()]
+    assert traza["trace_id"] == "t-spans"
+    assert traza["status"] == 200
+    nombres = [s["span"] for s in traza["spans"]]
+    assert "token" in nombres and "search" in nombres and "create" in nombres
+    assert all(s["duracion_ms"] >= 0 for s in traza["spans"])